@@ -26,6 +26,8 @@ from builtins import str
 from builtins import range
 from past.utils import old_div
 import cv2
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import sys
 import scipy.ndimage
@@ -67,7 +69,44 @@ from .traces import trace
 from ..mmapping import load_memmap
 from ..utils import visualization
 from .. import summary_images as si
-from ..motion_correction import apply_shift_online, motion_correct_online
+from ..motion_correction import apply_shift_online, motion_correct_online, write_frames_memmap
+
+
+def map_frame_chunks(func, num_frames, n_threads=None):
+    """ apply a function to chunks of frame indices in a pool of threads
+
+    Used by the frame by frame movie methods. OpenCV and numpy release the GIL,
+    so the chunks are processed in parallel without copying the movie.
+
+    Parameters:
+    ----------
+    func: function
+        function taking an array of frame indices
+
+    num_frames: int
+        number of frames
+
+    n_threads: int
+        number of threads. None uses all the cores
+
+    Returns:
+    -------
+    results: list
+        outputs of func, in the order of the chunks
+    """
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    n_threads = int(max(1, min(n_threads, num_frames)))
+    chunks = [idxs for idxs in np.array_split(np.arange(num_frames), 4 * n_threads) if len(idxs) > 0]
+    if n_threads == 1:
+        return list(map(func, chunks))
+
+    pool = ThreadPool(n_threads)
+    try:
+        return pool.map(func, chunks)
+    finally:
+        pool.close()
+        pool.join()
 
 
 class movie(ts.timeseries):
@@ -240,7 +279,7 @@ class movie(ts.timeseries):
         num_frames = num_windows * window
         return np.nanmedian(np.nanmean(np.reshape(self[:num_frames], (window, num_windows, d1, d2)), axis=0), axis=0)
 
-    def extract_shifts(self, max_shift_w=5, max_shift_h=5, template=None, method='opencv'):
+    def extract_shifts(self, max_shift_w=5, max_shift_h=5, template=None, method='opencv', n_threads=None):
         """
         Performs motion corretion using the opencv matchtemplate function. At every iteration a template is built by taking the median of all frames and then used to align the other frames.
 
@@ -252,6 +291,9 @@ class movie(ts.timeseries):
 
         method: depends on what is installed 'opencv' or 'skimage'. 'skimage' is an order of magnitude slower
 
+        n_threads: number of threads processing chunks of frames in parallel (see map_frame_chunks).
+                   None uses all the cores
+
         Returns:
         -------
         shifts : tuple, contains shifts in x and y and correlation with template
@@ -292,50 +334,61 @@ class movie(ts.timeseries):
         template = template[ms_h:h_i - ms_h,
                             ms_w:w_i - ms_w].astype(np.float32)
 
-        #% run algorithm, press q to stop it
-        shifts = []   # store the amount of shift in each frame
-        xcorrs = []
+        if method not in ('opencv', 'skimage'):
+            raise Exception('Unknown motion correction method!')
 
-        for i, frame in enumerate(self):
-            if i % 100 == 99:
-                print(("Frame %i" % (i + 1)))
-            if method == 'opencv':
-                res = cv2.matchTemplate(frame, template, cv2.TM_CCORR_NORMED)
-                top_left = cv2.minMaxLoc(res)[3]
-            elif method == 'skimage':
-                res = match_template(frame, template)
-                top_left = np.unravel_index(np.argmax(res), res.shape)
-                top_left = top_left[::-1]
-            else:
-                raise Exception('Unknown motion correction method!')
-            avg_corr = np.mean(res)
-            sh_y, sh_x = top_left
-
-            if (0 < top_left[1] < 2 * ms_h - 1) & (0 < top_left[0] < 2 * ms_w - 1):
-                # if max is internal, check for subpixel shift using gaussian
-                # peak registration
-                log_xm1_y = np.log(res[sh_x - 1, sh_y])
-                log_xp1_y = np.log(res[sh_x + 1, sh_y])
-                log_x_ym1 = np.log(res[sh_x, sh_y - 1])
-                log_x_yp1 = np.log(res[sh_x, sh_y + 1])
-                four_log_xy = 4 * np.log(res[sh_x, sh_y])
-
-                sh_x_n = -(sh_x - ms_h + old_div((log_xm1_y - log_xp1_y),
-                                                 (2 * log_xm1_y - four_log_xy + 2 * log_xp1_y)))
-                sh_y_n = -(sh_y - ms_w + old_div((log_x_ym1 - log_x_yp1),
-                                                 (2 * log_x_ym1 - four_log_xy + 2 * log_x_yp1)))
-            else:
-                sh_x_n = -(sh_x - ms_h)
-                sh_y_n = -(sh_y - ms_w)
+        frames = np.asarray(self)
 
-            shifts.append([sh_x_n, sh_y_n])
-            xcorrs.append([avg_corr])
+        def extract_shifts_chunk(idxs):
+            chunk_shifts = []   # store the amount of shift in each frame
+            chunk_xcorrs = []
+            for i in idxs:
+                if i % 100 == 99:
+                    print(("Frame %i" % (i + 1)))
+                if method == 'opencv':
+                    res = cv2.matchTemplate(frames[i], template, cv2.TM_CCORR_NORMED)
+                    top_left = cv2.minMaxLoc(res)[3]
+                else:
+                    res = match_template(frames[i], template)
+                    top_left = np.unravel_index(np.argmax(res), res.shape)
+                    top_left = top_left[::-1]
+                avg_corr = np.mean(res)
+                sh_y, sh_x = top_left
+
+                if (0 < top_left[1] < 2 * ms_h - 1) & (0 < top_left[0] < 2 * ms_w - 1):
+                    # if max is internal, check for subpixel shift using gaussian
+                    # peak registration
+                    log_xm1_y = np.log(res[sh_x - 1, sh_y])
+                    log_xp1_y = np.log(res[sh_x + 1, sh_y])
+                    log_x_ym1 = np.log(res[sh_x, sh_y - 1])
+                    log_x_yp1 = np.log(res[sh_x, sh_y + 1])
+                    four_log_xy = 4 * np.log(res[sh_x, sh_y])
+
+                    sh_x_n = -(sh_x - ms_h + old_div((log_xm1_y - log_xp1_y),
+                                                     (2 * log_xm1_y - four_log_xy + 2 * log_xp1_y)))
+                    sh_y_n = -(sh_y - ms_w + old_div((log_x_ym1 - log_x_yp1),
+                                                     (2 * log_x_ym1 - four_log_xy + 2 * log_x_yp1)))
+                else:
+                    sh_x_n = -(sh_x - ms_h)
+                    sh_y_n = -(sh_y - ms_w)
+
+                chunk_shifts.append([sh_x_n, sh_y_n])
+                chunk_xcorrs.append([avg_corr])
+            return chunk_shifts, chunk_xcorrs
+
+        #% run algorithm on chunks of frames in parallel
+        shifts = []
+        xcorrs = []
+        for chunk_shifts, chunk_xcorrs in map_frame_chunks(extract_shifts_chunk, len(frames), n_threads):
+            shifts += chunk_shifts
+            xcorrs += chunk_xcorrs
 
         self = self + min_val
 
         return (shifts, xcorrs)
 
-    def apply_shifts(self, shifts, interpolation='linear', method='opencv', remove_blanks=False):
+    def apply_shifts(self, shifts, interpolation='linear', method='opencv', remove_blanks=False, n_threads=None,
+                     out=None):
         """
         Apply precomputed shifts to a movie, using subpixels adjustment (cv2.INTER_CUBIC function)
 
@@ -345,9 +398,16 @@ class movie(ts.timeseries):
 
         interpolation: 'linear', 'cubic', 'nearest' or cvs.INTER_XXX
 
+        n_threads: number of threads processing chunks of frames in parallel (see map_frame_chunks).
+                   None uses all the cores
+
+        out: preallocated array or memmap receiving the shifted frames instead of the movie itself.
+             Either T x h x w, or pixels x T (frames flattened in F order as in the
+             CaImAn memory mapped files, see write_frames_memmap)
+
         Returns:
         -------
-        self
+        self, or out if passed
 
         Raise:
         -----
@@ -394,27 +454,45 @@ class movie(ts.timeseries):
         else:
             raise Exception('Interpolation method not available')
 
-        _, h, w = self.shape
-        for i, frame in enumerate(self):
-            if i % 100 == 99:
-                print(("Frame %i" % (i + 1)))
-
-            sh_x_n, sh_y_n = shifts[i]
+        if method not in ('opencv', 'skimage'):
+            raise Exception('Unknown shift  application method')
+        if remove_blanks and out is not None:
+            raise Exception('remove_blanks cannot be used with out')
 
-            if method == 'opencv':
-                M = np.float32([[1, 0, sh_y_n], [0, 1, sh_x_n]])
-                min_, max_ = np.min(frame), np.max(frame)
-                self[i] = np.clip(cv2.warpAffine(
-                    frame, M, (w, h), flags=interpolation, borderMode=cv2.BORDER_REFLECT), min_, max_)
+        _, h, w = self.shape
+        frames = np.asarray(self)
+        target = frames if out is None else out
+        # frames flattened in a pixels x time array are written one chunk at a time
+        buffered = np.ndim(target) == 2
+
+        def apply_shifts_chunk(idxs):
+            # chunks cover disjoint frames, so they can be written concurrently
+            new_frames = np.empty((len(idxs), h, w), dtype=np.float32) if buffered else target[idxs[0]:idxs[-1] + 1]
+            for k, i in enumerate(idxs):
+                if i % 100 == 99:
+                    print(("Frame %i" % (i + 1)))
+
+                sh_x_n, sh_y_n = shifts[i]
+
+                if method == 'opencv':
+                    M = np.float32([[1, 0, sh_y_n], [0, 1, sh_x_n]])
+                    min_, max_ = np.min(frames[i]), np.max(frames[i])
+                    new_frames[k] = np.clip(cv2.warpAffine(
+                        frames[i], M, (w, h), flags=interpolation, borderMode=cv2.BORDER_REFLECT), min_, max_)
+                else:
+                    tform = AffineTransform(translation=(-sh_y_n, -sh_x_n))
+                    new_frames[k] = warp(frames[i], tform, preserve_range=True,
+                                         order=interpolation)
 
-            elif method == 'skimage':
+            if buffered:
+                write_frames_memmap(target, new_frames, idxs)
 
-                tform = AffineTransform(translation=(-sh_y_n, -sh_x_n))
-                self[i] = warp(frame, tform, preserve_range=True,
-                               order=interpolation)
+        map_frame_chunks(apply_shifts_chunk, len(frames), n_threads)
 
-            else:
-                raise Exception('Unknown shift  application method')
+        if out is not None:
+            if hasattr(out, 'flush'):
+                out.flush()
+            return out
 
         if remove_blanks:
             max_h, max_w = np.max(shifts, axis=0)
@@ -463,12 +541,13 @@ class movie(ts.timeseries):
         t, h, w = self.shape
         return self[crop_begin:t - crop_end, crop_top:h - crop_bottom, crop_left:w - crop_right]
 
-    def computeDFF(self, secsWindow=5, quantilMin=8, method='only_baseline', order='F'):
+    def computeDFF(self, secsWindow=5, quantilMin=8, method='only_baseline', order='F', exact=False):
         """
         compute the DFF of the movie or remove baseline
 
         In order to compute the baseline frames are binned according to the window length parameter
-        and then the intermediate values are interpolated.
+        and then the intermediate values are interpolated, unless exact is set, in which case the
+        baseline of each pixel is its running quantile over a window centered at each frame.
 
         Parameters:
         ----------
@@ -478,6 +557,9 @@ class movie(ts.timeseries):
 
         method='only_baseline','delta_f_over_f','delta_f_over_sqrt_f'
 
+        exact: bool
+            compute the running quantile at every frame instead of interpolating between bins
+
         Returns:
         -----------
         self: DF or DF/F or DF/sqrt(F) movies
@@ -497,31 +579,45 @@ class movie(ts.timeseries):
         numFrames, linePerFrame, pixPerLine = np.shape(self)
         downsampfact = int(secsWindow * self.fr)
         print(downsampfact)
-        elm_missing = int(np.ceil(numFrames * 1.0 / downsampfact)
-                          * downsampfact - numFrames)
-        padbefore = int(np.floor(old_div(elm_missing, 2.0)))
-        padafter = int(np.ceil(old_div(elm_missing, 2.0)))
-
-        print(('Inizial Size Image:' + np.str(np.shape(self))))
-        sys.stdout.flush()
-        mov_out = movie(np.pad(self.astype(np.float32), ((
-            padbefore, padafter), (0, 0), (0, 0)), mode='reflect'), **self.__dict__)
-        #mov_out[:padbefore] = mov_out[padbefore+1]
-        #mov_out[-padafter:] = mov_out[-padafter-1]
-        numFramesNew, linePerFrame, pixPerLine = np.shape(mov_out)
-
-        #% compute baseline quickly
-        print("binning data ...")
-        sys.stdout.flush()
-        movBL = np.reshape(mov_out.copy(), (downsampfact, int(
-            old_div(numFramesNew, downsampfact)), linePerFrame, pixPerLine), order=order)
-        movBL = np.percentile(movBL, quantilMin, axis=0)
-        print("interpolating data ...")
-        sys.stdout.flush()
-        print((movBL.shape))
-        movBL = scipy.ndimage.zoom(np.array(movBL, dtype=np.float32), [
-                                   downsampfact, 1, 1], order=1, mode='constant', cval=0.0, prefilter=False)
-#        movBL = movie(movBL).resize(1,1,downsampfact, interpolation = 4)
+        if exact:
+            from ..source_extraction.cnmf.running_percentile import running_percentile
+            padbefore, padafter = 0, 0
+            mov_out = movie(np.array(self, dtype=np.float32), **self.__dict__)
+            Yr = np.reshape(np.asarray(mov_out), (numFrames, -1))
+            movBL = np.empty_like(Yr)
+            block_size = 10000
+            print("computing running quantile ...")
+            sys.stdout.flush()
+            for i in range(0, Yr.shape[1], block_size):
+                movBL[:, i:i + block_size] = running_percentile(
+                    Yr[:, i:i + block_size].T, quantilMin, downsampfact).T
+            movBL = np.reshape(movBL, mov_out.shape)
+        else:
+            elm_missing = int(np.ceil(numFrames * 1.0 / downsampfact)
+                              * downsampfact - numFrames)
+            padbefore = int(np.floor(old_div(elm_missing, 2.0)))
+            padafter = int(np.ceil(old_div(elm_missing, 2.0)))
+
+            print(('Inizial Size Image:' + np.str(np.shape(self))))
+            sys.stdout.flush()
+            mov_out = movie(np.pad(self.astype(np.float32), ((
+                padbefore, padafter), (0, 0), (0, 0)), mode='reflect'), **self.__dict__)
+            #mov_out[:padbefore] = mov_out[padbefore+1]
+            #mov_out[-padafter:] = mov_out[-padafter-1]
+            numFramesNew, linePerFrame, pixPerLine = np.shape(mov_out)
+
+            #% compute baseline quickly
+            print("binning data ...")
+            sys.stdout.flush()
+            movBL = np.reshape(mov_out.copy(), (downsampfact, int(
+                old_div(numFramesNew, downsampfact)), linePerFrame, pixPerLine), order=order)
+            movBL = np.percentile(movBL, quantilMin, axis=0)
+            print("interpolating data ...")
+            sys.stdout.flush()
+            print((movBL.shape))
+            movBL = scipy.ndimage.zoom(np.array(movBL, dtype=np.float32), [
+                                       downsampfact, 1, 1], order=1, mode='constant', cval=0.0, prefilter=False)
+#            movBL = movie(movBL).resize(1,1,downsampfact, interpolation = 4)
 
         #% compute DF/F
         if method == 'delta_f_over_sqrt_f':
@@ -735,56 +735,38 @@ def distance_masks(M_s, cm_s, max_dist, enclosed_thr=None):
 
     for gt_comp, test_comp, cmgt_comp, cmtest_comp in zip(M_s[:-1], M_s[1:], cm_s[:-1], cm_s[1:]):
 
-        # todo : better with a function that calls itself
         print('New Pair **')
-        # not to interfer with M_s
-        gt_comp = gt_comp.copy()[:, :]
-        test_comp = test_comp.copy()[:, :]
+        gt_comp = scipy.sparse.csc_matrix(gt_comp, dtype=float)
+        test_comp = scipy.sparse.csc_matrix(test_comp, dtype=float)
 
         # the number of components for each
         nb_gt = np.shape(gt_comp)[-1]
         nb_test = np.shape(test_comp)[-1]
         D = np.ones((nb_gt, nb_test))
 
-        cmgt_comp = np.array(cmgt_comp)
-        cmtest_comp = np.array(cmtest_comp)
+        cmgt_comp = np.array(cmgt_comp).reshape((nb_gt, -1))
+        cmtest_comp = np.array(cmtest_comp).reshape((nb_test, -1))
+        # only pairs of components sharing pixels can have a distance below one, so the sparse
+        # product of the masks lists the candidate pairs (neighbours) without comparing all of them
+        intersection = gt_comp.T.dot(test_comp).tocoo()
+        ii, jj = intersection.row, intersection.col
+        intersection = intersection.data
+        dist = np.linalg.norm(cmgt_comp[ii] - cmtest_comp[jj], axis=1)
+        keep = dist < max_dist
+        ii, jj, intersection = ii[keep], jj[keep], intersection[keep]
+        # union contains twice the overlaping area
+        union = np.ravel(gt_comp.sum(0))[ii] + np.ravel(test_comp.sum(0))[jj]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist = np.where(union > 0, 1 - 1. * intersection / (union - intersection), 1.)
         if enclosed_thr is not None:
-            gt_val = gt_comp.T.dot(gt_comp).diagonal()
-        for i in range(nb_gt):
-            # for each components of gt
-            k = gt_comp[:, np.repeat(i, nb_test)] + test_comp
-            # k is correlation matrix of this neuron to every other of the test
-            for j in range(nb_test):  # for each components on the tests
-                dist = np.linalg.norm(cmgt_comp[i] - cmtest_comp[j])
-                # we compute the distance of this one to the other ones
-                if dist < max_dist:
-                    # union matrix of the i-th neuron to the jth one
-                    union = k[:, j].sum()
-                    # we could have used OR for union and AND for intersection while converting
-                    # the matrice into real boolean before
-
-                    # product of the two elements' matrices
-                    # we multiply the boolean values from the jth omponent to the ith
-                    intersection = np.array(gt_comp[:, i].T.dot(
-                        test_comp[:, j]).todense()).squeeze()
-
-                    # if we don't have even a union this is pointless
-                    if union > 0:
-
-                        # intersection is removed from union since union contains twice the overlaping area
-                        # having the values in this format 0-1 is helpfull for the hungarian algorithm that follows
-                        D[i, j] = 1 - 1. * intersection / \
-                            (union - intersection)
-                        if enclosed_thr is not None:
-                            if intersection == gt_val[j] or intersection == gt_val[i]:
-                                D[i, j] = min(D[i, j], 0.5)
-                    else:
-                        D[i, j] = 1.
-
-                    if np.isnan(D[i, j]):
-                        raise Exception('Nan value produced. Error in inputs')
-                else:
-                    D[i, j] = 1
+            # ground truth (or inferred) component is a subset of the other one
+            gt_val = np.ravel(gt_comp.multiply(gt_comp).sum(0))
+            test_val = np.ravel(test_comp.multiply(test_comp).sum(0))
+            enclosed = (union > 0) & ((intersection == test_val[jj]) | (intersection == gt_val[ii]))
+            dist[enclosed] = np.minimum(dist[enclosed], 0.5)
+        if np.any(np.isnan(dist)):
+            raise Exception('Nan value produced. Error in inputs')
+        D[ii, jj] = dist
 
         D_s.append(D)
     return D_s
@@ -1278,16 +1260,21 @@ def extractROIsFromPCAICA(spcomps, numSTD=4, gaussiansigmax=2, gaussiansigmay=2,
 def detect_duplicates_and_subsets(binary_masks, predictions=None, r_values=None, dist_thr=0.1, min_dist=10,
                                   thresh_subset=0.8):
 
-    cm = [scipy.ndimage.center_of_mass(mm) for mm in binary_masks]
-    sp_rois = scipy.sparse.csc_matrix(
-        np.reshape(binary_masks, (binary_masks.shape[0], -1)).T)
+    flat_masks = np.reshape(binary_masks, (binary_masks.shape[0], -1))
+    comp, pix = np.nonzero(flat_masks)
+    sp_rois = scipy.sparse.csc_matrix((flat_masks[comp, pix], (pix, comp)), shape=flat_masks.shape[::-1])
+    sz = np.array(sp_rois.sum(0))
+    # centers of mass of all the masks at once
+    coords = np.indices(binary_masks.shape[1:]).reshape((binary_masks.ndim - 1, -1))
+    cm = sp_rois.T.dot(coords.T) / sz.T
     D = distance_masks([sp_rois, sp_rois], [cm, cm], min_dist)[0]
     np.fill_diagonal(D, 1)
-    overlap = sp_rois.T.dot(sp_rois).toarray()
-    sz = np.array(sp_rois.sum(0))
+    # only pairs of masks sharing pixels can be subsets of each other
+    overlap_sp = scipy.sparse.triu(sp_rois.T.dot(sp_rois), k=1)
+    overlap_sp = (overlap_sp + overlap_sp.T).tocoo()
+    overlap = overlap_sp.toarray()
     print(sz.shape)
     overlap = overlap/sz.T
-    np.fill_diagonal(overlap, 0)
     # pairs of duplicate indeces
 
     indeces_orig = np.where((D < dist_thr) | ((overlap) >= thresh_subset))
@@ -1302,35 +1289,29 @@ def detect_duplicates_and_subsets(binary_masks, predictions=None, r_values=None,
         metric = sz.squeeze()
         print('***** USING MAX AREA BY DEFAULT')
 
-    overlap_tmp = overlap.copy() >= thresh_subset
-    overlap_tmp = overlap_tmp*metric[:, None]
-
-    max_idx = np.argmax(overlap_tmp)
-    one, two = np.unravel_index(max_idx, overlap_tmp.shape)
-    max_val = overlap_tmp[one, two]
+    # greedily remove the worst component of the subset pair with the largest score, scanning the
+    # overlapping pairs once in decreasing order (ties in row-major order) and skipping the pairs
+    # of components already removed
+    rows, cols = overlap_sp.row, overlap_sp.col
+    keep = overlap[rows, cols] >= thresh_subset
+    rows, cols = rows[keep], cols[keep]
+    score = metric[rows]
+    keep = score > 0
+    rows, cols, score = rows[keep], cols[keep], score[keep]
+    order = np.lexsort((cols, rows, -score))
 
     indeces_to_keep = []
     indeces_to_remove = []
-    while max_val > 0:
-        one, two = np.unravel_index(max_idx, overlap_tmp.shape)
+    removed = np.zeros(len(metric), dtype=bool)
+    for one, two in zip(rows[order], cols[order]):
+        if removed[one] or removed[two]:
+            continue
         if metric[one] > metric[two]:
-            #indeces_to_keep.append(one)
-            overlap_tmp[:,two] = 0
-            overlap_tmp[two,:] = 0
+            removed[two] = True
             indeces_to_remove.append(two)
-            #if two in indeces_to_keep:
-            #    indeces_to_keep.remove(two)
         else:
-            overlap_tmp[:,one] = 0
-            overlap_tmp[one,:] = 0
+            removed[one] = True
             indeces_to_remove.append(one)
-            #indeces_to_keep.append(two)
-            #if one in indeces_to_keep:
-            #    indeces_to_keep.remove(one)
-
-        max_idx = np.argmax(overlap_tmp)
-        one, two = np.unravel_index(max_idx, overlap_tmp.shape)
-        max_val = overlap_tmp[one, two]
 
     #indeces_to_remove = np.setdiff1d(np.unique(indeces_orig),indeces_to_keep)
     indeces_to_keep = np.setdiff1d(np.unique(indeces_orig),indeces_to_remove)
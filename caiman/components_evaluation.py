@@ -378,10 +378,8 @@ def evaluate_components(Y, traces, A, C, b, f, final_frate, remove_baseline=True
         num_samps_bl = np.minimum(old_div(np.shape(traces)[-1], 5), 800)
         slow_baseline = False
         if slow_baseline:
-
-            traces = traces - \
-                scipy.ndimage.percentile_filter(
-                    traces, 8, size=[1, num_samps_bl])
+            from caiman.source_extraction.cnmf.running_percentile import running_percentile
+            traces = traces - running_percentile(traces, 8, num_samps_bl)
 
         else:  # fast baseline removal
 
@@ -20,6 +20,7 @@ import sys
 import tifffile
 import ipyparallel as parallel
 from itertools import chain
+from multiprocessing.pool import ThreadPool
 
 import caiman as cm
 
@@ -534,13 +535,32 @@ def parallel_dot_product(A, b, block_size=5000, dview=None, transpose=False, num
         if transpose:
             #            b = pickle.loads(b)
             print('Transposing')
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output = output + rs
+            # read the next block of rows in a thread while accumulating the current one
+            b_ = b.tocsr().astype(np.float32) if 'sparse' in str(type(b)) else b.astype(np.float32)
+            pool = ThreadPool(1)
+            next_rows = pool.apply_async(read_rows, (A, pars[0][1]))
+            for k, pr in enumerate(pars):
+                rows = next_rows.get()
+                if k + 1 < len(pars):
+                    next_rows = pool.apply_async(read_rows, (A, pars[k + 1][1]))
+                output += b_[pr[1][0]:pr[1][-1] + 1].T.dot(rows).T
+            pool.close()
         else:
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output[iddx] = rs
+            if 'sparse' in str(type(b)):
+                for _, pr in enumerate(pars):
+                    iddx, rs = dot_place_holder(pr)
+                    output[iddx] = rs
+            else:
+                # read the next block of rows in a thread while multiplying the current one
+                b_ = b.astype(np.float32)
+                pool = ThreadPool(1)
+                next_rows = pool.apply_async(read_rows, (A, pars[0][1]))
+                for k, pr in enumerate(pars):
+                    rows = next_rows.get()
+                    if k + 1 < len(pars):
+                        next_rows = pool.apply_async(read_rows, (A, pars[k + 1][1]))
+                    output[pr[1]] = rows.dot(b_)
+                pool.close()
 
     else:
         for itera in range(0, len(pars), num_blocks_per_run):
@@ -572,6 +592,12 @@ def parallel_dot_product(A, b, block_size=5000, dview=None, transpose=False, num
     return output
 
 
+#%%
+def read_rows(A, idx_to_pass):
+    """ load in memory the contiguous block of rows idx_to_pass of the memory mapped A"""
+    return np.array(A[idx_to_pass[0]:idx_to_pass[-1] + 1], dtype=np.float32)
+
+
 #%%
 def dot_place_holder(par):
     # todo: todocument
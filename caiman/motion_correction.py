@@ -53,14 +53,17 @@ import cv2
 import gc
 import h5py
 import itertools
+import multiprocessing
 import numpy as np
 from numpy.fft import ifftshift
 import os
 import pylab as pl
+from scipy.ndimage import zoom
 import tifffile
+import warnings
 
 import caiman as cm
-from .mmapping import prepare_shape
+from .mmapping import prepare_shape, load_memmap
 
 try:
     cv2.setNumThreads(0)
@@ -147,6 +150,29 @@ class MotionCorrect(object):
        border_nan : bool or string, optional
            Specifies how to deal with borders. (True, False, 'copy', 'min')
 
+       pyramid_levels: int
+           number of Gaussian pyramid levels used to estimate the rigid shifts
+           coarse-to-fine. Useful for large drifts (max_shifts of tens of pixels). 0 disables it
+
+       compute_metrics: bool
+           compute quality metrics of the correction (mean image, correlation with the template,
+           shifts of each frame, crispness) while the frames are corrected, see reduce_metrics_motion_correction
+
+       is3D: bool
+           the movie is volumetric (T x d1 x d2 x d3, e.g. hdf5 or mmap). max_shifts, strides and
+           overlaps then have three elements, the shifts are applied in the Fourier domain and the
+           corrected movies are saved in C order
+
+       frames_per_bin: int
+           estimate the shifts on averages of frames_per_bin consecutive frames and interpolate
+           them to every frame. Speeds up and denoises the registration of high frame rate, low
+           SNR movies. 1 registers every frame
+
+       template_tol: float
+           if not None, the niter_rig - 1 template refinement passes of the rigid correction
+           update the template after every few chunks and stop as soon as its relative change
+           is below template_tol, so niter_rig is only an upper bound on the extra passes
+
        Returns:
        -------
        self
@@ -158,7 +184,8 @@ class MotionCorrect(object):
     def __init__(self, fname, min_mov, dview=None, max_shifts=(6, 6), niter_rig=1, splits_rig=14, num_splits_to_process_rig=None,
                  strides=(96, 96), overlaps=(32, 32), splits_els=14, num_splits_to_process_els=[7, None],
                  upsample_factor_grid=4, max_deviation_rigid=3, shifts_opencv=True, nonneg_movie=False, gSig_filt=None,
-                 use_cuda=False, border_nan=True):
+                 use_cuda=False, border_nan=True, pyramid_levels=0, compute_metrics=False, is3D=False,
+                 frames_per_bin=1, template_tol=None):
         """
         Constructor class for motion correction operations
 
@@ -189,10 +216,19 @@ class MotionCorrect(object):
         self.gSig_filt = gSig_filt
         self.use_cuda = use_cuda
         self.border_nan = border_nan
+        self.pyramid_levels = pyramid_levels
+        self.compute_metrics = compute_metrics
+        self.is3D = is3D
+        self.frames_per_bin = frames_per_bin
+        self.template_tol = template_tol
+        if self.is3D and self.compute_metrics:
+            raise ValueError('Quality metrics are not supported for volumetric movies')
+        if self.is3D and self.frames_per_bin > 1:
+            raise ValueError('Binned registration is not supported for volumetric movies')
         if self.use_cuda and not HAS_CUDA:
             print("pycuda is unavailable. Falling back to default FFT.")
 
-    def motion_correct_rigid(self, template=None, save_movie=False):
+    def motion_correct_rigid(self, template=None, save_movie=False, order='F'):
         """
         Perform rigid motion correction
 
@@ -204,6 +240,10 @@ class MotionCorrect(object):
         save_movie_rigid:Bool
             save the movies vs just get the template
 
+        order: 'F' or 'C'
+            order of the saved movie. A movie saved in 'C' order can be passed
+            directly to CNMF without converting it with save_memmap
+
         Returns:
         --------
         self
@@ -217,6 +257,8 @@ class MotionCorrect(object):
         self.templates_rig: list of templates. one for each chunk
 
         self.shifts_rig: shifts in x and y per frame
+
+        self.metrics_rig: quality metrics, one dict per file (if compute_metrics)
         """
         print('Rigid Motion Correction')
         print(-self.min_mov)
@@ -224,9 +266,10 @@ class MotionCorrect(object):
         self.templates_rig = []
         self.fname_tot_rig = []
         self.shifts_rig = []
+        self.metrics_rig = []
 
         for fname_cur in self.fname:
-            _fname_tot_rig, _total_template_rig, _templates_rig, _shifts_rig = motion_correct_batch_rigid(
+            res = motion_correct_batch_rigid(
                 fname_cur,
                 self.max_shifts,
                 dview=self.dview,
@@ -240,7 +283,16 @@ class MotionCorrect(object):
                 nonneg_movie=self.nonneg_movie,
                 gSig_filt=self.gSig_filt,
                 use_cuda=self.use_cuda,
-                border_nan=self.border_nan)
+                border_nan=self.border_nan,
+                pyramid_levels=self.pyramid_levels,
+                compute_metrics=self.compute_metrics,
+                is3D=self.is3D,
+                order=order,
+                frames_per_bin=self.frames_per_bin,
+                template_tol=self.template_tol)
+            _fname_tot_rig, _total_template_rig, _templates_rig, _shifts_rig = res[:4]
+            if self.compute_metrics:
+                self.metrics_rig.append(res[4])
             if template is None:
                 self.total_template_rig = _total_template_rig
 
@@ -254,7 +306,8 @@ class MotionCorrect(object):
             self,
             save_movie=True,
             template=None,
-            show_template=False):
+            show_template=False,
+            order='F'):
         """Perform pw-rigid motion correction
 
         Parameters:
@@ -268,6 +321,9 @@ class MotionCorrect(object):
         show_template: boolean
             whether to show the updated template at each iteration
 
+        order: 'F' or 'C'
+            order of the saved movie (see motion_correct_rigid)
+
         Returns:
         --------
 
@@ -278,9 +334,11 @@ class MotionCorrect(object):
             self.templates_els: template updated by iterating  over the chunks
             self.x_shifts_els: shifts in x per frame per patch
             self.y_shifts_els: shifts in y per frame per patch
+            self.z_shifts_els: shifts in z per frame per patch (if is3D)
             self.coord_shifts_els: coordinates associated to the patch for
             values in x_shifts_els and y_shifts_els
             self.total_template_els: list of templates. one for each chunk
+            self.metrics_els: quality metrics, one dict per file (if compute_metrics)
 
         Raise:
         -----
@@ -299,17 +357,26 @@ class MotionCorrect(object):
         self.templates_els = []
         self.x_shifts_els = []
         self.y_shifts_els = []
+        self.z_shifts_els = []
         self.coord_shifts_els = []
+        self.metrics_els = []
         for name_cur in self.fname:
             for num_splits_to_process in self.num_splits_to_process_els:
-                _fname_tot_els, new_template_els, _templates_els,\
-                    _x_shifts_els, _y_shifts_els, _coord_shifts_els = motion_correct_batch_pwrigid(
+                res = motion_correct_batch_pwrigid(
                         name_cur, self.max_shifts, self.strides, self.overlaps, -self.min_mov,
                         dview=self.dview, upsample_factor_grid=self.upsample_factor_grid,
                         max_deviation_rigid=self.max_deviation_rigid, splits=self.splits_els,
                         num_splits_to_process=num_splits_to_process, num_iter=num_iter, template=self.total_template_els,
                         shifts_opencv=self.shifts_opencv, save_movie=save_movie, nonneg_movie=self.nonneg_movie, gSig_filt=self.gSig_filt,
-                        use_cuda=self.use_cuda, border_nan=self.border_nan)
+                        use_cuda=self.use_cuda, border_nan=self.border_nan, pyramid_levels=self.pyramid_levels,
+                        compute_metrics=self.compute_metrics, is3D=self.is3D, order=order,
+                        frames_per_bin=self.frames_per_bin)
+                if self.is3D:
+                    _fname_tot_els, new_template_els, _templates_els,\
+                        _x_shifts_els, _y_shifts_els, _z_shifts_els, _coord_shifts_els = res
+                else:
+                    _fname_tot_els, new_template_els, _templates_els,\
+                        _x_shifts_els, _y_shifts_els, _coord_shifts_els = res[:6]
                 if show_template:
                     pl.imshow(new_template_els)
                     pl.pause(.5)
@@ -324,10 +391,15 @@ class MotionCorrect(object):
             self.templates_els += _templates_els
             self.x_shifts_els += _x_shifts_els
             self.y_shifts_els += _y_shifts_els
+            if self.is3D:
+                self.z_shifts_els += _z_shifts_els
             self.coord_shifts_els += _coord_shifts_els
+            if self.compute_metrics:
+                self.metrics_els.append(res[6])
         return self
 
-    def apply_shifts_movie(self, fname, rigid_shifts=True, border_nan=True):
+    def apply_shifts_movie(self, fname, rigid_shifts=True, border_nan=True, save_memmap=False,
+                           base_name=None, order='C'):
         """
         Applies shifts found by registering one file to a different file. Useful
         for cases when shifts computed from a structural channel are applied to a
@@ -342,11 +414,36 @@ class MotionCorrect(object):
         rigid_shifts: bool
             apply rigid or pw-rigid shifts (must exist in the mc object)
 
+        save_memmap: bool
+            stream the movie in chunks through self.dview and save the result in a
+            memory mapped file instead of loading it in memory (see apply_shifts_movie_parallel)
+
+        base_name: str
+            prefix of the memory mapped file (if save_memmap)
+
+        order: 'C' or 'F'
+            order of the memory mapped file (if save_memmap). 'C' can be passed directly to CNMF
+
         Returns:
         ----------
         m_reg: caiman movie object
             caiman movie object with applied shifts (not memory mapped)
+
+        or, if save_memmap:
+
+        fname_tot: str
+            name of the memory mapped file
         """
+        if save_memmap:
+            if rigid_shifts is True:
+                return apply_shifts_movie_parallel(fname, shifts_rig=self.shifts_rig, dview=self.dview,
+                                                   splits=self.splits_rig, shifts_opencv=self.shifts_opencv,
+                                                   border_nan=border_nan, base_name=base_name, order=order)
+            else:
+                return apply_shifts_movie_parallel(fname, x_shifts=self.x_shifts_els, y_shifts=self.y_shifts_els,
+                                                   coord_shifts=self.coord_shifts_els, dview=self.dview,
+                                                   splits=self.splits_els, border_nan=border_nan,
+                                                   base_name=base_name, order=order)
 
         Y = cm.load(fname).astype(np.float32)
 
@@ -366,10 +463,10 @@ class MotionCorrect(object):
             shifts_y = np.stack([np.reshape(_sh_, dims_grid, order='C').astype(
                 np.float32) for _sh_ in self.y_shifts_els], axis=0)
             dims = Y.shape[1:]
-            x_grid, y_grid = np.meshgrid(np.arange(0., dims[0]).astype(
-                np.float32), np.arange(0., dims[1]).astype(np.float32))
+            x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(
+                np.float32), np.arange(0., dims[0]).astype(np.float32))
             m_reg = [cv2.remap(img,
-                               -cv2.resize(shiftY, dims) + x_grid, -cv2.resize(shiftX, dims) + y_grid, cv2.INTER_CUBIC)
+                               -cv2.resize(shiftY, dims[::-1]) + x_grid, -cv2.resize(shiftX, dims[::-1]) + y_grid, cv2.INTER_CUBIC)
                      for img, shiftX, shiftY in zip(Y, shifts_x, shifts_y)]
 
         return cm.movie(np.stack(m_reg, axis=0))
@@ -455,6 +552,258 @@ def apply_shift_online(movie_iterable, xy_shifts, save_base_name=None, order='F'
     else:
         return np.array(new_mov)
 #%%
+def get_file_size(fname):
+    """ dimensions and number of frames of a movie file, without loading it
+
+    Parameters:
+    -----------
+    fname: str
+        name of the movie (tif, sbx, sima, hdf5, h5 or mmap)
+
+    Returns:
+    --------
+    dims: tuple
+        dimensions of the frames
+
+    T: int
+        number of frames
+    """
+    name, extension = os.path.splitext(fname)[:2]
+    if extension == '.tif' or extension == '.tiff':
+        with tifffile.TiffFile(fname) as tf:
+            T = len(tf.pages)
+            if T == 1:  # Fiji-generated TIF
+                T, d1, d2 = tf[0].shape
+            else:
+                d1, d2 = tf.pages[0].shape
+    elif extension == '.sbx':
+        shape = cm.base.movies.sbxshape(name)
+        d1, d2, T = shape[1], shape[0], shape[2]
+    elif extension == '.sima':
+        import sima
+        dataset = sima.ImagingDataset.load(fname)
+        shape = dataset.sequences[0].shape
+        d1, d2, T = shape[2], shape[3], shape[0]
+        del dataset
+    elif extension == '.hdf5':
+        with h5py.File(fname) as fl:
+            T, dims = fl['mov'].shape[0], fl['mov'].shape[1:]
+        return tuple(dims), T
+    elif extension == '.h5':
+        with h5py.File(fname) as fl:
+            if 'imaging' in fl.keys():
+                T, _, d1, d2, _ = fl['imaging'].shape
+            else:
+                raise Exception('Unsupported file key for h5 files')
+    elif extension == '.mmap':
+        Yr, dims, T = cm.load_memmap(fname)
+        del Yr
+        return dims, T
+    else:
+        raise Exception('Unsupported file extension ' + extension)
+
+    return (d1, d2), T
+
+
+#%%
+def load_frames(fname, idxs):
+    """ load a subset of frames of a movie file (see tile_and_correct_wrapper)
+
+    Parameters:
+    -----------
+    fname: str
+        name of the movie
+
+    idxs: array of int
+        indices of the frames to load
+
+    Returns:
+    --------
+    imgs: caiman movie
+    """
+    extension = os.path.splitext(fname)[1]
+    if extension == '.sbx':
+        return cm.base.movies.sbxread(fname, idxs[0], len(idxs))
+    elif extension == '.sima' or extension == '.hdf5' or extension == '.h5':
+        return cm.load(fname, subindices=list(idxs))
+    else:
+        return cm.load(fname, subindices=idxs)
+
+
+#%%
+def apply_shifts_frames(imgs, shifts_rig=None, x_shifts=None, y_shifts=None, dims_grid=None,
+                        shifts_opencv=True, border_nan=True):
+    """ apply rigid or pw-rigid shifts to a batch of frames
+
+    Parameters:
+    -----------
+    imgs: ndarray
+        frames to shift (T x d1 x d2, or T x d1 x d2 x d3 for rigid shifts in the Fourier domain)
+
+    shifts_rig: ndarray
+        rigid shifts, one per frame
+
+    x_shifts, y_shifts: ndarray
+        pw-rigid shifts per frame and patch
+
+    dims_grid: tuple
+        dimensions of the grid of patches
+
+    shifts_opencv: bool
+        apply rigid shifts with opencv (faster, with some smoothing) or with the FFT
+
+    border_nan: bool or string
+        specifies how to deal with borders. (True, False, 'copy', 'min')
+
+    Returns:
+    --------
+    new_imgs: ndarray
+        shifted frames
+    """
+    if shifts_rig is not None:
+        if shifts_opencv:
+            new_imgs = np.array([apply_shift_iteration(img, sh, border_nan=border_nan)
+                                 for img, sh in zip(imgs, shifts_rig)])
+        else:
+            new_imgs = apply_shifts_dft_batch(np.fft.fftn(imgs, axes=tuple(range(1, imgs.ndim))),
+                                              shifts_rig, np.zeros(len(imgs)), border_nan=border_nan)
+    else:
+        d1, d2 = imgs.shape[1:]
+        x_grid, y_grid = np.meshgrid(np.arange(d2, dtype=np.float32), np.arange(d1, dtype=np.float32))
+        new_imgs = np.array([cv2.remap(img, -cv2.resize(np.reshape(shY, dims_grid).astype(np.float32), (d2, d1)) + x_grid,
+                                       -cv2.resize(np.reshape(shX, dims_grid).astype(np.float32), (d2, d1)) + y_grid,
+                                       cv2.INTER_CUBIC)
+                             for img, shX, shY in zip(imgs, x_shifts, y_shifts)])
+
+    return new_imgs
+
+
+#%%
+def apply_shifts_wrapper(params):
+    """ apply stored shifts to a chunk of frames and write them to the output memory mapped file
+
+    Returns:
+    --------
+    idxs: indices of the frames processed
+    """
+    try:
+        cv2.setNumThreads(0)
+    except:
+        pass
+
+    fname, out_fname, idxs, shape_mov, order, shifts_rig, x_shifts, y_shifts, dims_grid, \
+        shifts_opencv, border_nan, add_to_movie = params
+
+    imgs = np.array(load_frames(fname, idxs), dtype=np.float32)
+    new_imgs = apply_shifts_frames(imgs, shifts_rig=shifts_rig, x_shifts=x_shifts, y_shifts=y_shifts,
+                                   dims_grid=dims_grid, shifts_opencv=shifts_opencv, border_nan=border_nan)
+
+    outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
+                     shape=prepare_shape(shape_mov), order=order)
+    write_frames_memmap(outv, new_imgs.astype(np.float32), idxs, bias=np.float32(add_to_movie))
+    outv.flush()
+    del outv
+    return idxs
+
+
+#%%
+def apply_shifts_movie_parallel(fname, shifts_rig=None, x_shifts=None, y_shifts=None, coord_shifts=None,
+                                dview=None, splits=14, shifts_opencv=True, border_nan=True, add_to_movie=0,
+                                base_name=None, order='C'):
+    """ apply stored rigid or pw-rigid shifts to a movie file, chunk by chunk and in parallel
+
+    The movie is never held in memory as a whole: each worker loads a chunk of
+    frames, applies the shifts and writes it into a memory mapped file that
+    (with order='C') can be passed directly to CNMF. Useful to apply shifts
+    computed on a structural channel to a functional channel.
+
+    Parameters:
+    -----------
+    fname: str
+        movie to correct (any format supported by the parallel motion correction, or mmap)
+
+    shifts_rig: list or ndarray
+        rigid shifts, one pair per frame (e.g. MotionCorrect.shifts_rig)
+
+    x_shifts, y_shifts: lists
+        pw-rigid shifts per frame and patch (e.g. MotionCorrect.x_shifts_els, y_shifts_els)
+
+    coord_shifts: list
+        coordinates of the patches in the grid (e.g. MotionCorrect.coord_shifts_els)
+
+    dview: ipyparallel view or multiprocessing pool
+        used to perform parallel computing
+
+    splits: int
+        number of chunks in which the movie is subdivided
+
+    shifts_opencv: bool
+        apply rigid shifts with opencv (faster, with some smoothing) or with the FFT
+
+    border_nan: bool or string
+        specifies how to deal with borders. (True, False, 'copy', 'min')
+
+    add_to_movie: float
+        value added to the saved movie
+
+    base_name: str
+        prefix of the saved file (defaults to the name of the movie)
+
+    order: 'C' or 'F'
+        order of the saved file
+
+    Returns:
+    --------
+    fname_tot: str
+        name of the memory mapped file
+    """
+    dims, T = get_file_size(fname)
+    if shifts_rig is None and x_shifts is None:
+        raise Exception('Either rigid or pw-rigid shifts must be provided')
+    if len(shifts_rig if shifts_rig is not None else x_shifts) != T:
+        raise Exception('Number of shifts does not match movie length!')
+
+    if shifts_rig is not None:
+        shifts_rig = np.array(shifts_rig, dtype=np.float32)
+        dims_grid = None
+    else:
+        dims_grid = tuple(np.max(np.stack(coord_shifts[0], axis=1), axis=1) - np.min(
+            np.stack(coord_shifts[0], axis=1), axis=1) + 1)
+        x_shifts = np.array(x_shifts, dtype=np.float32)
+        y_shifts = np.array(y_shifts, dtype=np.float32)
+
+    if base_name is None:
+        base_name = os.path.splitext(os.path.split(fname)[-1])[0] + '_shifted_'
+    fname_tot = base_name + '_d1_' + str(dims[0]) + '_d2_' + str(dims[1]) + '_d3_' + str(
+        1 if len(dims) == 2 else dims[2]) + '_order_' + str(order) + '_frames_' + str(T) + '_.mmap'
+    fname_tot = os.path.join(os.path.split(fname)[0], fname_tot)
+    shape_mov = (np.prod(dims), T)
+    np.memmap(fname_tot, mode='w+', dtype=np.float32,
+              shape=prepare_shape(shape_mov), order=order)
+
+    pars = []
+    for idx in np.array_split(np.arange(T), splits):
+        if len(idx) == 0:
+            continue
+        if shifts_rig is not None:
+            sh_rig, sh_x, sh_y = shifts_rig[idx], None, None
+        else:
+            sh_rig, sh_x, sh_y = None, x_shifts[idx], y_shifts[idx]
+        pars.append([fname, fname_tot, idx, shape_mov, order, sh_rig, sh_x, sh_y, dims_grid,
+                     shifts_opencv, border_nan, add_to_movie])
+
+    if dview is not None:
+        if 'multiprocessing' in str(type(dview)):
+            dview.map_async(apply_shifts_wrapper, pars).get(4294967)
+        else:
+            dview.map_sync(apply_shifts_wrapper, pars)
+    else:
+        list(map(apply_shifts_wrapper, pars))
+
+    return fname_tot
+
+
+#%%
 
 def motion_correct_oneP_rigid(
         filename,
@@ -863,13 +1212,13 @@ def motion_correct_iteration_fast(img, template, max_shift_w=10, max_shift_h=10)
 
 
 def bin_median(mat, window=10, exclude_nans=True):
-    """ compute median of 3D array in along axis o by binning values
+    """ compute median of 3D (or 4D) array in along axis o by binning values
 
     Parameters:
     ----------
 
     mat: ndarray
-        input 3D matrix, time along first dimension
+        input 3D (or 4D) matrix, time along first dimension
 
     window: int
         number of frames in a bin
@@ -886,20 +1235,80 @@ def bin_median(mat, window=10, exclude_nans=True):
     Exception('Path to template does not exist:'+template)
     """
 
-    T, d1, d2 = np.shape(mat)
+    T, dims = np.shape(mat)[0], tuple(np.shape(mat)[1:])
     if T < window:
         window = T
     num_windows = np.int(old_div(T, window))
     num_frames = num_windows * window
     if exclude_nans:
         img = np.nanmedian(np.nanmean(np.reshape(
-            mat[:num_frames], (window, num_windows, d1, d2)), axis=0), axis=0)
+            mat[:num_frames], (window, num_windows) + dims), axis=0), axis=0)
     else:
         img = np.median(np.mean(np.reshape(
-            mat[:num_frames], (window, num_windows, d1, d2)), axis=0), axis=0)
+            mat[:num_frames], (window, num_windows) + dims), axis=0), axis=0)
 
     return img
 
+
+#%%
+def bin_mean(mat, window=10):
+    """ average consecutive frames in bins of window frames
+
+    Parameters:
+    ----------
+    mat: ndarray
+        input 3D (or 4D) matrix, time along first dimension
+
+    window: int
+        number of frames in a bin (the last bin may be shorter)
+
+    Returns:
+    -------
+    binned: ndarray
+        averaged frames, one per bin
+
+    centers: ndarray
+        position of the center of each bin in frames
+    """
+    T = len(mat)
+    num_full = T // window
+    binned = np.nanmean(np.reshape(np.asarray(mat[:num_full * window]),
+                                   (num_full, window) + tuple(np.shape(mat)[1:])), axis=1)
+    centers = np.arange(num_full) * window + (window - 1) / 2.
+    if T > num_full * window:
+        binned = np.concatenate([binned, np.nanmean(mat[num_full * window:], axis=0)[None]])
+        centers = np.append(centers, (num_full * window + T - 1) / 2.)
+
+    return binned, centers
+
+
+#%%
+def interpolate_shifts(shifts, centers, num_frames):
+    """ linearly interpolate shifts estimated on binned frames back to every frame
+
+    Parameters:
+    ----------
+    shifts: ndarray
+        shifts of each bin (num_bins x ...)
+
+    centers: ndarray
+        position of the center of each bin in frames (see bin_mean)
+
+    num_frames: int
+        number of frames
+
+    Returns:
+    -------
+    shifts_frames: ndarray
+        shifts of each frame (num_frames x ...), constant before the first
+        and after the last bin center
+    """
+    shifts = np.asarray(shifts, dtype=np.float64)
+    flat_shifts = shifts.reshape((len(shifts), -1))
+    frames = np.arange(num_frames)
+    shifts_frames = np.array([np.interp(frames, centers, sh) for sh in flat_shifts.T]).T
+    return shifts_frames.reshape((num_frames,) + shifts.shape[1:])
+
 def process_movie_parallel(arg_in):
     #todo: todocument
     fname, fr, margins_out, template, max_shift_w, max_shift_h, remove_blanks, apply_smooth, save_hdf5 = arg_in
@@ -1143,6 +1552,67 @@ def _upsampled_dft(data, upsampled_region_size,
     return output
 
 
+# kernels of _upsampled_dft_batch, by (axis length, region size, upsample factor)
+_upsampled_dft_kernels = {}
+
+
+def _upsampled_dft_kernel(n, upsampled_region_size, upsample_factor):
+    """ cached DFT kernel of _upsampled_dft_batch along one axis of length n
+
+    Returns the (upsampled_region_size x n) kernel without offset, and the
+    per frequency factors that turn an offset into a phase ramp
+    """
+    key = (n, upsampled_region_size, float(upsample_factor))
+    if key not in _upsampled_dft_kernels:
+        freqs = ifftshift(np.arange(n)) - np.floor(old_div(n, 2))
+        kernel = np.exp((-1j * 2 * np.pi / (n * upsample_factor)) *
+                        np.arange(upsampled_region_size)[:, None] * freqs[None, :])
+        _upsampled_dft_kernels[key] = (kernel, (1j * 2 * np.pi / (n * upsample_factor)) * freqs)
+    return _upsampled_dft_kernels[key]
+
+
+def _upsampled_dft_batch(data, upsampled_region_size, upsample_factor=1, axis_offsets=None):
+    """
+    batched version of _upsampled_dft for a stack of 2D or 3D arrays
+
+    The kernel of _upsampled_dft along each axis factors into a kernel that only
+    depends on the axis length, the region size and the upsample factor, which
+    is cached, and a phase ramp that depends on the offset of each array. The
+    ramps are applied to the data, and the whole stack is then transformed
+    with one batched matrix multiply per axis.
+
+    Parameters:
+    ----------
+    data : ndarray
+        stack of DFTs to upsample (N x d1 x d2 [x d3])
+
+    upsampled_region_size : integer
+        size of the region to be sampled along each dimension
+
+    upsample_factor : integer, optional
+        The upsampling factor.  Defaults to 1.
+
+    axis_offsets : ndarray, optional
+        N x ndim offsets of the region to be sampled for each array. Defaults to None (zero offsets)
+
+    Returns:
+    -------
+    output : ndarray
+        N x upsampled_region_size x ... upsampled DFTs of the specified regions
+    """
+    upsampled_region_size = int(upsampled_region_size)
+    output = data
+    for ax in range(data.ndim - 1):
+        n = data.shape[ax + 1]
+        kernel, freq_phase = _upsampled_dft_kernel(n, upsampled_region_size, upsample_factor)
+        if axis_offsets is not None:
+            ramp = np.exp(np.asarray(axis_offsets, dtype=np.float64)[:, ax, None] * freq_phase)
+            output = output * ramp.reshape((len(data),) + (1,) * ax + (n,) + (1,) * (data.ndim - ax - 2))
+        output = np.moveaxis(np.matmul(kernel, np.moveaxis(output, ax + 1, -2)), -2, ax + 1)
+
+    return output
+
+
 def _compute_phasediff(cross_correlation_max):
     """
     Compute global phase difference between the two images (should be zero if images are non-negative).
@@ -1541,10 +2011,10 @@ def register_translation(src_image, target_image, upsample_factor=1,
         # Matrix multiply DFT around the current shift estimate
         sample_region_offset = dftshift - shifts * upsample_factor
 
-        cross_correlation = _upsampled_dft(image_product.conj(),
-                                           upsampled_region_size,
-                                           upsample_factor,
-                                           sample_region_offset).conj()
+        cross_correlation = _upsampled_dft_batch(image_product.conj()[None],
+                                                 upsampled_region_size,
+                                                 upsample_factor,
+                                                 sample_region_offset[None])[0].conj()
         cross_correlation /= normalization
         # Locate maximum and map back to original pixel grid
         maxima = np.array(np.unravel_index(
@@ -2039,74 +2509,779 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
             except:
                 pass
         return new_img - add_to_movie, total_shifts, start_step, xy_grid
-#%%
 
-def compute_flow_single_frame(frame, templ, pyr_scale=.5, levels=3, winsize=100, iterations=15, poly_n=5,
-                              poly_sigma=1.2 / 5, flags=0):
-    flow = cv2.calcOpticalFlowFarneback(
-        templ, frame, None, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags)
-    return flow
+
 #%%
+def sliding_window_starts(shape, overlaps, strides):
+    """ starting coordinates of the patches laid out by sliding_window
 
+    Parameters:
+    -----------
+    shape: tuple
+        shape of the image (or volume)
 
-def compute_metrics_motion_correction(fname, final_size_x, final_size_y, swap_dim, pyr_scale=.5, levels=3,
-                                      winsize=100, iterations=15, poly_n=5, poly_sigma=1.2 / 5, flags=0,
-                                      play_flow=False, resize_fact_flow=.2, template=None):
-    #todo: todocument
-    # cv2.OPTFLOW_FARNEBACK_GAUSSIAN
-    import scipy
-    vmin, vmax = -1, 1
-    m = cm.load(fname)
+    overlaps, strides: tuples
+        overlaps and strides of the patches
 
-    max_shft_x = np.int(np.ceil((np.shape(m)[1] - final_size_x) / 2))
-    max_shft_y = np.int(np.ceil((np.shape(m)[2] - final_size_y) / 2))
-    max_shft_x_1 = - ((np.shape(m)[1] - max_shft_x) - (final_size_x))
-    max_shft_y_1 = - ((np.shape(m)[2] - max_shft_y) - (final_size_y))
-    if max_shft_x_1 == 0:
-        max_shft_x_1 = None
+    Returns:
+    --------
+    ranges: tuple of lists
+        top-left coordinates of the patches along each dimension
+    """
+    windowSize = np.add(overlaps, strides)
+    return tuple(list(range(0, sh - ws, st)) + [sh - ws]
+                 for sh, ws, st in zip(shape, windowSize, strides))
 
-    if max_shft_y_1 == 0:
-        max_shft_y_1 = None
-    print([max_shft_x, max_shft_x_1, max_shft_y, max_shft_y_1])
-    m = m[:, max_shft_x:max_shft_x_1, max_shft_y:max_shft_y_1]
-    if np.sum(np.isnan(m)) > 0:
-        print(m.shape)
-        raise Exception('Movie contains NaN')
 
-    print('Local correlations..')
-    img_corr = m.local_correlations(eight_neighbours=True, swap_dim=swap_dim)
-    print(m.shape)
-    if template is None:
-        tmpl = cm.motion_correction.bin_median(m)
-    else:
-        tmpl = template
+#%%
+def extract_tiles(imgs, ranges, windowSize):
+    """ extract the patches of a batch of frames through a strided view
 
-    print('Compute Smoothness.. ')
-    smoothness = np.sqrt(
-        np.sum(np.sum(np.array(np.gradient(np.mean(m, 0)))**2, 0)))
-    smoothness_corr = np.sqrt(
-        np.sum(np.sum(np.array(np.gradient(img_corr))**2, 0)))
+    Parameters:
+    -----------
+    imgs: ndarray
+        batch of frames (T x d1 x d2 [x d3])
 
-    print('Compute correlations.. ')
-    correlations = []
-    count = 0
-    for fr in m:
-        if count % 100 == 0:
-            print(count)
+    ranges: tuple of lists
+        top-left coordinates of the patches along each dimension (see sliding_window_starts)
 
-        count += 1
-        correlations.append(scipy.stats.pearsonr(
-            fr.flatten(), tmpl.flatten())[0])
+    windowSize: tuple
+        size of each patch
 
-    print('Compute optical flow .. ')
+    Returns:
+    --------
+    tiles: ndarray
+        T x len(ranges[0]) x len(ranges[1]) [x len(ranges[2])] x windowSize array of patches
+    """
+    imgs = np.ascontiguousarray(imgs)
+    view = np.lib.stride_tricks.as_strided(
+        imgs, shape=imgs.shape[:1] + tuple(np.subtract(imgs.shape[1:], windowSize) + 1) + tuple(windowSize),
+        strides=imgs.strides + imgs.strides[1:], writeable=False)
+    for ax, rng in enumerate(ranges):
+        view = view[(slice(None),) * (ax + 1) + (rng,)]
+    return view
 
-    m = m.resize(1, 1, resize_fact_flow)
-    norms = []
-    flows = []
-    count = 0
-    for fr in m:
-        if count % 100 == 0:
-            print(count)
+
+#%%
+def register_translation_batch(src_freq, target_freq, upsample_factor=1, shifts_lb=None, shifts_ub=None,
+                               max_shifts=(10, 10)):
+    """ register a stack of images (or patches) to their targets in the Fourier domain.
+
+    Batched counterpart of register_translation (and register_translation_3d):
+    the cross correlations of the whole stack are computed with a single
+    inverse FFT and the constrained peak search is vectorized. Same conventions
+    as register_translation. The number of spatial dimensions (2 or 3) is
+    given by the length of max_shifts.
+
+    Parameters:
+    -----------
+    src_freq: ndarray
+        FFT of the images to register (... x h x w [x d])
+
+    target_freq: ndarray
+        FFT of the reference images, broadcastable to src_freq
+
+    upsample_factor: int
+        images are registered within 1 / upsample_factor of a pixel
+
+    shifts_lb, shifts_ub: ndarray or None
+        lower and upper bounds of the shifts, broadcastable to (... x ndim)
+
+    max_shifts: tuple
+        max shifts along each dimension, used if no bounds are passed
+
+    Returns:
+    --------
+    shifts: ndarray
+        ... x ndim shifts required to register the images
+
+    phasediff: ndarray
+        global phase difference between each image and its target
+    """
+    ndim = len(max_shifts)
+    shape = src_freq.shape[-ndim:]
+    batch_shape = src_freq.shape[:-ndim]
+    image_product = src_freq * target_freq.conj()
+    cross_correlation = np.fft.ifftn(image_product, axes=tuple(range(-ndim, 0)))
+    new_cross_corr = np.abs(cross_correlation)
+
+    lags = [np.arange(n) - n * (np.arange(n) > np.fix(n / 2.)) for n in shape]
+    if (shifts_lb is not None) or (shifts_ub is not None):
+        shifts_lb = np.asarray(shifts_lb)[..., None]
+        shifts_ub = np.asarray(shifts_ub)[..., None]
+        for ax, n in enumerate(shape):
+            mask = (lags[ax] >= shifts_lb[..., ax, :]) & (lags[ax] < shifts_ub[..., ax, :])
+            new_cross_corr *= mask.reshape(mask.shape[:-1] + (1,) * ax + (n,) + (1,) * (ndim - ax - 1))
+    else:
+        for ax, (n, ms) in enumerate(zip(shape, max_shifts)):
+            if ms > 0:
+                mask = (lags[ax] >= -ms) & (lags[ax] < ms)
+                new_cross_corr *= mask.reshape((1,) * ax + (n,) + (1,) * (ndim - ax - 1))
+
+    maxima = np.unravel_index(np.argmax(new_cross_corr.reshape(batch_shape + (-1,)), axis=-1), shape)
+    shifts = np.stack([lag[idx] for lag, idx in zip(lags, maxima)], axis=-1).astype(np.float64)
+
+    if upsample_factor == 1:
+        cross_correlation = cross_correlation.reshape(batch_shape + (-1,))
+        CCmax = np.take_along_axis(cross_correlation, np.argmax(
+            cross_correlation.real, axis=-1)[..., None], axis=-1)[..., 0]
+    else:
+        # refine each estimate with the matrix multiply DFT
+        shifts = old_div(np.round(shifts * upsample_factor), upsample_factor)
+        upsampled_region_size = np.ceil(upsample_factor * 1.5)
+        dftshift = np.fix(old_div(upsampled_region_size, 2.0))
+        normalization = (np.prod(shape) * upsample_factor ** ndim)
+        sample_region_offset = dftshift - shifts * upsample_factor
+        cross_correlation = _upsampled_dft_batch(
+            image_product.reshape((-1,) + shape).conj(), upsampled_region_size, upsample_factor,
+            sample_region_offset.reshape((-1, ndim))).conj() / normalization
+        cross_correlation = cross_correlation.reshape((len(cross_correlation), -1))
+        maxima_up = np.array(np.unravel_index(np.argmax(np.abs(cross_correlation), axis=-1),
+                                              (int(upsampled_region_size),) * ndim), dtype=np.float64).T
+        shifts += old_div(maxima_up - dftshift, upsample_factor).reshape(shifts.shape)
+        CCmax = cross_correlation.max(axis=-1).reshape(batch_shape)
+
+    for dim, n in enumerate(shape):
+        if n == 1:
+            shifts[..., dim] = 0
+
+    return shifts, _compute_phasediff(CCmax)
+
+
+#%%
+def register_translation_pyramid(imgs, template, levels=2, upsample_factor=1, max_shifts=(10, 10),
+                                 src_freq=None, search_radius=2):
+    """ coarse-to-fine rigid registration of a batch of frames on a Gaussian pyramid
+
+    The shifts are first estimated on the coarsest level (the images are halved
+    in size at each level with cv2.pyrDown) over the whole max_shifts range,
+    and then refined at each finer level only within search_radius pixels of
+    the upscaled estimate. This is more robust than a single full resolution
+    search when max_shifts is large (tens of pixels), since the coarse levels
+    are smoother and have fewer spurious peaks.
+
+    Parameters:
+    -----------
+    imgs: ndarray
+        frames to register (T x d1 x d2)
+
+    template: ndarray
+        reference image
+
+    levels: int
+        number of pyramid levels above the full resolution
+
+    upsample_factor: int
+        resolution of fractional shifts (only used at full resolution)
+
+    max_shifts: tuple
+        max shifts in x and y at full resolution
+
+    src_freq: ndarray
+        FFT of imgs, if already available
+
+    search_radius: int
+        half size of the search window at the finer levels
+
+    Returns:
+    --------
+    shifts: ndarray
+        T x 2 shifts required to register the frames
+
+    phasediff: ndarray
+        global phase differences (see register_translation_batch)
+    """
+    pyr_imgs = [np.asarray(imgs, dtype=np.float64)]
+    pyr_templ = [np.asarray(template, dtype=np.float64)]
+    for _ in range(levels):
+        pyr_imgs.append(np.array([cv2.pyrDown(img) for img in pyr_imgs[-1]]))
+        pyr_templ.append(cv2.pyrDown(pyr_templ[-1]))
+
+    shifts = None
+    for level in range(levels, -1, -1):
+        ms = np.ceil(np.divide(max_shifts[:2], 2. ** level)).astype(int)
+        if level == 0 and src_freq is not None:
+            freq = src_freq
+        else:
+            freq = np.fft.fft2(pyr_imgs[level])
+        if shifts is None:
+            shifts_lb, shifts_ub = None, None
+        else:
+            center = np.round(2 * shifts).astype(int)
+            shifts_lb = np.maximum(center - search_radius, -ms)
+            shifts_ub = np.minimum(center + search_radius + 1, ms)
+        shifts, phasediff = register_translation_batch(
+            freq, np.fft.fft2(pyr_templ[level]), upsample_factor=upsample_factor if level == 0 else 1,
+            shifts_lb=shifts_lb, shifts_ub=shifts_ub, max_shifts=ms)
+
+    return shifts, phasediff
+
+
+#%%
+def fill_border(img, shift, border_nan, min_=None):
+    """ set the border left uncovered after shifting an image or a volume (in place)
+
+    Parameters:
+    -----------
+    img: ndarray 2D or 3D
+        shifted image
+
+    shift: tuple
+        shift that was applied along each dimension
+
+    border_nan: bool or string
+        specifies how to deal with borders. (True, False, 'copy', 'min')
+
+    min_: float
+        value used when border_nan is 'min' (defaults to the minimum of the image)
+
+    Returns:
+    --------
+    img: the image with the border filled
+    """
+    if border_nan is False:
+        return img
+    if border_nan == 'min' and min_ is None:
+        min_ = np.nanmin(img)
+    for ax, sh in enumerate(shift):
+        max_ = int(np.ceil(max(0, sh)))
+        min_sh = int(np.floor(min(0, sh)))
+        before = (slice(None),) * ax
+        if border_nan is True or border_nan == 'min':
+            val = np.nan if border_nan is True else min_
+            img[before + (slice(None, max_),)] = val
+            if min_sh < 0:
+                img[before + (slice(min_sh, None),)] = val
+        elif border_nan == 'copy':
+            if max_ > 0:
+                img[before + (slice(None, max_),)] = img[before + (slice(max_, max_ + 1),)]
+            if min_sh < 0:
+                img[before + (slice(min_sh, None),)] = img[before + (slice(min_sh - 1, min_sh),)]
+
+    return img
+
+
+#%%
+def apply_shifts_dft_batch(src_freq, shifts, diffphase, border_nan=True):
+    """ apply shifts to a stack of images, volumes or patches in the Fourier domain
+
+    Batched counterpart of apply_shifts_dft. The number of spatial dimensions
+    (2 or 3) is given by the last dimension of shifts.
+
+    Parameters:
+    -----------
+    src_freq: ndarray
+        FFT of the images (... x h x w [x d]), as returned by np.fft.fftn
+
+    shifts: ndarray
+        ... x ndim shifts to apply
+
+    diffphase: ndarray
+        global phase differences, as returned by register_translation_batch
+
+    border_nan: bool or string
+        specifies how to deal with borders. (True, False, 'copy', 'min')
+
+    Returns:
+    --------
+    new_imgs: ndarray
+        ... x h x w [x d] shifted images
+    """
+    shifts = np.asarray(shifts, dtype=np.float64)
+    ndim = shifts.shape[-1]
+    shape = src_freq.shape[-ndim:]
+    phase = 0
+    for ax in range(ndim - 1, -1, -1):
+        n = shape[ax]
+        freqs = ifftshift(np.arange(-np.fix(n / 2.), np.ceil(n / 2.)))
+        phase = phase - shifts[(Ellipsis, ax) + (None,) * ndim] * freqs.reshape(
+            (n,) + (1,) * (ndim - ax - 1)) / n
+    Greg = src_freq * np.exp(1j * 2 * np.pi * phase)
+    Greg *= np.exp(1j * np.asarray(diffphase))[(Ellipsis,) + (None,) * ndim]
+    new_imgs = np.real(np.fft.ifftn(Greg, axes=tuple(range(-ndim, 0))))
+
+    if border_nan is not False:
+        # in 2D same border convention as apply_shifts_dft
+        for img, sh in zip(new_imgs.reshape((-1,) + shape), shifts.reshape((-1, ndim))):
+            fill_border(img, sh[::-1] if ndim == 2 else sh, border_nan)
+
+    return new_imgs
+
+
+#%%
+def tile_and_correct_batch(imgs, template, strides, overlaps, max_shifts, newoverlaps=None, newstrides=None,
+                           upsample_factor_grid=4, upsample_factor_fft=10, max_deviation_rigid=2, add_to_movie=0,
+                           shifts_opencv=False, gSig_filt=None, border_nan=True, pyramid_levels=0,
+                           shifts_only=False):
+    """ piecewise rigid motion correction of a batch of frames
+
+    Same algorithm and outputs as calling tile_and_correct on each frame, but
+    patches are extracted from a strided view over the whole batch, all the
+    registrations are performed with batched FFTs, and the shifts are applied
+    and the patches blended across frames at once.
+
+    Parameters:
+    -----------
+    imgs: ndarray
+        frames to correct (T x d1 x d2)
+
+    template, strides, overlaps, max_shifts, newoverlaps, newstrides,
+    upsample_factor_grid, upsample_factor_fft, max_deviation_rigid,
+    add_to_movie, shifts_opencv, gSig_filt, border_nan:
+        see tile_and_correct
+
+    pyramid_levels: int
+        if larger than 0 the rigid shifts are estimated coarse-to-fine on a
+        Gaussian pyramid with this many levels (see register_translation_pyramid)
+
+    shifts_only: bool
+        only estimate the shifts, the frames are not corrected and None is returned in their place
+
+    Returns:
+    --------
+    new_imgs: ndarray
+        corrected frames (T x d1 x d2)
+
+    shift_info: list
+        [total_shifts, start_step, xy_grid] for each frame (see tile_and_correct)
+    """
+    imgs = np.array(imgs, dtype=np.float64)
+    template = template.astype(np.float64)
+    num_frames = len(imgs)
+
+    if gSig_filt is not None:
+        imgs_orig = imgs
+        imgs = np.array([high_pass_filter_space(img, gSig_filt) for img in imgs_orig])
+
+    imgs = imgs + add_to_movie
+    template = template + add_to_movie
+
+    # compute rigid shifts
+    src_freq = np.fft.fft2(imgs)
+    if pyramid_levels > 0:
+        rigid_shts, diffphase = register_translation_pyramid(
+            imgs, template, levels=pyramid_levels, upsample_factor=upsample_factor_fft,
+            max_shifts=max_shifts, src_freq=src_freq)
+    else:
+        rigid_shts, diffphase = register_translation_batch(
+            src_freq, np.fft.fft2(template), upsample_factor=upsample_factor_fft, max_shifts=max_shifts)
+
+    if max_deviation_rigid == 0:
+        if shifts_only:
+            return None, [[(-sh[0], -sh[1]), None, None] for sh in rigid_shts]
+        if shifts_opencv:
+            if gSig_filt is not None:
+                imgs = imgs_orig
+            new_imgs = np.array([apply_shift_iteration(img, -sh, border_nan=border_nan)
+                                 for img, sh in zip(imgs, rigid_shts)])
+        else:
+            if gSig_filt is not None:
+                raise Exception(
+                    'The use of FFT and filtering options have not been tested. Set opencv=True')
+            new_imgs = apply_shifts_dft_batch(src_freq, -rigid_shts, diffphase, border_nan=border_nan)
+
+        return new_imgs - add_to_movie, [[(-sh[0], -sh[1]), None, None] for sh in rigid_shts]
+
+    del src_freq
+    # extract patches and compute their shifts
+    range_1, range_2 = sliding_window_starts(template.shape, overlaps, strides)
+    windowSize = tuple(np.add(overlaps, strides))
+    templates = extract_tiles(template[None], (range_1, range_2), windowSize)[0]
+    tiles = extract_tiles(imgs, (range_1, range_2), windowSize)
+
+    if max_deviation_rigid is not None:
+        lb_shifts = np.ceil(rigid_shts - max_deviation_rigid).astype(int)[:, None, None]
+        ub_shifts = np.floor(rigid_shts + max_deviation_rigid).astype(int)[:, None, None]
+    else:
+        lb_shifts = None
+        ub_shifts = None
+
+    shfts, diffs_phase = register_translation_batch(
+        np.fft.fft2(tiles), np.fft.fft2(templates), upsample_factor=upsample_factor_fft,
+        shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts)
+    del tiles
+
+    # create automatically upsample parameters if not passed
+    if newoverlaps is None:
+        newoverlaps = overlaps
+    if newstrides is None:
+        newstrides = tuple(
+            np.round(np.divide(strides, upsample_factor_grid)).astype(int))
+
+    newshapes = tuple(np.add(newstrides, newoverlaps))
+    new_range_1, new_range_2 = sliding_window_starts(template.shape, newoverlaps, newstrides)
+    dim_new_grid = (len(new_range_1), len(new_range_2))
+    num_tiles = np.prod(dim_new_grid)
+    start_step = [(x, y) for x in new_range_1 for y in new_range_2]
+    xy_grid = [(i, j) for i in range(dim_new_grid[0]) for j in range(dim_new_grid[1])]
+
+    # upsample the vector fields
+    shift_imgs = np.zeros((num_frames,) + dim_new_grid + (2,))
+    diffs_phase_us = np.zeros((num_frames,) + dim_new_grid)
+    max_shear = np.zeros(num_frames)
+    for idx in range(num_frames):
+        for dim in range(2):
+            shift_imgs[idx, ..., dim] = cv2.resize(
+                shfts[idx, ..., dim], dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC)
+        diffs_phase_us[idx] = cv2.resize(
+            diffs_phase[idx], dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC)
+        max_shear[idx] = np.percentile(
+            [np.max(np.abs(np.diff(shift_imgs[idx, ..., dim], axis=ax))) for dim, ax in itertools.product(
+                [0, 1], [0, 1])], 75)
+
+    total_shifts = -shift_imgs
+    shift_info = [[[tuple(sh) for sh in frame_shifts.reshape(num_tiles, 2)], start_step, xy_grid]
+                  for frame_shifts in total_shifts]
+    if shifts_only:
+        return None, shift_info
+    if shifts_opencv:
+        if gSig_filt is not None:
+            imgs = imgs_orig
+        tiles = extract_tiles(imgs, (new_range_1, new_range_2), newshapes)
+        tiles = np.array([[[apply_shift_iteration(im, sh, border_nan=border_nan)
+                            for im, sh in zip(tile_row, sh_row)]
+                           for tile_row, sh_row in zip(frame_tiles, frame_shifts)]
+                          for frame_tiles, frame_shifts in zip(tiles, total_shifts)])
+    else:
+        if gSig_filt is not None:
+            raise Exception(
+                'The use of FFT and filtering options have not been tested. Set opencv=True')
+        tiles = apply_shifts_dft_batch(np.fft.fft2(extract_tiles(imgs, (new_range_1, new_range_2), newshapes)),
+                                       total_shifts, diffs_phase_us, border_nan=border_nan)
+
+    tiles = tiles.reshape((num_frames, num_tiles) + newshapes)
+    new_imgs = np.zeros(imgs.shape) * np.nan
+    weight_matrix = create_weight_matrix_for_blending(
+        template, newoverlaps, newstrides)
+
+    blend = max_shear < 0.5
+    if np.any(blend):
+        accum = np.zeros((np.sum(blend),) + imgs.shape[1:])
+        normalizer = np.zeros_like(accum)
+        for (x, y), weight_mat, ims in zip(start_step, weight_matrix, tiles[blend].transpose(1, 0, 2, 3)):
+            is_valid = ~np.isnan(ims)
+            accum[:, x:x + newshapes[0], y:y + newshapes[1]] += np.where(is_valid, ims * weight_mat, 0)
+            normalizer[:, x:x + newshapes[0], y:y + newshapes[1]] += is_valid * weight_mat
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_imgs[blend] = old_div(accum, normalizer)
+
+    if not np.all(blend):
+        # in case the difference in shift between neighboring patches is larger than 0.5 pixels we do not interpolate in the overlaping area
+        half_overlap_x = int(newoverlaps[0] / 2)
+        half_overlap_y = int(newoverlaps[1] / 2)
+        hard = new_imgs[~blend]
+        for (x, y), (idx_0, idx_1), ims in zip(start_step, xy_grid, tiles[~blend].transpose(1, 0, 2, 3)):
+            x_start = x if idx_0 == 0 else x + half_overlap_x
+            y_start = y if idx_1 == 0 else y + half_overlap_y
+            hard[:, x_start:x + newshapes[0], y_start:y + newshapes[1]] = ims[:, x_start - x:, y_start - y:]
+        new_imgs[~blend] = hard
+
+    return new_imgs - add_to_movie, shift_info
+
+
+#%%
+def tile_and_correct_3d(imgs, template, strides, overlaps, max_shifts, newoverlaps=None, newstrides=None,
+                        upsample_factor_grid=4, upsample_factor_fft=10, max_deviation_rigid=2, add_to_movie=0,
+                        border_nan=True):
+    """ piecewise rigid motion correction of a batch of volumes
+
+    Volumetric counterpart of tile_and_correct_batch: the volumes are divided
+    in overlapping 3D patches, each patch is registered to the corresponding
+    patch of the template with batched 3D FFTs (the search is bounded by
+    max_deviation_rigid around the rigid shift of the volume), the
+    3-components shift field is upsampled on a finer 3D grid, and the shifted
+    patches are blended back together. Shifts are applied in the Fourier domain.
+
+    Parameters:
+    -----------
+    imgs: ndarray
+        volumes to correct (T x d1 x d2 x d3)
+
+    template: ndarray
+        reference volume (d1 x d2 x d3)
+
+    strides, overlaps: tuples
+        strides and overlaps of the patches along each dimension
+
+    max_shifts: tuple
+        max rigid shifts along each dimension
+
+    newoverlaps, newstrides, upsample_factor_grid, upsample_factor_fft,
+    max_deviation_rigid, add_to_movie, border_nan:
+        see tile_and_correct
+
+    Returns:
+    --------
+    new_imgs: ndarray
+        corrected volumes (T x d1 x d2 x d3)
+
+    shift_info: list
+        [total_shifts, start_step, xyz_grid] for each volume (see tile_and_correct)
+    """
+    imgs = np.array(imgs, dtype=np.float64) + add_to_movie
+    template = template.astype(np.float64) + add_to_movie
+    num_frames = len(imgs)
+    axes = (-3, -2, -1)
+
+    # compute rigid shifts
+    src_freq = np.fft.fftn(imgs, axes=axes)
+    rigid_shts, diffphase = register_translation_batch(
+        src_freq, np.fft.fftn(template), upsample_factor=upsample_factor_fft, max_shifts=max_shifts)
+
+    if max_deviation_rigid == 0:
+        new_imgs = apply_shifts_dft_batch(src_freq, -rigid_shts, diffphase, border_nan=border_nan)
+        return new_imgs - add_to_movie, [[tuple(-sh), None, None] for sh in rigid_shts]
+
+    del src_freq
+    # extract patches and compute their shifts
+    ranges = sliding_window_starts(template.shape, overlaps, strides)
+    windowSize = tuple(np.add(overlaps, strides))
+    dim_grid = tuple(len(rng) for rng in ranges)
+    templates = extract_tiles(template[None], ranges, windowSize)[0]
+    tiles = extract_tiles(imgs, ranges, windowSize)
+
+    if max_deviation_rigid is not None:
+        lb_shifts = np.ceil(rigid_shts - max_deviation_rigid).astype(int)[:, None, None, None]
+        ub_shifts = np.floor(rigid_shts + max_deviation_rigid).astype(int)[:, None, None, None]
+    else:
+        lb_shifts = None
+        ub_shifts = None
+
+    shfts, diffs_phase = register_translation_batch(
+        np.fft.fftn(tiles, axes=axes), np.fft.fftn(templates, axes=axes), upsample_factor=upsample_factor_fft,
+        shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts)
+    del tiles
+
+    # create automatically upsample parameters if not passed
+    if newoverlaps is None:
+        newoverlaps = overlaps
+    if newstrides is None:
+        newstrides = tuple(
+            np.round(np.divide(strides, upsample_factor_grid)).astype(int))
+
+    newshapes = tuple(np.add(newstrides, newoverlaps))
+    new_ranges = sliding_window_starts(template.shape, newoverlaps, newstrides)
+    dim_new_grid = tuple(len(rng) for rng in new_ranges)
+    num_tiles = np.prod(dim_new_grid)
+    start_step = list(itertools.product(*new_ranges))
+    xyz_grid = list(itertools.product(*[range(n) for n in dim_new_grid]))
+
+    # upsample the vector fields (the shifts along z are interpolated like the others)
+    zoom_factors = np.divide(dim_new_grid, dim_grid)
+    shift_imgs = np.zeros((num_frames,) + dim_new_grid + (3,))
+    diffs_phase_us = np.zeros((num_frames,) + dim_new_grid)
+    max_shear = np.zeros(num_frames)
+    for idx in range(num_frames):
+        for dim in range(3):
+            shift_imgs[idx, ..., dim] = zoom(shfts[idx, ..., dim], zoom_factors, order=3, mode='nearest')
+        diffs_phase_us[idx] = zoom(diffs_phase[idx], zoom_factors, order=3, mode='nearest')
+        shears = [np.max(np.abs(np.diff(shift_imgs[idx, ..., dim], axis=ax)))
+                  for dim, ax in itertools.product(range(3), range(3)) if dim_new_grid[ax] > 1]
+        max_shear[idx] = np.percentile(shears, 75) if len(shears) else 0
+
+    total_shifts = -shift_imgs
+    tiles = apply_shifts_dft_batch(np.fft.fftn(extract_tiles(imgs, new_ranges, newshapes), axes=axes),
+                                   total_shifts, diffs_phase_us, border_nan=border_nan)
+    tiles = tiles.reshape((num_frames, num_tiles) + newshapes).transpose(1, 0, 2, 3, 4)
+    new_imgs = np.zeros(imgs.shape) * np.nan
+
+    # blending weights are the product of linear ramps over the overlaps along each dimension
+    ramps = []
+    for n, ov, sz in zip(dim_new_grid, newoverlaps, newshapes):
+        ramps.append([])
+        for grid in range(n):
+            ramp = np.ones(sz)
+            if ov > 0:
+                if grid > 0:
+                    ramp[:ov] = np.linspace(0, 1, ov)
+                if grid < n - 1:
+                    ramp[-ov:] *= np.linspace(1, 0, ov)
+            ramps[-1].append(ramp)
+
+    blend = max_shear < 0.5
+    if np.any(blend):
+        accum = np.zeros((np.sum(blend),) + imgs.shape[1:])
+        normalizer = np.zeros_like(accum)
+        for start, grid, ims in zip(start_step, xyz_grid, tiles[:, blend]):
+            weight_mat = ramps[0][grid[0]][:, None, None] * ramps[1][grid[1]][None, :, None] * \
+                ramps[2][grid[2]][None, None, :]
+            sl = (slice(None),) + tuple(slice(st, st + sz) for st, sz in zip(start, newshapes))
+            is_valid = ~np.isnan(ims)
+            accum[sl] += np.where(is_valid, ims * weight_mat, 0)
+            normalizer[sl] += is_valid * weight_mat
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_imgs[blend] = old_div(accum, normalizer)
+
+    if not np.all(blend):
+        # in case the difference in shift between neighboring patches is larger than 0.5 pixels we do not interpolate in the overlaping area
+        half_overlaps = [int(ov / 2) for ov in newoverlaps]
+        hard = new_imgs[~blend]
+        for start, grid, ims in zip(start_step, xyz_grid, tiles[:, ~blend]):
+            starts = [st if gr == 0 else st + ho for st, gr, ho in zip(start, grid, half_overlaps)]
+            hard[(slice(None),) + tuple(slice(st_, st + sz) for st_, st, sz in zip(starts, start, newshapes))] = \
+                ims[(slice(None),) + tuple(slice(st_ - st, None) for st_, st in zip(starts, start))]
+        new_imgs[~blend] = hard
+
+    shift_info = [[[tuple(sh) for sh in frame_shifts.reshape(num_tiles, 3)], start_step, xyz_grid]
+                  for frame_shifts in total_shifts]
+    return new_imgs - add_to_movie, shift_info
+
+
+#%%
+def compute_metrics_batch(frames, template, shift_info):
+    """ quality metrics of a batch of motion corrected frames
+
+    Computed by the motion correction workers on the frames they have just
+    corrected, so that no second pass over the movie is needed (see
+    reduce_metrics_motion_correction). The shifts are the ones estimated by
+    the registration of the frames, they are not estimated again.
+
+    Parameters:
+    -----------
+    frames: ndarray
+        corrected frames (T x d1 x d2), NaNs allowed on the borders
+
+    template: ndarray
+        template the frames were registered to
+
+    shift_info: list
+        shift information of the frames returned by the registration (see
+        tile_and_correct_batch), one entry per frame
+
+    Returns:
+    --------
+    correlations: ndarray
+        correlation of each frame with the template over its non NaN pixels,
+        the borders left empty by the correction are excluded
+
+    shifts: ndarray
+        T x 2 rigid shifts applied to each frame (for piecewise rigid
+        correction the mean of the shifts of the patches)
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    template = np.asarray(template, dtype=np.float64)
+    is_valid = ~np.isnan(frames)
+    n_valid = np.maximum(is_valid.sum(axis=(1, 2)), 1)
+
+    mean_frames = np.sum(np.where(is_valid, frames, 0), axis=(1, 2)) / n_valid
+    mean_templ = np.sum(is_valid * template, axis=(1, 2)) / n_valid
+    dev_frames = np.where(is_valid, frames - mean_frames[:, None, None], 0)
+    dev_templ = is_valid * (template - mean_templ[:, None, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlations = np.sum(dev_frames * dev_templ, axis=(1, 2)) / np.sqrt(
+            np.sum(dev_frames ** 2, axis=(1, 2)) * np.sum(dev_templ ** 2, axis=(1, 2)))
+
+    shifts = np.array([np.mean(np.reshape(np.array(sh[0], dtype=np.float64), (-1, 2)), 0)
+                       for sh in shift_info]).reshape(-1, 2)
+
+    return correlations, shifts
+
+#%%
+def reduce_metrics_motion_correction(res):
+    """ reduce the partial quality metrics returned by the motion correction workers
+
+    Parameters:
+    -----------
+    res: list
+        output of motion_correction_piecewise run with compute_metrics=True
+
+    Returns:
+    --------
+    metrics: dict
+        mean_img: mean of the corrected movie
+        correlations: correlation of each frame with the template
+        shifts: rigid shifts applied to each frame (mean over the patches if piecewise rigid)
+        shift_norms: norms of the shifts
+        crispness: norm of the gradient of the mean image, over the pixels
+        that are valid in all the frames (larger means sharper)
+    """
+    sum_img = np.sum([r[-1]['sum_img'] for r in res], 0)
+    count_img = np.sum([r[-1]['count_img'] for r in res], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_img = sum_img / count_img
+    correlations = np.concatenate([r[-1]['correlations'] for r in res])
+    shifts = np.concatenate([r[-1]['shifts'] for r in res])
+
+    rows = np.where(np.any(count_img == count_img.max(), axis=1))[0]
+    cols = np.where(np.any(count_img == count_img.max(), axis=0))[0]
+    if len(rows) > 1 and len(cols) > 1:
+        crop = mean_img[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        crispness = np.sqrt(np.sum(np.sum(np.array(np.gradient(crop)) ** 2, 0)))
+    else:
+        crispness = np.nan
+
+    return {'mean_img': mean_img, 'correlations': correlations, 'shifts': shifts,
+            'shift_norms': np.sqrt(np.sum(shifts ** 2, 1)), 'crispness': crispness}
+
+
+#%%
+
+def compute_flow_single_frame(frame, templ, pyr_scale=.5, levels=3, winsize=100, iterations=15, poly_n=5,
+                              poly_sigma=1.2 / 5, flags=0):
+    flow = cv2.calcOpticalFlowFarneback(
+        templ, frame, None, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags)
+    return flow
+#%%
+
+
+def compute_metrics_motion_correction(fname, final_size_x, final_size_y, swap_dim, pyr_scale=.5, levels=3,
+                                      winsize=100, iterations=15, poly_n=5, poly_sigma=1.2 / 5, flags=0,
+                                      play_flow=False, resize_fact_flow=.2, template=None):
+    #todo: todocument
+    # cv2.OPTFLOW_FARNEBACK_GAUSSIAN
+    import scipy
+    vmin, vmax = -1, 1
+    m = cm.load(fname)
+
+    max_shft_x = np.int(np.ceil((np.shape(m)[1] - final_size_x) / 2))
+    max_shft_y = np.int(np.ceil((np.shape(m)[2] - final_size_y) / 2))
+    max_shft_x_1 = - ((np.shape(m)[1] - max_shft_x) - (final_size_x))
+    max_shft_y_1 = - ((np.shape(m)[2] - max_shft_y) - (final_size_y))
+    if max_shft_x_1 == 0:
+        max_shft_x_1 = None
+
+    if max_shft_y_1 == 0:
+        max_shft_y_1 = None
+    print([max_shft_x, max_shft_x_1, max_shft_y, max_shft_y_1])
+    m = m[:, max_shft_x:max_shft_x_1, max_shft_y:max_shft_y_1]
+    if np.sum(np.isnan(m)) > 0:
+        print(m.shape)
+        raise Exception('Movie contains NaN')
+
+    print('Local correlations..')
+    img_corr = m.local_correlations(eight_neighbours=True, swap_dim=swap_dim)
+    print(m.shape)
+    if template is None:
+        tmpl = cm.motion_correction.bin_median(m)
+    else:
+        tmpl = template
+
+    print('Compute Smoothness.. ')
+    smoothness = np.sqrt(
+        np.sum(np.sum(np.array(np.gradient(np.mean(m, 0)))**2, 0)))
+    smoothness_corr = np.sqrt(
+        np.sum(np.sum(np.array(np.gradient(img_corr))**2, 0)))
+
+    print('Compute correlations.. ')
+    correlations = []
+    count = 0
+    for fr in m:
+        if count % 100 == 0:
+            print(count)
+
+        count += 1
+        correlations.append(scipy.stats.pearsonr(
+            fr.flatten(), tmpl.flatten())[0])
+
+    print('Compute optical flow .. ')
+
+    m = m.resize(1, 1, resize_fact_flow)
+    norms = []
+    flows = []
+    count = 0
+    for fr in m:
+        if count % 100 == 0:
+            print(count)
 
         count += 1
         flow = cv2.calcOpticalFlowFarneback(
@@ -2137,11 +3312,111 @@ def compute_metrics_motion_correction(fname, final_size_x, final_size_y, swap_di
     return tmpl, correlations, flows, norms, smoothness
 
 
+#%%
+def refine_template_streaming(fname, template, splits, num_passes=1, tol=None, dview=None, splits_per_update=None,
+                              subidx=None, gSig_filt=None, **kwargs):
+    """ refine the template while streaming over the chunks of the movie
+
+    Instead of registering the whole movie before each template update, the
+    chunks are registered a few at a time (splits_per_update, in a fixed random
+    order so that every update sees frames from across the recording) and the
+    template is updated after each group as the pixelwise median of the latest
+    mean image of every chunk registered so far. After a full pass this is the
+    same template that motion_correction_piecewise produces. The refinement
+    stops as soon as the relative change of the template falls below tol, so
+    additional passes are only run while the template is still changing.
+
+    Parameters:
+    -----------
+    fname: str
+        name of the movie
+
+    template: ndarray
+        initial template
+
+    splits: int
+        number of chunks in which the movie is subdivided
+
+    num_passes: int
+        maximum number of passes over the movie
+
+    tol: float
+        relative change of the template (in norm) below which the refinement stops.
+        If None all the passes are performed
+
+    dview: ipyparallel view or multiprocessing pool
+        used to perform parallel computing
+
+    splits_per_update: int
+        number of chunks registered (in parallel) between template updates.
+        Defaults to 1 without dview, to the number of cores with a multiprocessing pool
+        and to the number of engines with an ipyparallel view
+
+    subidx: slice
+        indices of the frames to consider
+
+    gSig_filt: list
+        size of the high pass spatial filter applied to the template (see high_pass_filter_space)
+
+    kwargs: dict
+        parameters of motion_correction_piecewise (strides, overlaps, max_shifts, add_to_movie, ...)
+
+    Returns:
+    --------
+    template: ndarray
+        refined template
+
+    num_chunks: int
+        number of chunks registered
+
+    converged: bool
+        whether the template change fell below tol
+    """
+    T = get_file_size(fname)[1]
+    rng = range(T) if subidx is None else range(T)[subidx]
+    idxs = [idx for idx in np.array_split(list(rng), splits) if len(idx) > 0]
+    if splits_per_update is None:
+        if dview is None:
+            splits_per_update = 1
+        elif 'multiprocessing' in str(type(dview)):
+            # a pool does not expose its size, setup_cluster starts one worker per core
+            splits_per_update = multiprocessing.cpu_count()
+        else:
+            splits_per_update = len(dview)
+
+    chunk_order = np.random.RandomState(0).permutation(len(idxs))
+    min_chunks = min(len(idxs), 4)
+    chunk_means = {}
+    num_chunks = 0
+    for pass_ in range(num_passes):
+        for start in range(0, len(chunk_order), splits_per_update):
+            group = chunk_order[start:start + splits_per_update]
+            _, res = motion_correction_piecewise(fname, [idxs[i] for i in group], template=template, dview=dview,
+                                                 save_movie=False, gSig_filt=gSig_filt, **kwargs)
+            for i, r in zip(group, res):
+                chunk_means[i] = r[2]
+            num_chunks += len(group)
+            if len(chunk_means) < min_chunks:
+                continue
+
+            new_templ = np.nanmedian(np.stack(list(chunk_means.values()), -1), -1)
+            if gSig_filt is not None:
+                new_templ = high_pass_filter_space(new_templ, gSig_filt)
+            change = old_div(np.linalg.norm(new_templ - template), np.linalg.norm(template))
+            template = new_templ
+            print('pass ' + str(pass_) + ', ' + str(num_chunks) + ' chunks registered, template change ' + str(change))
+            if tol is not None and change < tol:
+                return template, num_chunks, True
+
+    return template, num_chunks, False
+
+
 #%%
 def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_splits_to_process=None, num_iter=1,
                                template=None, shifts_opencv=False, save_movie_rigid=False, add_to_movie=None,
                                nonneg_movie=False, gSig_filt=None, subidx=slice(None, None, 1), use_cuda=False,
-                               border_nan=True):
+                               border_nan=True, pyramid_levels=0, compute_metrics=False, is3D=False, order='F',
+                               frames_per_bin=1, template_tol=None):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2180,6 +3455,32 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
     use_cuda : bool, optional
         Use skcuda.fft (if available). Default: False
 
+    pyramid_levels: int
+        number of Gaussian pyramid levels for coarse-to-fine registration (0 to disable)
+
+    compute_metrics: bool
+        compute quality metrics while correcting the frames in the last iteration
+
+    is3D: bool
+        the movie is volumetric (T x d1 x d2 x d3). The initial template is then the binned
+        median of the raw volumes, and the movie is saved in C order so that it can be
+        passed directly to CNMF
+
+    order: 'F' or 'C'
+        order of the saved movie. With 'C' the workers write the corrected frames with
+        blocked transposed writes (see write_frames_memmap) and the file can be passed
+        to CNMF without a further save_memmap pass
+
+    frames_per_bin: int
+        if larger than 1 the shifts are estimated on averages of frames_per_bin consecutive
+        frames and linearly interpolated to every frame. Useful for high frame rate, low SNR
+        movies: registration is about frames_per_bin times faster and less noisy
+
+    template_tol: float
+        if not None, the first num_iter - 1 iterations refine the template while streaming over
+        the chunks and stop as soon as its relative change is below template_tol (see
+        refine_template_streaming). The last iteration is always a full pass
+
     Returns:
     --------
     fname_tot_rig: str
@@ -2192,11 +3493,23 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
     shifts: list
         inferred rigid shifts to correct the movie
 
+    metrics: dict
+        only if compute_metrics, see reduce_metrics_motion_correction
+
     Raise:
     -----
         Exception('The movie contains nans. Nans are not allowed!')
 
+        ValueError('Quality metrics are not supported for volumetric movies')
+
+        ValueError('Binned registration is not supported for volumetric movies')
+
     """
+    if is3D and compute_metrics:
+        raise ValueError('Quality metrics are not supported for volumetric movies')
+    if is3D and frames_per_bin > 1:
+        raise ValueError('Binned registration is not supported for volumetric movies')
+
     corrected_slicer = slice(subidx.start, subidx.stop, subidx.step * 10)
     m = cm.load(fname, subindices=corrected_slicer)
 
@@ -2209,13 +3522,19 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
         corrected_slicer = slice(subidx.start, subidx.stop, subidx.step * 30)
         m = cm.load(fname, subindices=corrected_slicer)
 
+    if is3D and gSig_filt is not None:
+        raise Exception('High pass filtering is not supported for volumetric movies')
+
     if template is None:
         if gSig_filt is not None:
             m = cm.movie(
                 np.array([high_pass_filter_space(m_, gSig_filt) for m_ in m]))
 
-        template = cm.motion_correction.bin_median(
-            m.motion_correct(max_shifts[0], max_shifts[1], template=None)[0])
+        if is3D:
+            template = cm.motion_correction.bin_median(m)
+        else:
+            template = cm.motion_correction.bin_median(
+                m.motion_correct(max_shifts[0], max_shifts[1], template=None)[0])
 
     new_templ = template
     if add_to_movie is None:
@@ -2226,13 +3545,23 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
     else:
         print('Adding to movie ' + str(add_to_movie))
 
+    if template_tol is not None and num_iter > 1:
+        new_templ = refine_template_streaming(fname, new_templ, splits, num_passes=num_iter - 1, tol=template_tol,
+                                              dview=dview, subidx=subidx, gSig_filt=gSig_filt, strides=None,
+                                              overlaps=None, add_to_movie=add_to_movie, max_shifts=max_shifts,
+                                              max_deviation_rigid=0, shifts_opencv=shifts_opencv,
+                                              nonneg_movie=nonneg_movie, use_cuda=use_cuda, border_nan=border_nan,
+                                              pyramid_levels=pyramid_levels, frames_per_bin=frames_per_bin)[0]
+        num_iter = 1
+
     save_movie = False
     fname_tot_rig = None
     res_rig = []
     for iter_ in range(num_iter):
         print(iter_)
         old_templ = new_templ.copy()
-        if iter_ == num_iter - 1:
+        last_iter = iter_ == num_iter - 1
+        if last_iter:
             save_movie = save_movie_rigid
             print('saving!')
 
@@ -2241,9 +3570,13 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
                                                              dview=dview, save_movie=save_movie, base_name=os.path.split(
                                                                  fname)[-1][:-4] + '_rig_', subidx = subidx,
                                                              num_splits=num_splits_to_process, shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
-                                                             use_cuda=use_cuda, border_nan=border_nan)
+                                                             use_cuda=use_cuda, border_nan=border_nan,
+                                                             pyramid_levels=pyramid_levels,
+                                                             compute_metrics=compute_metrics and last_iter,
+                                                             order='C' if is3D else order,
+                                                             frames_per_bin=frames_per_bin)
 
-        new_templ = np.nanmedian(np.dstack([r[-1] for r in res_rig]), -1)
+        new_templ = np.nanmedian(np.stack([r[2] for r in res_rig], -1), -1)
         if gSig_filt is not None:
             new_templ = high_pass_filter_space(new_templ, gSig_filt)
 
@@ -2253,9 +3586,12 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
     templates = []
     shifts = []
     for rr in res_rig:
-        shift_info, idxs, tmpl = rr
+        shift_info, idxs, tmpl, _ = rr
         templates.append(tmpl)
-        shifts += [[sh[0][0], sh[0][1]] for sh in shift_info[:len(idxs)]]
+        shifts += [list(sh[0]) for sh in shift_info[:len(idxs)]]
+
+    if compute_metrics:
+        return fname_tot_rig, total_template, templates, shifts, reduce_metrics_motion_correction(res_rig)
 
     return fname_tot_rig, total_template, templates, shifts
 #%%
@@ -2265,7 +3601,8 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                  dview=None, upsample_factor_grid=4, max_deviation_rigid=3,
                                  splits=56, num_splits_to_process=None, num_iter=1,
                                  template=None, shifts_opencv=False, save_movie=False, nonneg_movie=False, gSig_filt=None,
-                                 use_cuda=False, border_nan=True):
+                                 use_cuda=False, border_nan=True, pyramid_levels=0, compute_metrics=False, is3D=False,
+                                 order='F', frames_per_bin=1, template_tol=None):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2313,6 +3650,29 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
     use_cuda : bool, optional
         Use skcuda.fft (if available). Default: False
 
+    pyramid_levels: int
+        number of Gaussian pyramid levels for coarse-to-fine registration of
+        the rigid shifts that bound the patch shifts (0 to disable)
+
+    compute_metrics: bool
+        compute quality metrics while correcting the frames in the last iteration
+
+    is3D: bool
+        the movie is volumetric (T x d1 x d2 x d3), strides, overlaps and max_shifts have
+        three elements, the patches are registered with tile_and_correct_3d and the movie
+        is saved in C order so that it can be passed directly to CNMF
+
+    order: 'F' or 'C'
+        order of the saved movie (see motion_correct_batch_rigid)
+
+    frames_per_bin: int
+        if larger than 1 the patch shifts are estimated on averages of frames_per_bin
+        consecutive frames and linearly interpolated to every frame (see motion_correct_batch_rigid)
+
+    template_tol: float
+        streaming template refinement with early stopping for the first num_iter - 1
+        iterations (see motion_correct_batch_rigid)
+
     Returns:
     --------
     fname_tot_rig: str
@@ -2322,14 +3682,26 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
     templates:list
         list of produced templates, one per batch
 
-    shifts: list
-        inferred rigid shifts to corrrect the movie
+    x_shifts, y_shifts, [z_shifts (only if is3D),] coord_shifts: lists
+        inferred shifts of each patch to correct the movie, and the grid coordinates of the patches
+
+    metrics: dict
+        only if compute_metrics, see reduce_metrics_motion_correction
 
     Raise:
     ----
         Exception('You need to initialize the template with a good estimate. See the motion'
                         '_correct_batch_rigid function')
+
+        ValueError('Quality metrics are not supported for volumetric movies')
+
+        ValueError('Binned registration is not supported for volumetric movies')
     """
+    if is3D and compute_metrics:
+        raise ValueError('Quality metrics are not supported for volumetric movies')
+    if is3D and frames_per_bin > 1:
+        raise ValueError('Binned registration is not supported for volumetric movies')
+
     if template is None:
         raise Exception('You need to initialize the template with a good estimate. See the motion'
                         '_correct_batch_rigid function')
@@ -2341,6 +3713,17 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
     else:
         print('Adding to movie ' + str(add_to_movie))
 
+    if template_tol is not None and num_iter > 1:
+        new_templ = refine_template_streaming(fname, new_templ, splits, num_passes=num_iter - 1, tol=template_tol,
+                                              dview=dview, gSig_filt=gSig_filt, strides=strides, overlaps=overlaps,
+                                              add_to_movie=add_to_movie, max_shifts=max_shifts,
+                                              max_deviation_rigid=max_deviation_rigid, newoverlaps=newoverlaps,
+                                              newstrides=newstrides, upsample_factor_grid=upsample_factor_grid,
+                                              shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie,
+                                              use_cuda=use_cuda, border_nan=border_nan,
+                                              pyramid_levels=pyramid_levels, frames_per_bin=frames_per_bin)[0]
+        num_iter = 1
+
     for iter_ in range(num_iter):
         print(iter_)
         old_templ = new_templ.copy()
@@ -2354,12 +3737,16 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                                             add_to_movie=add_to_movie, template=old_templ, max_shifts=max_shifts,
                                                             max_deviation_rigid=max_deviation_rigid,
                                                             newoverlaps=newoverlaps, newstrides=newstrides,
-                                                            upsample_factor_grid=upsample_factor_grid, order='F', dview=dview, save_movie=save_movie,
+                                                            upsample_factor_grid=upsample_factor_grid, order='C' if is3D else order,
+                                                            dview=dview, save_movie=save_movie,
                                                             base_name=os.path.split(fname)[-1][:-4] + '_els_', num_splits=num_splits_to_process,
                                                             shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
-                                                            use_cuda=use_cuda, border_nan=border_nan)
+                                                            use_cuda=use_cuda, border_nan=border_nan,
+                                                            pyramid_levels=pyramid_levels,
+                                                            compute_metrics=compute_metrics and iter_ == num_iter - 1,
+                                                            frames_per_bin=frames_per_bin)
 
-        new_templ = np.nanmedian(np.dstack([r[-1] for r in res_el]), -1)
+        new_templ = np.nanmedian(np.stack([r[2] for r in res_el], -1), -1)
         if gSig_filt is not None:
             new_templ = high_pass_filter_space(new_templ, gSig_filt)
 
@@ -2367,28 +3754,91 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
     templates = []
     x_shifts = []
     y_shifts = []
+    z_shifts = []
     coord_shifts = []
     for rr in res_el:
-        shift_info_chunk, idxs_chunk, tmpl_chunk = rr
+        shift_info_chunk, idxs_chunk, tmpl_chunk, _ = rr
         templates.append(tmpl_chunk)
         for shift_info, _ in zip(shift_info_chunk, idxs_chunk):
             total_shift, _, xy_grid = shift_info
             x_shifts.append(np.array([sh[0] for sh in total_shift]))
             y_shifts.append(np.array([sh[1] for sh in total_shift]))
+            if is3D:
+                z_shifts.append(np.array([sh[2] for sh in total_shift]))
             coord_shifts.append(xy_grid)
 
+    if is3D:
+        return fname_tot_els, total_template, templates, x_shifts, y_shifts, z_shifts, coord_shifts
+
+    if compute_metrics:
+        return fname_tot_els, total_template, templates, x_shifts, y_shifts, coord_shifts, \
+            reduce_metrics_motion_correction(res_el)
+
     return fname_tot_els, total_template, templates, x_shifts, y_shifts, coord_shifts
 
 
+#%%
+def write_frames_memmap(outv, frames, idxs, bias=0, block_size=65536):
+    """ write frames into the columns idxs of a pixels x time memory mapped file
+
+    For a file in C order each row holds one pixel over time, so writing frame
+    by frame touches every row of the file. If idxs is a contiguous range, the
+    frames are instead transposed in memory in blocks of block_size pixels and
+    each block is written with a single slice assignment, so that each row
+    receives one contiguous run of len(idxs) values.
+
+    Parameters:
+    -----------
+    outv: np.memmap
+        pixels x time memory mapped file (C or F order)
+
+    frames: ndarray
+        frames to write (T x d1 x d2 [x d3])
+
+    idxs: array of int
+        time indices of the frames in the file
+
+    bias: float
+        value added to the frames
+
+    block_size: int
+        number of pixels transposed and written at once (C order only)
+    """
+    frames = np.reshape(frames, (len(frames), -1), order='F')
+    idxs = np.asarray(idxs)
+    if outv.flags['C_CONTIGUOUS'] and len(idxs) > 1 and np.all(np.diff(idxs) == 1):
+        cols = slice(idxs[0], idxs[-1] + 1)
+        for start in range(0, frames.shape[1], block_size):
+            outv[start:start + block_size, cols] = frames[:, start:start + block_size].T + bias
+    else:
+        outv[:, idxs] = frames.T + bias
+
+
 #%% in parallel
 def tile_and_correct_wrapper(params):
     """Does motion correction on specified image frames
 
+    Frames are processed in batches of batch_size (see tile_and_correct_batch,
+    or tile_and_correct_3d if the template is a volume) and each corrected batch
+    is written straight into the output memory mapped file. If the file is in C
+    order, the corrected frames of the chunk are kept in memory and written at
+    the end with blocked transposed writes (see write_frames_memmap).
+
+    If frames_per_bin > 1 the shifts are estimated on averages of frames_per_bin
+    consecutive frames (see bin_mean), linearly interpolated back to every frame
+    (see interpolate_shifts) and applied to the raw frames of the chunk (see
+    apply_shifts_frames). The bins are only registered, the template and the
+    metrics are computed on the corrected frames.
+
     Returns:
     ----------------
     shift_info:
     idxs:
     mean_img: mean over all frames of corrected image (to get individ frames, use out_fname to write them to disk)
+    metrics: None, or if compute_metrics partial quality metrics of the chunk (sum and count
+        of valid values per pixel, and per frame correlations with the template and shifts,
+        see compute_metrics_batch), reduced by reduce_metrics_motion_correction. With
+        frames_per_bin > 1 they are computed on every corrected frame, not per bin
 
     Notes:
     ----------------
@@ -2406,46 +3856,125 @@ def tile_and_correct_wrapper(params):
 
     img_name, out_fname, idxs, shape_mov, template, strides, overlaps, max_shifts,\
         add_to_movie, max_deviation_rigid, upsample_factor_grid, newoverlaps, newstrides, \
-        shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan = params
+        shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan, batch_size, pyramid_levels, \
+        compute_metrics, frames_per_bin = params
 
-    name, extension = os.path.splitext(img_name)[:2]
+    if HAS_CUDA and use_cuda and pyramid_levels > 0:
+        warnings.warn('pyramid_levels is not supported with use_cuda=True and is ignored')
 
     shift_info = []
-    if extension == '.tif' or extension == '.tiff':  # check if tiff file
-#        with tifffile.TiffFile(img_name) as tffl:
-#            imgs = tffl.asarray(img_name, key=idxs)        
-        imgs = cm.load(img_name, subindices=idxs)
-            
-    elif extension == '.sbx':  # check if sbx file
-        imgs = cm.base.movies.sbxread(img_name, idxs[0], len(idxs))
-    elif extension == '.sima' or extension == '.hdf5' or extension == '.h5':
-        imgs = cm.load(img_name, subindices=list(idxs))
-    mc = np.zeros(imgs.shape, dtype=np.float32)
-    for count, img in enumerate(imgs):
-        if count % 10 == 0:
-            print(count)
-        mc[count], total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
-                                                                       add_to_movie=add_to_movie, newoverlaps=newoverlaps,
-                                                                       newstrides=newstrides,
-                                                                       upsample_factor_grid=upsample_factor_grid,
-                                                                       upsample_factor_fft=10, show_movie=False,
-                                                                       max_deviation_rigid=max_deviation_rigid,
-                                                                       shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
-                                                                       use_cuda=use_cuda, border_nan=border_nan)
-        shift_info.append([total_shift, start_step, xy_grid])
+    imgs = load_frames(img_name, idxs)
+    if frames_per_bin > 1:
+        raw_imgs = np.array(imgs, dtype=np.float32)
+        imgs, bin_centers = bin_mean(raw_imgs, frames_per_bin)
 
     if out_fname is not None:
-        outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
-                         shape=prepare_shape(shape_mov), order='F')
+        # the order of the file is encoded in its name
+        outv = load_memmap(out_fname, mode='r+')[0]
         if nonneg_movie:
             bias = np.float32(add_to_movie)
         else:
             bias = 0
-        outv[:, idxs] = np.reshape(
-            mc.astype(np.float32), (len(imgs), -1), order='F').T + bias
-    new_temp = np.nanmean(mc, 0)
+        buffer_chunk = outv.flags['C_CONTIGUOUS'] and not outv.flags['F_CONTIGUOUS'] and frames_per_bin == 1
+        if buffer_chunk:
+            mc_chunk = np.zeros(imgs.shape, dtype=np.float32)
+
+    sum_img = np.zeros(imgs.shape[1:], dtype=np.float64)
+    count_img = np.zeros(imgs.shape[1:], dtype=np.int64)
+    correlations = []
+    frame_shifts = []
+
+    def accumulate(mc, mc_shift_info):
+        sum_img[:] += np.nansum(mc, 0)
+        count_img[:] += np.sum(~np.isnan(mc), 0)
+        if compute_metrics:
+            corrs, shifts = compute_metrics_batch(mc, template, mc_shift_info)
+            correlations.append(corrs)
+            frame_shifts.append(shifts)
+
+    for start in range(0, len(imgs), batch_size):
+        batch_idxs = idxs[start:start + batch_size]
+        if HAS_CUDA and use_cuda:
+            mc = []
+            for img in imgs[start:start + batch_size]:
+                new_img, total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
+                                                                             add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                                             newstrides=newstrides,
+                                                                             upsample_factor_grid=upsample_factor_grid,
+                                                                             upsample_factor_fft=10, show_movie=False,
+                                                                             max_deviation_rigid=max_deviation_rigid,
+                                                                             shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                                                             use_cuda=use_cuda, border_nan=border_nan)
+                mc.append(new_img)
+                shift_info.append([total_shift, start_step, xy_grid])
+            mc = np.array(mc, dtype=np.float32)
+        elif template.ndim == 3:
+            mc, batch_shift_info = tile_and_correct_3d(imgs[start:start + batch_size], template, strides, overlaps,
+                                                       max_shifts, add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                       newstrides=newstrides,
+                                                       upsample_factor_grid=upsample_factor_grid,
+                                                       upsample_factor_fft=10,
+                                                       max_deviation_rigid=max_deviation_rigid,
+                                                       border_nan=border_nan)
+            mc = mc.astype(np.float32)
+            shift_info += batch_shift_info
+        else:
+            # the bins are only registered, their shifts are applied to the raw frames below
+            mc, batch_shift_info = tile_and_correct_batch(imgs[start:start + batch_size], template, strides, overlaps,
+                                                          max_shifts, add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                          newstrides=newstrides,
+                                                          upsample_factor_grid=upsample_factor_grid,
+                                                          upsample_factor_fft=10,
+                                                          max_deviation_rigid=max_deviation_rigid,
+                                                          shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                                          border_nan=border_nan, pyramid_levels=pyramid_levels,
+                                                          shifts_only=frames_per_bin > 1)
+            shift_info += batch_shift_info
+        if frames_per_bin > 1:
+            continue
+        mc = mc.astype(np.float32)
+
+        if out_fname is not None:
+            if buffer_chunk:
+                mc_chunk[start:start + batch_size] = mc
+            else:
+                write_frames_memmap(outv, mc, batch_idxs, bias=bias)
+        accumulate(mc, shift_info[start:start + batch_size])
+
+    if frames_per_bin > 1:
+        total_shifts = interpolate_shifts([sh[0] for sh in shift_info], bin_centers, len(raw_imgs))
+        if shift_info[0][1] is None:  # rigid
+            shift_info = [[tuple(sh), None, None] for sh in total_shifts]
+            shifts_rig, x_shifts, y_shifts, dims_grid = total_shifts, None, None, None
+        else:
+            start_step, xy_grid = shift_info[0][1:]
+            shift_info = [[[tuple(s) for s in sh], start_step, xy_grid] for sh in total_shifts]
+            shifts_rig, x_shifts, y_shifts = None, total_shifts[..., 0], total_shifts[..., 1]
+            dims_grid = tuple(np.max(xy_grid, axis=0) + 1)
+        mc_chunk = apply_shifts_frames(raw_imgs, shifts_rig=shifts_rig, x_shifts=x_shifts, y_shifts=y_shifts,
+                                       dims_grid=dims_grid, shifts_opencv=shifts_opencv and raw_imgs.ndim == 3,
+                                       border_nan=border_nan).astype(np.float32)
+        for start in range(0, len(mc_chunk), batch_size):
+            accumulate(mc_chunk[start:start + batch_size], shift_info[start:start + batch_size])
+        buffer_chunk = True
+
+    if out_fname is not None:
+        if buffer_chunk:
+            write_frames_memmap(outv, mc_chunk, idxs, bias=bias)
+            del mc_chunk
+        outv.flush()
+        del outv
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_temp = (sum_img / count_img).astype(np.float32)
     new_temp[np.isnan(new_temp)] = np.nanmin(new_temp)
-    return shift_info, idxs, new_temp
+    if compute_metrics:
+        metrics = {'sum_img': sum_img, 'count_img': count_img,
+                   'correlations': np.concatenate(correlations),
+                   'shifts': np.concatenate(frame_shifts)}
+    else:
+        metrics = None
+    return shift_info, idxs, new_temp, metrics
 
 
 #%%
@@ -2453,56 +3982,35 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
                                 max_shifts=(12, 12), max_deviation_rigid=3, newoverlaps=None, newstrides=None,
                                 upsample_factor_grid=4, order='F', dview=None, save_movie=True,
                                 base_name=None, subidx = None, num_splits=None, shifts_opencv=False, nonneg_movie=False, gSig_filt=None,
-                                use_cuda=False, border_nan=True):
-    """
+                                use_cuda=False, border_nan=True, batch_size=20, pyramid_levels=0,
+                                compute_metrics=False, frames_per_bin=1):
+    """ motion correct the movie in parallel chunks of frames (see tile_and_correct_wrapper)
 
-    """
-    # todo todocument
-    name, extension = os.path.splitext(fname)[:2]
-    is_fiji = False
+    Parameters:
+    -----------
+    batch_size: int
+        number of frames registered and corrected at once by each worker (see tile_and_correct_batch)
 
-    if extension == '.tif' or extension == '.tiff':  # check if tiff file
-        with tifffile.TiffFile(fname) as tf:
-            T = len(tf.pages)
-            if T == 1:  # Fiji-generated TIF
-                is_fiji = True
-                T, d1, d2 = tf[0].shape
-            else:
-                d1, d2 = tf.pages[0].shape
+    pyramid_levels: int
+        number of Gaussian pyramid levels for coarse-to-fine rigid registration (0 to disable)
 
-    elif extension == '.sbx':  # check if sbx file
+    compute_metrics: bool
+        whether the workers also return partial quality metrics of the corrected
+        frames (see tile_and_correct_wrapper and reduce_metrics_motion_correction)
 
-        shape = cm.base.movies.sbxshape(name)
-        d1 = shape[1]
-        d2 = shape[0]
-        T = shape[2]
+    frames_per_bin: int
+        if larger than 1 the shifts are estimated on averages of frames_per_bin
+        consecutive frames and interpolated to every frame (see tile_and_correct_wrapper)
 
-    elif extension == '.sima':  # check if sbx file
-        import sima
-        dataset = sima.ImagingDataset.load(fname)
-        shape = dataset.sequences[0].shape
-        d1 = shape[2]
-        d2 = shape[3]
-        T = shape[0]
-        del dataset
-    elif extension == '.npy':
+    Volumetric movies (T x d1 x d2 x d3, e.g. hdf5 or mmap files) are corrected
+    with tile_and_correct_3d when the template is a volume. In that case strides,
+    overlaps and max_shifts have three elements and the saved file has d3 > 1.
+    """
+    # todo todocument
+    if os.path.splitext(fname)[1] == '.npy':
         raise Exception('Numpy not supported at the moment')
-
-    elif extension == '.hdf5':
-        with h5py.File(fname) as fl:
-            T, d1, d2 = fl['mov'].shape
-
-    elif extension == '.h5':
-        with h5py.File(fname) as fl:
-            if 'imaging' in fl.keys():
-                T, _, d1, d2, _ = fl['imaging'].shape
-            else:
-                raise Exception(
-                    'Unsupported file key for for h5 files in parallel motion correction')
-    else:
-        raise Exception(
-            'Unsupported file extension for parallel motion correction')
-
+    is_fiji = False
+    dims, T = get_file_size(fname)
     if type(splits) is int:
         if subidx is None:
             rng = range(T)
@@ -2517,9 +4025,8 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
     if template is None:
         raise Exception('Not implemented')
 
-    shape_mov = (d1 * d2, T)
+    shape_mov = (np.prod(dims), T)
 
-    dims = d1, d2
     if num_splits is not None:
         idxs = np.array(idxs)[np.random.randint(0, len(idxs), num_splits)]
         save_movie = False
@@ -2540,7 +4047,8 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
     for idx in idxs:
         pars.append([fname, fname_tot, idx, shape_mov, template, strides, overlaps, max_shifts, np.array(
             add_to_movie, dtype=np.float32), max_deviation_rigid, upsample_factor_grid,
-            newoverlaps, newstrides, shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan])
+            newoverlaps, newstrides, shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan, batch_size, pyramid_levels, compute_metrics,
+            frames_per_bin])
 
     if dview is not None:
         print('** Starting parallel motion correction **')
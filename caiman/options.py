@@ -156,6 +156,7 @@ def Params(Y, K=30, gSig=[5, 5], ssub=2, tsub=2, p=1, p_ssub=2, p_tsub=2,
             'nnls_L0'. Nonnegative least square with L0 penalty
             'lasso_lars' lasso lars function from scikit learn
             'lasso_lars_old' lasso lars from old implementation, will be deprecated
+            'hals' block coordinate descent updating all the footprints of a block of pixels at once
 
         TEMPORAL PARAMS###########
 
@@ -34,10 +34,10 @@ from .pre_processing import preprocess_data
 from .initialization import initialize_components, imblur
 from .merging import merge_components
 from .spatial import update_spatial_components
-from .temporal import update_temporal_components, constrained_foopsi_parallel
+from .temporal import update_temporal_components, constrained_foopsi_block
 from caiman.components_evaluation import estimate_components_quality_auto, select_components_from_metrics
 from .map_reduce import run_CNMF_patches
-from .oasis import OASIS
+from .oasis import OASIS, fit_batch, fit_next_batch
 import caiman
 from caiman import components_evaluation, mmapping
 import cv2
@@ -48,6 +48,7 @@ import psutil
 import pylab as pl
 from time import time
 import logging
+import multiprocessing
 import sys
 
 try:
@@ -97,7 +98,7 @@ class CNMF(object):
                  center_psf=False, use_dense=True, deconv_flag=True,
                  simultaneously=False, n_refit=0, del_duplicates=False, N_samples_exceptionality=5,
                  max_num_added=1, min_num_trial=2, thresh_CNN_noisy=0.99,
-                 ssub_B=2, init_iter=2):
+                 ssub_B=2, init_iter=2, multiscale=False):
         """
         Constructor of the CNMF method
 
@@ -257,6 +258,10 @@ class CNMF(object):
         init_iter: int, optional
             number of iterations for 1-photon imaging initialization
 
+        multiscale: bool, optional
+            if True the components found on spatially downsampled data (ssub > 1) are refined
+            up a resolution pyramid, only within their bounding boxes
+
         Returns:
         --------
         self
@@ -350,7 +355,7 @@ class CNMF(object):
                                     rolling_sum=self.rolling_sum,
                                     min_corr=min_corr, min_pnr=min_pnr,
                                     ring_size_factor=ring_size_factor, center_psf=center_psf,
-                                    ssub_B=ssub_B, init_iter=init_iter)
+                                    ssub_B=ssub_B, init_iter=init_iter, multiscale=multiscale)
         self.options['merging']['thr'] = merge_thresh
         self.options['temporal_params']['s_min'] = s_min
         
@@ -654,6 +659,156 @@ class CNMF(object):
 
         return self
 
+    def fit_more(self, images, n_iter=1, search_residual=False, max_new_comps=None):
+        """
+        Warm-started refit of an already fitted object on additional frames (e.g. a new session of the same FOV)
+
+        The temporal components of the new frames are initialized by projecting the data on the current
+        spatial components and background, then n_iter rounds of temporal and spatial updates are run on the
+        new frames only, followed by a final temporal update. Patches, initialization and merging are skipped.
+
+        Parameters:
+        ----------
+        images : mapped np.ndarray of shape (t,x,y[,z]) containing the new frames only.
+            Same FOV (and C order) as the data passed to fit
+
+        n_iter: int
+            number of alternating temporal/spatial updates
+
+        search_residual: bool
+            whether to look for new components in the new frames after the last spatial update, once the
+            current neurons are subtracted (the background is kept for the initialization, which estimates
+            it again). Needs n_iter >= 1, the residual movie is held in memory
+
+        max_new_comps: int
+            maximum number of new components. None uses options['init_params']['K']
+
+        Returns:
+        --------
+        self: with A, b updated and C, f, S, YrA, bl, c1, neurons_sn, g referring to the new frames.
+            self.idx_previous gives for each component its index before the call (-1 for new components),
+            components whose footprint or trace vanished are removed
+
+        Raise:
+        ------
+        Exception('You need to fit the object before calling fit_more')
+
+        Exception('The file is in F order, it should be in C order (see save_memmap function')
+
+        ValueError('search_residual needs at least one spatial update (n_iter >= 1)')
+        """
+        if self.A is None or self.C is None:
+            raise Exception('You need to fit the object before calling fit_more')
+        if search_residual and n_iter < 1:
+            raise ValueError('search_residual needs at least one spatial update (n_iter >= 1)')
+
+        T = images.shape[0]
+        dims = images.shape[1:]
+        Yr = np.transpose(np.reshape(images, (T, -1), order='F'))
+        if np.isfortran(Yr):
+            raise Exception('The file is in F order, it should be in C order (see save_memmap function')
+        try:
+            Yr.filename = images.filename
+        except AttributeError:  # if no memmapping cause working with small data
+            pass
+
+        # the parameters of the fit are kept, the ones of the new frames only apply to this call
+        options = {key: dict(params) for key, params in self.options.items()}
+        options['spatial_params']['dims'] = dims
+        options['spatial_params']['medw'] = (3,) * len(dims)
+        options['spatial_params']['se'] = np.ones((3,) * len(dims), dtype=np.uint8)
+        options['spatial_params']['ss'] = np.ones((3,) * len(dims), dtype=np.uint8)
+        if self.n_pixels_per_process is None:
+            self.n_pixels_per_process = np.int(np.prod(dims) // self.n_processes)
+        options['spatial_params']['n_pixels_per_process'] = self.n_pixels_per_process
+        options['preprocess_params']['n_pixels_per_process'] = self.n_pixels_per_process
+        options['temporal_params']['block_size'] = self.block_size
+        options['temporal_params']['num_blocks_per_run'] = self.num_blocks_per_run
+        options['spatial_params']['block_size'] = self.block_size
+        options['spatial_params']['num_blocks_per_run'] = self.num_blocks_per_run
+
+        A = scipy.sparse.csc_matrix(self.A)
+        b = np.array(self.b.toarray() if 'sparse' in str(type(self.b)) else self.b)
+        nr = A.shape[-1]
+        idx_previous = np.arange(nr)
+
+        print('projecting the new frames on the components ...')
+        Ab = scipy.sparse.hstack((A, b)).tocsc()
+        if 'memmap' in str(type(Yr)):
+            AbY = mmapping.parallel_dot_product(Yr, Ab, dview=self.dview, block_size=self.block_size,
+                                               transpose=True, num_blocks_per_run=self.num_blocks_per_run).T
+        else:
+            AbY = np.array(Ab.T.dot(Yr))
+        Cf = np.linalg.lstsq(Ab.T.dot(Ab).toarray(), AbY, rcond=None)[0]
+        C = np.maximum(Cf[:nr], 0)
+        f = Cf[nr:]
+
+        if self.sn is not None and np.size(self.sn) == Yr.shape[0]:
+            sn = self.sn
+        else:
+            sn = preprocess_data(Yr, dview=self.dview, **options['preprocess_params'])[1]
+
+        for it in range(n_iter + 1):
+            print('update temporal ...')
+            C, A, b, f, S, bl, c1, neurons_sn, g, YrA, lam, removed = update_temporal_components(
+                Yr, A, b, C, f, dview=self.dview, bl=None, c1=None, sn=None, g=None, return_removed=True,
+                **options['temporal_params'])
+            idx_previous = np.delete(idx_previous, removed)
+            if it == n_iter:
+                break
+
+            print('update spatial ...')
+            A, b, C, f, removed = update_spatial_components(
+                Yr, C=C, f=f, A_in=A, sn=sn, b_in=b, dview=self.dview, return_removed=True,
+                **options['spatial_params'])
+            idx_previous = np.delete(idx_previous, removed)
+            A = scipy.sparse.csc_matrix(A)
+
+            if search_residual and it == n_iter - 1:
+                print('searching the residual for new components ...')
+                # Y - A*C in blocks of pixels, held in F order so that it is reshaped without a copy
+                Yres = np.zeros((np.prod(dims), T), dtype=np.float32, order='F')
+                A_rows = A.tocsr()
+                for i in range(0, Yres.shape[0], self.block_size):
+                    Yres[i:i + self.block_size] = Yr[i:i + self.block_size] - \
+                        A_rows[i:i + self.block_size].dot(C)
+                del A_rows
+                init_params = dict(options['init_params'])
+                if max_new_comps is not None:
+                    init_params['K'] = max_new_comps
+                A_new, C_new = initialize_components(
+                    Yres.reshape(dims + (T,), order='F'), sn=sn, options_total=options, **init_params)[:2]
+                del Yres
+                A = scipy.sparse.hstack((A, scipy.sparse.csc_matrix(A_new))).tocsc()
+                C = np.vstack((C, C_new))
+                idx_previous = np.concatenate((idx_previous, -np.ones(C_new.shape[0], dtype=int)))
+                print(str(C_new.shape[0]) + ' new components, updating spatial ...')
+                A, b, C, f, removed = update_spatial_components(
+                    Yr, C=C, f=f, A_in=A, sn=sn, b_in=b, dview=self.dview, return_removed=True,
+                    **options['spatial_params'])
+                idx_previous = np.delete(idx_previous, removed)
+                A = scipy.sparse.csc_matrix(A)
+
+        self.A = A
+        self.C = C
+        self.b = b
+        self.f = f
+        self.S = S
+        self.YrA = YrA
+        self.sn = sn
+        self.g = g
+        self.bl = bl
+        self.c1 = c1
+        self.neurons_sn = neurons_sn
+        self.lam = lam
+        self.dims = dims
+        self.idx_previous = idx_previous
+
+        self.A, self.C, self.YrA, self.b, self.f, self.neurons_sn = normalize_AC(
+            self.A, self.C, self.YrA, self.b, self.f, self.neurons_sn)
+
+        return self
+
     def _prepare_object(self, Yr, T, expected_comps, new_dims=None,
                         idx_components=None, g=None, lam=None, s_min=None,
                         bl=None, use_dense=True, N_samples_exceptionality=5,
@@ -754,8 +909,9 @@ class CNMF(object):
                 g2=0 if self.p < 2 else (np.ravel(g)[1] if g is not None else gam[1]))
                 for gam, l, b, sn in zip(self.g2, self.lam2, self.bl2, self.neurons_sn2)]
 
+            fit_batch(self.OASISinstances,
+                      self.noisyC[self.gnb:self.gnb + len(self.OASISinstances), :self.initbatch])
             for i, o in enumerate(self.OASISinstances):
-                o.fit(self.noisyC[i + self.gnb, :self.initbatch])
                 self.C_on[i, :self.initbatch] = o.c
         else:
             self.C_on[:self.N, :self.initbatch] = self.C2
@@ -881,10 +1037,8 @@ class CNMF(object):
                 frame, self.Ab, C_in, self.AtA, iters=num_iters_hals, groups=self.groups)
             if self.p:
                 # denoise & deconvolve
-                for i, o in enumerate(self.OASISinstances):
-                    o.fit_next(self.noisyC[nb_ + i, t])
-                    self.C_on[nb_ + i, t - o.get_l_of_last_pool() +
-                              1: t + 1] = o.get_c_of_last_pool()
+                fit_next_batch(self.OASISinstances, self.noisyC[nb_:nb_ + len(self.OASISinstances), t],
+                               C=self.C_on, t=t, row_offset=nb_)
 
         else:
             # update buffer, initialize C with previous value
@@ -1294,9 +1448,19 @@ class CNMF(object):
         return self
 
     def deconvolve(self, p=None, method=None, bas_nonneg=None,
-                   noise_method=None, optimize_g=0, s_min=None, **kwargs):
+                   noise_method=None, optimize_g=0, s_min=None, fixed_params=False, n_threads=1, **kwargs):
         """Performs deconvolution on already extracted traces using
         constrained foopsi.
+
+        Parameters:
+        -----------
+        fixed_params: bool
+            keep the baselines, time constants, noise levels and sparsity penalties of a previous
+            fit or deconvolution and only deconvolve the traces again
+
+        n_threads: int
+            number of threads deconvolving a block of traces. For OASIS with p=1 or p=2, without
+            s_min and optimize_g, the traces of each block are deconvolved at once, without the GIL
         """
 
         p = self.p if p is None else p
@@ -1318,29 +1482,45 @@ class CNMF(object):
         args['noise_range'] = self.options['temporal_params']['noise_range']
         args['fudge_factor'] = self.options['temporal_params']['fudge_factor']
 
-        args_in = [(F[jj], None, jj, None, None, None, None,
-                    args) for jj in range(F.shape[0])]
+        # blocks of traces, whose noise levels and time constants are estimated at once
+        if 'multiprocessing' in str(type(self.dview)):
+            # a pool does not expose its size, setup_cluster starts one worker per core
+            n_workers = multiprocessing.cpu_count()
+        elif self.dview is not None:
+            n_workers = len(self.dview)
+        else:
+            n_workers = 1
+        blocks = np.array_split(np.arange(F.shape[0]), min(F.shape[0], 4 * n_workers))
+        if fixed_params:
+            if any(getattr(self, key, None) is None for key in ('bl', 'g', 'neurons_sn', 'lam')):
+                raise Exception('fixed_params requires the parameters of a previous fit or deconvolution')
+            args_in = [(F[jjs].T, jjs, args, [self.bl[j] for j in jjs], [self.g[j] for j in jjs],
+                        [self.neurons_sn[j] for j in jjs], [self.lam[j] for j in jjs], n_threads)
+                       for jjs in blocks]
+        else:
+            args_in = [(F[jjs].T, jjs, args, n_threads) for jjs in blocks]
 
         if 'multiprocessing' in str(type(self.dview)):
             results = self.dview.map_async(
-                constrained_foopsi_parallel, args_in).get(4294967)
+                constrained_foopsi_block, args_in).get(4294967)
         elif self.dview is not None:
-            results = self.dview.map_sync(constrained_foopsi_parallel, args_in)
+            results = self.dview.map_sync(constrained_foopsi_block, args_in)
         else:
-            results = list(map(constrained_foopsi_parallel, args_in))
+            results = list(map(constrained_foopsi_block, args_in))
+        results = [chunk for block in results for chunk in block]
 
         if sys.version_info >= (3, 0):
             results = list(zip(*results))
         else:  # python 2
             results = zip(*results)
 
-        order = list(results[7])
+        order = np.argsort(results[7])
         self.C = np.stack([results[0][i] for i in order])
         self.S = np.stack([results[1][i] for i in order])
         self.bl = [results[3][i] for i in order]
         self.c1 = [results[4][i] for i in order]
-        self.g = [results[5][i] for i in order]
-        self.neuron_sn = [results[6][i] for i in order]
+        self.neurons_sn = [results[5][i] for i in order]
+        self.g = [results[6][i] for i in order]
         self.lam = [results[8][i] for i in order]
         self.YrA = F - self.C
         return self
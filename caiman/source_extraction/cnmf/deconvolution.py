@@ -945,6 +945,203 @@ def constrained_oasisAR2(y, g, sn, optimize_b=True, b_nonneg=True, optimize_g=0,
     return c, s, b, g, lam
 
 
+def oasis_batch(Y, g, lam, b=0, n_threads=1):
+    """ Sparse non-negative deconvolution of many traces at once with OASIS
+
+    Solves for each row y of Y, with its own AR coefficients, sparsity penalty and baseline,
+    min 1/2|c-y+b|^2 + lam |s|_1 subject to s_t = c_t-g1 c_{t-1}-g2 c_{t-2} >= 0
+    as oasisAR1 and onnls do. The traces are fitted and constructed without the GIL,
+    see oasis.fit_batch.
+
+    Parameters:
+    ----------
+    Y : array, shape (N, T)
+        Fluorescence traces.
+
+    g : array, shape (N,) or (N, p)
+        Parameters of the AR(1) or AR(2) process of each trace.
+
+    lam : float or array, shape (N,)
+        Sparsity penalty parameter of each trace.
+
+    b : float or array, shape (N,), optional, default 0
+        Baseline of each trace.
+
+    n_threads : int, optional, default 1
+        Number of threads among which the traces are split.
+
+    Returns:
+    -------
+    oases : list of OASIS
+        The fitted OASIS instances.
+
+    C : array of float32, shape (N, T)
+        The inferred denoised fluorescence signals.
+    """
+    from caiman.source_extraction.cnmf.oasis import OASIS, fit_batch, get_c_batch
+    Y = np.array(Y, dtype=np.float32)
+    N, T = Y.shape
+    g = np.reshape(np.asarray(g, dtype=np.float32), (N, -1))
+    lam = np.broadcast_to(np.asarray(lam, dtype=np.float32), (N,))
+    b = np.broadcast_to(np.asarray(b, dtype=np.float32), (N,))
+    g2 = g[:, 1] if g.shape[1] > 1 else np.zeros(N, dtype=np.float32)
+    # OASIS penalizes lam (1-g1-g2) |c|_1, correct the last two time points for |s|_1
+    Y[:, -1] -= lam * (g[:, 0] + g2)
+    if T > 1:
+        Y[:, -2] -= lam * g2
+    oases = fit_batch([OASIS(g[n, 0], lam=lam[n], b=b[n], g2=g2[n]) for n in range(N)],
+                      Y, n_threads)
+    return oases, get_c_batch(oases, T, n_threads)
+
+
+def _constrained_oasisAR1_batch(Y, g, sn, b_nonneg=True, max_iter=5, n_threads=1):
+    """ constrained_oasisAR1 with optimize_b for many traces at once, see constrained_oasis_batch
+    """
+    from caiman.source_extraction.cnmf.oasis import get_c_batch, get_shift_derivative_batch, shift_batch
+    N, T = Y.shape
+    thresh = sn * sn * T
+    b = np.percentile(Y, 15, axis=1)
+    if b_nonneg:
+        b = np.maximum(b, 0)
+    lam = np.zeros(N)
+    oases, C = oasis_batch(Y, g, lam, b, n_threads)
+    # update b and lam
+    db = np.maximum(np.mean(Y - C, 1), 0 if b_nonneg else -np.inf) - b
+    b += db
+    lam -= db / (1 - g)
+    C = get_c_batch(shift_batch(oases, db, -db / (1 - g), n_threads), T, n_threads)
+    todo = np.arange(N)
+    for _ in range(max_iter):
+        res = Y[todo] - b[todo, None] - C[todo]
+        RSS = np.sum(res * res, 1)
+        # until noise constraint is tight or spike train is empty
+        keep = ((np.abs(RSS - thresh[todo]) > thresh[todo] * 1e-4) &
+                (C[todo].sum(1) > 1e-9))
+        todo, res, RSS = todo[keep], res[keep], RSS[keep]
+        if len(todo) == 0:
+            break
+        oases_todo = [oases[n] for n in todo]
+        # calc total shift dphi due to contribution of baseline and lambda
+        tmp = get_shift_derivative_batch(oases_todo, T, n_threads)
+        tmp -= tmp.mean(1)[:, None]
+        aa = np.sum(tmp * tmp, 1)
+        bb = np.sum(res * tmp, 1)
+        cc = RSS - thresh[todo]
+        disc = bb * bb - aa * cc
+        dphi = np.where(disc > 0, -bb + np.sqrt(np.maximum(disc, 0)), -bb) / np.maximum(aa, 1e-12)
+        if b_nonneg:
+            dphi = np.maximum(dphi, -b[todo] / (1 - g[todo]))
+        b[todo] += dphi * (1 - g[todo])
+        shift_batch(oases_todo, dphi * (1 - g[todo]), np.zeros(len(todo)), n_threads)
+        C[todo] = get_c_batch(oases_todo, T, n_threads)
+        # update b and lam
+        db = np.maximum(np.mean(Y[todo] - C[todo], 1), 0 if b_nonneg else -np.inf) - b[todo]
+        b[todo] += db
+        lam[todo] -= db / (1 - g[todo])
+        shift_batch(oases_todo, db, -db / (1 - g[todo]), n_threads)
+        C[todo] = get_c_batch(oases_todo, T, n_threads)
+    return C, b, lam
+
+
+def constrained_oasis_batch(Y, g, sn, b_nonneg=True, max_iter=5, decimate=5, n_threads=1):
+    """ Infer the spike trains underlying many AR(1) or AR(2) fluorescence traces at once
+
+    Solves for each row y of Y the noise constrained sparse non-negative deconvolution problem
+    min |s|_1 subject to |c-y+b|^2 = sn^2 T and s_t = c_t-g1 c_{t-1}-g2 c_{t-2} >= 0
+    with optimized baseline b, as constrained_oasisAR1 and constrained_oasisAR2 do with
+    optimize_b=True, but updating the baselines and sparsity penalties of all traces
+    together and fitting them with oasis_batch.
+    For AR(2) the baseline and penalty are estimated with the AR(1) solver on decimated data
+    and a single AR(2) pass is run, as constrained_oasisAR2 does by default.
+
+    Parameters:
+    ----------
+    Y : array, shape (N, T)
+        Fluorescence traces.
+
+    g : array, shape (N, p)
+        Parameters of the AR(p) process of each trace, p = 1 or 2.
+
+    sn : array, shape (N,)
+        Standard deviation of the noise of each trace.
+
+    b_nonneg: bool, optional, default True
+        Enforce strictly non-negative baseline if True.
+
+    max_iter : int, optional, default 5
+        Maximal number of iterations of the AR(1) solver.
+
+    decimate : int, optional, default 5
+        Decimation factor for estimating the AR(2) hyper-parameters on decimated data.
+
+    n_threads : int, optional, default 1
+        Number of threads among which the traces are split.
+
+    Returns:
+    -------
+    C : array, shape (N, T)
+        The inferred denoised fluorescence signals.
+
+    S : array, shape (N, T)
+        Discretized deconvolved neural activity (spikes).
+
+    b : array, shape (N,)
+        Fluorescence baseline values.
+
+    lam : array, shape (N,)
+        Sparsity penalty parameters lambda of the dual problems.
+    """
+    Y = np.asarray(Y, dtype=np.float32)
+    N, T = Y.shape
+    g = np.reshape(np.asarray(g, dtype=np.float64), (N, -1))
+    sn = np.asarray(sn, dtype=np.float64)
+    if g.shape[1] == 1:
+        C, b, lam = _constrained_oasisAR1_batch(Y, g[:, 0], sn, b_nonneg, max_iter, n_threads)
+    elif g.shape[1] == 2:
+        d = (g[:, 0] + np.sqrt(g[:, 0] * g[:, 0] + 4 * g[:, 1])) / 2
+        decimate = max(1, min(decimate, T // 2))
+        # get initial estimate of b and lam on downsampled data using AR1 model
+        _, b, lam = _constrained_oasisAR1_batch(
+            Y[:, :T // decimate * decimate].reshape(N, -1, decimate).mean(2),
+            d**decimate, sn / sqrt(decimate), b_nonneg, max_iter, n_threads)
+        f_lam = 1 - g[:, 0] - g[:, 1]
+        lam *= (1 - d**decimate) / f_lam
+        C = oasis_batch(Y, g, lam, b, n_threads)[1]
+        # update b and lam
+        db = np.maximum(np.mean(Y - C, 1), 0 if b_nonneg else -np.inf) - b
+        b += db
+        lam -= db / f_lam
+    else:
+        raise Exception('OASIS is currently only implemented for p=1 and p=2')
+    return C, ar_innovations(C, g), b, lam
+
+
+def ar_innovations(C, g):
+    """ Discretized neural activity s_t = c_t-g1 c_{t-1}-...-gp c_{t-p} of many traces
+
+    Parameters:
+    ----------
+    C : array, shape (N, T)
+        Denoised fluorescence traces.
+
+    g : array, shape (N, p)
+        Parameters of the AR(p) process of each trace.
+
+    Returns:
+    -------
+    S : array, shape (N, T)
+        Deconvolved neural activity, 0 at the first time step, where the initial
+        calcium of the traces is not attributed to spikes.
+    """
+    C = np.asarray(C)
+    g = np.reshape(g, (len(C), -1))
+    S = C.copy()
+    S[:, 0] = 0
+    for k in range(g.shape[1]):
+        S[:, k + 1:] -= g[:, k:k + 1] * C[:, :C.shape[1] - k - 1]
+    return S
+
+
 def estimate_parameters(fluor, p=2, sn=None, g=None, range_ff=[0.25, 0.5],
                         method='logmexp', lags=5, fudge_factor=1.):
     """
@@ -953,6 +1150,10 @@ def estimate_parameters(fluor, p=2, sn=None, g=None, range_ff=[0.25, 0.5],
     Parameters:
     -----------
 
+    fluor: np.ndarray
+        fluorescence trace, or two dimensional array with one trace per row (all the traces are
+        estimated at once)
+
     p: positive integer
         order of AR system
 
@@ -977,7 +1178,7 @@ def estimate_parameters(fluor, p=2, sn=None, g=None, range_ff=[0.25, 0.5],
 
     if g is None:
         if p == 0:
-            g = np.array(0)
+            g = np.array(0) if np.ndim(fluor) == 1 else np.zeros((len(fluor), 0))
         else:
             g = estimate_time_constant(fluor, p, sn, lags, fudge_factor)
 
@@ -988,18 +1189,21 @@ def estimate_time_constant(fluor, p=2, sn=None, lags=5, fudge_factor=1.):
     """
     Estimate AR model parameters through the autocovariance function
 
+    The autocovariances of all the traces are computed in one FFT pass and all the Yule-Walker
+    systems are solved at once.
+
     Inputs:
     --------
 
     fluor        : nparray
         One dimensional array containing the fluorescence intensities with
-        one entry per time-bin.
+        one entry per time-bin, or two dimensional array with one trace per row.
 
     p            : positive integer
         order of AR system
 
     sn           : float
-        noise standard deviation, estimated if not provided.
+        noise standard deviation (one per trace), estimated if not provided.
 
     lags         : positive integer
         number of additional lags where he autocovariance is computed
@@ -1010,27 +1214,35 @@ def estimate_time_constant(fluor, p=2, sn=None, lags=5, fudge_factor=1.):
     Returns:
     -----------
 
-    g       : estimated coefficients of the AR process
+    g       : estimated coefficients of the AR process (p, or number of traces x p)
     """
 
     if sn is None:
         sn = GetSn(fluor)
 
     lags += p
-    xc = axcov(fluor, lags)
-    xc = xc[:, np.newaxis]
-
-    A = scipy.linalg.toeplitz(xc[lags + np.arange(lags)],
-                              xc[lags + np.arange(p)]) - sn**2 * np.eye(lags, p)
-    g = np.linalg.lstsq(A, xc[lags + 1:])[0]
-    gr = np.roots(np.concatenate([np.array([1]), -g.flatten()]))
-    gr = old_div((gr + gr.conjugate()), 2.)
+    xc = np.atleast_2d(axcov(fluor, lags))
+    K = xc.shape[0]
+
+    # Toeplitz matrices of the autocovariances, A[k, i, j] = xc[k, lags + |i - j|]
+    A = xc[:, lags + np.abs(np.arange(lags)[:, None] - np.arange(p))] - \
+        np.reshape(np.asarray(sn, dtype=float)**2, (-1, 1, 1)) * np.eye(lags, p)
+    g = np.matmul(np.linalg.pinv(A), xc[:, lags + 1:, None])[..., 0]
+    # roots of the AR polynomials as eigenvalues of their companion matrices
+    companion = np.zeros((K, p, p))
+    companion[:, 0] = g
+    companion[:, np.arange(1, p), np.arange(p - 1)] = 1
+    gr = np.real(np.linalg.eigvals(companion))
     gr[gr > 1] = 0.95 + np.random.normal(0, 0.01, np.sum(gr > 1))
     gr[gr < 0] = 0.15 + np.random.normal(0, 0.01, np.sum(gr < 0))
-    g = np.poly(fudge_factor * gr)
-    g = -g[1:]
+    # coefficients of the polynomials with the shrunk roots
+    g = np.zeros((K, p + 1))
+    g[:, 0] = 1
+    for j in range(p):
+        g[:, 1:j + 2] -= fudge_factor * gr[:, j, None] * g[:, :j + 1]
+    g = -g[:, 1:]
 
-    return g.flatten()
+    return g.flatten() if np.ndim(fluor) == 1 else g
 
 
 def GetSn(fluor, range_ff=[0.25, 0.5], method='logmexp'):
@@ -1042,7 +1254,7 @@ def GetSn(fluor, range_ff=[0.25, 0.5], method='logmexp'):
 
     fluor    : nparray
         One dimensional array containing the fluorescence intensities with
-        one entry per time-bin.
+        one entry per time-bin, or two dimensional array with one trace per row.
 
     range_ff : (1,2) array, nonnegative, max value <= 0.5
         range of frequency (x Nyquist rate) over which the spectrum is averaged  
@@ -1052,18 +1264,18 @@ def GetSn(fluor, range_ff=[0.25, 0.5], method='logmexp'):
 
     Returns:
     -----------
-    sn       : noise standard deviation
+    sn       : noise standard deviation (one per trace)
     """
 
     ff, Pxx = scipy.signal.welch(fluor)
     ind1 = ff > range_ff[0]
     ind2 = ff < range_ff[1]
     ind = np.logical_and(ind1, ind2)
-    Pxx_ind = Pxx[ind]
+    Pxx_ind = Pxx[..., ind]
     sn = {
-        'mean': lambda Pxx_ind: np.sqrt(np.mean(old_div(Pxx_ind, 2))),
-        'median': lambda Pxx_ind: np.sqrt(np.median(old_div(Pxx_ind, 2))),
-        'logmexp': lambda Pxx_ind: np.sqrt(np.exp(np.mean(np.log(old_div(Pxx_ind, 2)))))
+        'mean': lambda Pxx_ind: np.sqrt(np.mean(old_div(Pxx_ind, 2), -1)),
+        'median': lambda Pxx_ind: np.sqrt(np.median(old_div(Pxx_ind, 2), -1)),
+        'logmexp': lambda Pxx_ind: np.sqrt(np.exp(np.mean(np.log(old_div(Pxx_ind, 2)), -1)))
     }[method](Pxx_ind)
 
     return sn
@@ -1076,7 +1288,7 @@ def axcov(data, maxlag=5):
     Parameters:
     ----------
     data : array
-        Array containing fluorescence data
+        Array containing fluorescence data (one trace per row if two dimensional)
 
     maxlag : int
         Number of lags to use in autocovariance calculation
@@ -1084,17 +1296,15 @@ def axcov(data, maxlag=5):
     Returns:
     -------
     axcov : array
-        Autocovariances computed from -maxlag:0:maxlag
+        Autocovariances computed from -maxlag:0:maxlag (along the last axis)
     """
 
-    data = data - np.mean(data)
-    T = len(data)
-    bins = np.size(data)
-    xcov = np.fft.fft(data, np.power(2, nextpow2(2 * bins - 1)))
-    xcov = np.fft.ifft(np.square(np.abs(xcov)))
-    xcov = np.concatenate([xcov[np.arange(xcov.size - maxlag, xcov.size)],
-                           xcov[np.arange(0, maxlag + 1)]])
-    return np.real(old_div(xcov, T))
+    data = data - np.mean(data, axis=-1, keepdims=True)
+    T = np.shape(data)[-1]
+    n_fft = np.power(2, nextpow2(2 * T - 1))
+    xcov = np.fft.irfft(np.square(np.abs(np.fft.rfft(data, n_fft))), n_fft)
+    xcov = np.concatenate([xcov[..., n_fft - maxlag:], xcov[..., :maxlag + 1]], axis=-1)
+    return old_div(xcov, T)
 
 
 def nextpow2(value):
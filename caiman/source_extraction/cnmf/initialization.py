@@ -34,6 +34,8 @@ from caiman.source_extraction.cnmf.pre_processing import get_noise_fft, get_nois
 from caiman.source_extraction.cnmf.spatial import circular_constraint, connectivity_constraint
 import cv2
 import sys
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from sklearn.utils.extmath import randomized_svd, squared_norm
@@ -179,7 +181,8 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
                           max_iter_snmf=500, alpha_snmf=10e2, sigma_smooth_snmf=(.5, .5, .5),
                           perc_baseline_snmf=20, options_local_NMF=None, rolling_sum=False,
                           rolling_length=100, sn=None, options_total=None, min_corr=0.8, min_pnr=10,
-                          ring_size_factor=1.5, center_psf=False, ssub_B=2, init_iter=2, remove_baseline = True):
+                          ring_size_factor=1.5, center_psf=False, ssub_B=2, init_iter=2, remove_baseline = True,
+                          multiscale=False):
     """
     Initalize components
 
@@ -269,6 +272,12 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
     init_iter: int, optional
         number of iterations for 1-photon imaging initialization
 
+    multiscale: bool, optional
+        if True (and ssub > 1) the components found on the downsampled data are not simply
+        upsampled, but refined up a resolution pyramid with rank-1 HALS steps on the pixels
+        of their bounding boxes (see refine_multiscale). Used by 'greedy_roi', 'sparse_nmf',
+        'pca_ica' and 'corr_pnr'.
+
     Returns:
     --------
 
@@ -355,7 +364,7 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
         Ain, Cin, _, b_in, f_in, extra_1p = greedyROI_corr(
             Y, Y_ds, max_number=K, gSiz=gSiz[0], gSig=gSig[0], min_corr=min_corr, min_pnr=min_pnr,
             ring_size_factor=ring_size_factor, center_psf=center_psf, options=options_total,
-            sn=sn, nb=nb, ssub=ssub, ssub_B=ssub_B, init_iter=init_iter)
+            sn=sn, nb=nb, ssub=ssub, ssub_B=ssub_B, init_iter=init_iter, multiscale=multiscale)
 
     elif method == 'sparse_nmf':
         Ain, Cin, _, b_in, f_in = sparseNMF(
@@ -401,8 +410,9 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
         raise Exception("Unsupported method")
 
     K = np.shape(Ain)[-1]
+    multiscale = multiscale and ssub > 1 and Ain.size > 0 and not center_psf
 
-    if Ain.size > 0 and not center_psf:
+    if Ain.size > 0 and not center_psf and not multiscale:
 
         Ain = np.reshape(Ain, ds + (K,), order='F')
 
@@ -436,6 +446,12 @@ def initialize_components(Y, K=30, gSig=[5, 5], gSiz=None, ssub=1, tsub=1, nIter
     if Ain.size > 0:
         Cin = resize(Cin.astype(float), [K, T])
 
+        if multiscale:
+            print('Multiscale Refinement...')
+            Ain, Cin = refine_multiscale(Y, Ain, Cin, ds, b=b_in if nb != 0 else None,
+                                         f=f_in, maxIter=maxIter)
+            Ain = Ain.toarray()
+
         center = np.asarray(
             [center_of_mass(a.reshape(d, order='F')) for a in Ain.T])
     else:
@@ -966,13 +982,162 @@ def hals(Y, A, C, b, f, bSiz=3, maxIter=5):
 
     return Ab[:, :-nb], Cf[:-nb], Ab[:, -nb:], Cf[-nb:].reshape(nb, -1)
 
+#%%
+
+
+def refine_multiscale(Y, A, C, ds, b=None, f=None, bSiz=3, maxIter=3):
+    """ Refine footprints found on spatially downsampled data up a resolution pyramid
+
+    The downsampling factor is halved at each level until full resolution is reached. At each
+    level every footprint is upsampled and then refined, together with its trace, by a few
+    rank-1 HALS steps that only use the pixels in the bounding box of the footprint, after
+    removing the background and the overlapping components from them.
+
+    Parameters:
+    ----------
+    Y: np.ndarray or np.memmap
+        d1 x d2 [x d3] x T movie at full resolution. Only the bounding boxes of the
+        components are read.
+
+    A: np.ndarray or sparse matrix
+        (ds1*ds2[*ds3]) x K, footprints on the downsampled grid
+
+    C: np.ndarray
+        K x T, temporal components at full temporal resolution
+
+    ds: tuple
+        shape of the downsampled grid (ds1, ds2[, ds3])
+
+    b: np.ndarray, optional
+        (d1*d2[*d3]) x nb, spatial background at full resolution
+
+    f: np.ndarray, optional
+        nb x T, temporal background
+
+    bSiz: int
+        the support of each upsampled footprint is dilated by a box of this size
+        (in pixels of the current level) to define the pixels that are updated
+
+    maxIter: int
+        number of rank-1 HALS iterations per component and level
+
+    Returns:
+    --------
+    A: scipy.sparse.csc_matrix
+        (d1*d2[*d3]) x K, refined spatial components
+
+    C: np.ndarray
+        K x T, refined temporal components
+    """
+    d, T = Y.shape[:-1], Y.shape[-1]
+    A = spr.csc_matrix(A)
+    C = np.array(C, dtype=np.float32)
+    K = A.shape[-1]
+    if b is not None and b.shape[-1] == 0:
+        b = None
+    if f is not None and spr.issparse(f):
+        f = f.toarray()
+    idx_full = np.arange(np.prod(d)).reshape(d, order='F')
+    # grid spacing (in pixels of the full resolution) of the current footprints
+    step = np.array(d, dtype=float) / np.array(ds)
+    # each footprint is stored as (offset, image) of its bounding box on the current grid
+    boxes = []
+    for k in range(K):
+        rows = A.indices[A.indptr[k]:A.indptr[k + 1]]
+        if len(rows) == 0:
+            boxes.append(None)
+            continue
+        coords = np.array(np.unravel_index(rows, ds, order='F'))
+        lo = coords.min(1)
+        img = np.zeros(coords.max(1) - lo + 1, dtype=np.float32)
+        img[tuple(coords - lo[:, None])] = A.data[A.indptr[k]:A.indptr[k + 1]]
+        boxes.append((lo, img))
+
+    def stack(boxes, idx):
+        """ sparse matrix of the footprints (idx are the indices of the pixels of the grid)
+        and for each component the positions of its pixels in the data of the matrix """
+        kk = [k for k, box in enumerate(boxes) if box is not None]
+        ind = [idx[tuple(slice(l, l + n) for l, n in zip(boxes[k][0], boxes[k][1].shape))].ravel(order='F')
+               for k in kk]
+        nnz = [len(i) for i in ind]
+        A = spr.csr_matrix((np.arange(1, sum(nnz) + 1),
+                            (np.concatenate(ind + [[]]).astype(int), np.repeat(kk, nnz).astype(int))),
+                           shape=(idx.size, K))
+        pos = np.empty(sum(nnz), dtype=int)
+        pos[A.data - 1] = np.arange(len(pos))
+        A.data = np.concatenate([boxes[k][1].ravel(order='F') for k in kk] + [[]])[A.data - 1]
+        return A, dict(zip(kk, np.split(pos, np.cumsum(nnz)[:-1])))
+
+    scales = [max(int(round(step.max())) // 2, 1)]
+    while scales[-1] > 1:
+        scales.append(scales[-1] // 2)
+
+    for s in scales:
+        dl = tuple((np.array(d) - 1) // s + 1)
+        idx_level = np.arange(np.prod(dl)).reshape(dl, order='F')
+        margin = (bSiz + 1) * s + int(np.ceil(step.max()))
+        # upsample the footprints to the grid of this level
+        new_boxes = []
+        for lo, img in filter(None, boxes):
+            nz = np.array(np.nonzero(img)) + lo[:, None]
+            lo_f = np.maximum((nz.min(1) * step).astype(int) - margin, 0)
+            hi_f = np.minimum(np.ceil((nz.max(1) + 1) * step).astype(int) + margin, d)
+            L, H = lo_f // s, (hi_f - 1) // s + 1
+            # positions of the new pixels on the previous grid, relative to the zero padded box
+            pos = [(np.arange(l, h) + .5) * s / st - .5 - o + 1
+                   for l, h, st, o in zip(L, H, step, lo)]
+            img = nd.map_coordinates(np.pad(img, 1, mode='constant'),
+                                     np.meshgrid(*pos, indexing='ij'), order=1, mode='nearest')
+            new_boxes.append((L, np.maximum(img, 0)))
+        new_boxes = iter(new_boxes)
+        boxes = [None if box is None else next(new_boxes) for box in boxes]
+
+        A_l, pos = stack(boxes, idx_level)
+        # rank-1 HALS on the pixels of each bounding box
+        for k in [k for k, box in enumerate(boxes) if box is not None]:
+            L, img = boxes[k]
+            sl = tuple(slice(l * s, min((l + n) * s, dd)) for l, n, dd in zip(L, img.shape, d))
+            Yb = np.array(Y[sl + (slice(None),)], dtype=np.float32)
+            if s > 1:
+                Yb = downscale(Yb, (s,) * len(d) + (1,))
+            Yb = Yb.reshape((-1, T), order='F')
+            if b is not None:
+                bb = b[idx_full[sl].ravel(order='F')].reshape(idx_full[sl].shape + (-1,), order='F')
+                if s > 1:
+                    bb = downscale(bb, (s,) * len(d) + (1,))
+                Yb -= bb.reshape((len(Yb), -1), order='F').dot(f)
+            Ab = A_l[idx_level[tuple(slice(l, l + n) for l, n in zip(L, img.shape))].ravel(order='F')]
+            others = np.setdiff1d(Ab.indices, [k])
+            if len(others):
+                Yb -= Ab[:, others].dot(C[others])
+            mask = np.ravel(nd.uniform_filter(img, size=bSiz) > 1e-10, order='F')
+            a = img.ravel(order='F')
+            c = C[k]
+            for _ in range(maxIter):
+                cc = c.dot(c)
+                if cc == 0:
+                    break
+                a = np.maximum(Yb.dot(c) / cc, 0) * mask
+                aa = a.dot(a)
+                if aa == 0:
+                    break
+                c = np.maximum(a.dot(Yb) / aa, 0)
+            C[k] = c
+            A_l.data[pos[k]] = a
+            boxes[k] = (L, a.reshape(img.shape, order='F')) if a.any() else None
+        step = np.array([float(s)] * len(d))
+
+    A = stack(boxes, idx_full)[0].tocsc()
+    A.eliminate_zeros()
+    return A, C
+
 
 @profile
 def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=True,
                    min_corr=None, min_pnr=None, seed_method='auto',
                    min_pixel=3, bd=0, thresh_init=2, ring_size_factor=None, nb=1, options=None,
                    sn=None, save_video=False, video_name='initialization.mp4', ssub=1,
-                   ssub_B=2, init_iter=2):
+                   ssub_B=2, init_iter=2, multiscale=False):
     """
     initialize neurons based on pixels' local correlations and peak-to-noise ratios.
 
@@ -1008,6 +1173,9 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
             downsampling factor for 1-photon imaging background computation
         init_iter: int, optional
             number of iterations for 1-photon imaging initialization
+        multiscale: bool, optional
+            if True (and ssub > 1) the components are brought to full resolution with
+            refine_multiscale instead of being upsampled and updated on the whole field of view
 
     Returns:
 
@@ -1039,6 +1207,7 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
     T = Y.shape[-1]
     d1, d2, total_frames = Y_ds.shape
     tsub = int(round(float(T) / total_frames))
+    multiscale = multiscale and ssub > 1
     B = Y_ds.reshape((-1, total_frames), order='F') - A.dot(C)
 
     if ring_size_factor is not None:
@@ -1141,10 +1310,15 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
             B = np.reshape(B, (d1, d2, -1), order='F')
             B = (np.repeat(np.repeat(B, ssub, 0), ssub, 1)[:dims[0], :dims[1]]
                  .reshape((-1, T), order='F'))
-            A = A.toarray().reshape((d1, d2, K), order='F')
-            A = spr.csc_matrix(np.repeat(np.repeat(A, ssub, 0), ssub, 1)[:dims[0], :dims[1]]
+            if not multiscale:
+                A = A.toarray().reshape((d1, d2, K), order='F')
+                A = spr.csc_matrix(np.repeat(np.repeat(A, ssub, 0), ssub, 1)[:dims[0], :dims[1]]
                                .reshape((np.prod(dims), K), order='F'))
         B += Y.reshape((-1, T), order='F')  # "Y-B"
+        if multiscale:
+            print('Multiscale Refinement')
+            A, C = refine_multiscale(B.reshape(dims + (T,), order='F'), A, C, (d1, d2),
+                                     maxIter=options['init_params']['maxIter'])
 
         print('Merge Components')
         A, C = caiman.source_extraction.cnmf.merging.merge_components(
@@ -1152,13 +1326,14 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
             dview=None, thr=options['merging']['thr'], mx=np.Inf, fast_merge=True)[:2]
         A = A.astype(np.float32)
         C = C.astype(np.float32)
-        print('Update Spatial')
-        options['spatial_params']['dims'] = dims
-        options['spatial_params']['se'] = np.ones((1,) * len((d1, d2)), dtype=np.uint8)
-        A, _, C, _ = caiman.source_extraction.cnmf.spatial.update_spatial_components(
-            B, C=C, f=np.zeros((0, T), np.float32), A_in=A, sn=sn,
-            b_in=np.zeros((np.prod(dims), 0), np.float32),
-            dview=None, **options['spatial_params'])
+        if not multiscale:
+            print('Update Spatial')
+            options['spatial_params']['dims'] = dims
+            options['spatial_params']['se'] = np.ones((1,) * len((d1, d2)), dtype=np.uint8)
+            A, _, C, _ = caiman.source_extraction.cnmf.spatial.update_spatial_components(
+                B, C=C, f=np.zeros((0, T), np.float32), A_in=A, sn=sn,
+                b_in=np.zeros((np.prod(dims), 0), np.float32),
+                dview=None, **options['spatial_params'])
         print('Update Temporal')
         C, A, b__, f__, S, bl, c1, neurons_sn, g1, YrA, lam__ = \
             caiman.source_extraction.cnmf.temporal.update_temporal_components(
@@ -1201,6 +1376,75 @@ def greedyROI_corr(Y, Y_ds, max_number=None, gSiz=None, gSig=None, center_psf=Tr
             (S.astype(np.float32), bl, c1, neurons_sn, g1, YrA))
 
 
+#%%
+
+
+def _neighbour_pairs(shape):
+    """ slices of the pixels p and of their neighbours q = p + offset within an image of the given
+    shape, for the four offsets that enumerate each pair of 8-neighbours once """
+    for di, dj in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        yield ((slice(0, shape[0] - di), slice(max(0, -dj), shape[1] - max(0, dj))),
+               (slice(di, shape[0]), slice(max(0, dj), shape[1] - max(0, -dj))))
+
+
+def local_correlation_moments(Y, moments=None, corner=(0, 0)):
+    """ per pixel sums, sums of squares and products with the 8 neighbouring pixels, from which the
+    local correlation image is computed exactly
+
+    Parameters:
+    ----------
+    Y: np.ndarray
+        T x d1 x d2 data
+
+    moments: tuple, optional
+        output of a previous call for the whole field of view. If given, Y is a block of it with
+        upper left pixel at corner, and the moments of the pixels and pairs in the block are
+        recomputed in place. Only the pairs within the block are updated, hence after changing the
+        data of some pixels the block should include one more pixel around them.
+
+    corner: tuple
+        position of the block in the field of view
+
+    Returns:
+    --------
+    moments: tuple
+        (sums, sums of squares, products with the neighbours for each of the 4 offsets)
+    """
+    if moments is None:
+        moments = (np.zeros(Y.shape[1:]), np.zeros(Y.shape[1:]), np.zeros((4,) + Y.shape[1:]))
+    S1, S2, N = moments
+    sl = tuple(slice(c, c + n) for c, n in zip(corner, Y.shape[1:]))
+    S1[sl] = Y.sum(0, dtype=np.float64)
+    S2[sl] = np.einsum('tij,tij->ij', Y, Y, dtype=np.float64)
+    for n, (a, b) in enumerate(_neighbour_pairs(Y.shape[1:])):
+        N[n][sl][a] = np.einsum('tij,tij->ij', Y[(slice(None),) + a], Y[(slice(None),) + b],
+                                dtype=np.float64)
+    return moments
+
+
+def local_correlation_from_moments(moments, T, rows=slice(None), cols=slice(None)):
+    """ local correlation image (as computed by local_correlations_fft with eight neighbours) of the
+    pixels in rows x cols, from the moments of local_correlation_moments """
+    d1, d2 = moments[0].shape
+    r0, r1, _ = rows.indices(d1)
+    c0, c1, _ = cols.indices(d2)
+    # one more pixel on each side, for the neighbours
+    sl = (slice(max(r0 - 1, 0), min(r1 + 1, d1)), slice(max(c0 - 1, 0), min(c1 + 1, d2)))
+    m = moments[0][sl] / T
+    sd = np.sqrt(np.maximum(moments[1][sl] / T - m**2, 0))
+    sd[sd == 0] = np.inf
+    Cn = np.zeros(m.shape)
+    num = np.zeros(m.shape)
+    for N, (a, b) in zip(moments[2][(slice(None),) + sl], _neighbour_pairs(m.shape)):
+        corr = (N[a] / T - m[a] * m[b]) / (sd[a] * sd[b])
+        Cn[a] += corr
+        Cn[b] += corr
+        num[a] += 1
+        num[b] += 1
+    Cn /= num
+    return Cn[r0 - sl[0].start:r1 - sl[0].start, c0 - sl[1].start:c1 - sl[1].start].astype(np.float32)
+
+
 @profile
 def init_neurons_corr_pnr(data, max_number=None, gSiz=15, gSig=None,
                           center_psf=True, min_corr=0.8, min_pnr=10,
@@ -1306,8 +1550,9 @@ def init_neurons_corr_pnr(data, max_number=None, gSiz=15, gSig=None,
     # remove small values and only keep pixels with large fluorescence signals
     tmp_data = np.copy(data_filtered)
     tmp_data[tmp_data < thresh_init * noise_pixel] = 0
-    # compute correlation image
-    cn = caiman.summary_images.local_correlations_fft(tmp_data, swap_dim=False)
+    # compute correlation image, keeping the moments for updating it after each neuron
+    moments = local_correlation_moments(tmp_data)
+    cn = local_correlation_from_moments(moments, total_frames)
     del(tmp_data)
 #    cn[np.isnan(cn)] = 0  # remove abnormal pixels
 
@@ -1543,27 +1788,36 @@ def init_neurons_corr_pnr(data, max_number=None, gSiz=15, gSig=None,
                     # update the filtered data
                     data_filtered[:, r2_min:r2_max, c2_min:c2_max] -= \
                         ai_filtered[np.newaxis, ...] * ci[..., np.newaxis, np.newaxis]
-                    data_filtered_box = data_filtered[:, r2_min:r2_max, c2_min:c2_max].copy()
+                    changed = ai_filtered != 0
                 else:
-                    data_filtered_box = data_raw[:, r2_min:r2_max, c2_min:c2_max].copy()
+                    changed = Ain[num_neurons, r2_min:r2_max, c2_min:c2_max] != 0
+
+                # only the pixels whose data changed (and their neighbours)
+                # need to be updated in the PNR and correlation images
+                ind_r, ind_c = np.nonzero(changed)
+                u_min = max(0, r2_min + ind_r.min() - 1)
+                u_max = min(d1, r2_min + ind_r.max() + 2)
+                v_min = max(0, c2_min + ind_c.min() - 1)
+                v_max = min(d2, c2_min + ind_c.max() + 2)
+                data_filtered_box = (data_filtered if gSig else data_raw)[
+                    :, u_min:u_max, v_min:v_max].copy()
 
                 # update PNR image
                 # data_filtered_box -= data_filtered_box.mean(axis=0)
-                max_box = np.max(data_filtered_box, axis=0)
-                noise_box = noise_pixel[r2_min:r2_max, c2_min:c2_max]
-                pnr_box = np.divide(max_box, noise_box)
+                noise_box = noise_pixel[u_min:u_max, v_min:v_max]
+                pnr[u_min:u_max, v_min:v_max] = np.divide(
+                    np.max(data_filtered_box, axis=0), noise_box)
+                pnr_box = pnr[r2_min:r2_max, c2_min:c2_max]
                 pnr_box[pnr_box < min_pnr] = 0
-                pnr[r2_min:r2_max, c2_min:c2_max] = pnr_box
 
                 # update correlation image
                 data_filtered_box[data_filtered_box <
                                   thresh_init * noise_box] = 0
-                cn_box = caiman.summary_images.local_correlations_fft(
-                    data_filtered_box, swap_dim=False)
+                local_correlation_moments(data_filtered_box, moments, (u_min, v_min))
+                cn_box = local_correlation_from_moments(
+                    moments, total_frames, slice(u_min, u_max), slice(v_min, v_max))
                 cn_box[np.isnan(cn_box) | (cn_box < 0)] = 0
-                cn[r_min:r_max, c_min:c_max] = cn_box[
-                    (r_min - r2_min):(r_max - r2_min), (c_min - c2_min):(c_max - c2_min)]
-                cn_box[cn_box < min_corr] = 0
+                cn[u_min:u_max, v_min:v_max] = cn_box
                 cn_box = cn[r2_min:r2_max, c2_min:c2_max]
 
                 # update v_search
@@ -1650,7 +1904,7 @@ def extract_ac(data_filtered, data_raw, ind_ctr, patch_dims):
 
 
 @profile
-def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1):
+def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, n_threads=None, tile_width=None):
     """compute background according to ring model
     solves the problem
         min_{W,b0} ||X-W*X|| with X = Y - A*C - b0*1'
@@ -1658,6 +1912,13 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1):
         W(i,j) = 0 for each pixel j that is not in ring around pixel i
     Problem parallelizes over pixels i
     Fluctuating background activity is W*X, constant baselines b0.
+
+    The normal equations of all pixels are formed from the correlations of X with its shifted
+    copies (one for each offset between two pixels of a ring). The field of view is processed in
+    tiles of columns of pixels: the correlations of a tile (plus the margin of its rings) are
+    accumulated from the rows of Y of the tile in a pass over chunks of frames, and the small
+    systems of its pixels are solved as soon as they are complete.
+
     Parameters:
     ----------
     Y: np.ndarray (2D or 3D)
@@ -1671,7 +1932,13 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1):
     radius: int
         radius of ring
     data_fits_in_memory: [optional] bool
-        If true, use faster but more memory consuming computation
+        If true, the rows of X of a tile are formed for all frames at once, otherwise Y (e.g. a
+        memory mapped file) is read sequentially in chunks of frames
+    n_threads: [optional] int
+        number of threads solving the blocks of pixels. None uses all the cores
+    tile_width: [optional] int
+        number of columns of (downscaled) pixels in a tile. None keeps the correlations of a tile
+        around 256MB
 
     Returns:
     --------
@@ -1688,50 +1955,139 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1):
     radius = int(round(radius / float(ssub)))
     ring = disk(radius + 1)
     ring[1:-1, 1:-1] -= disk(radius)
-    ringidx = [i - radius - 1 for i in np.nonzero(ring)]
-
-    def get_indices_of_pixels_on_ring(pixel):
-        pixel = np.unravel_index(pixel, (d1, d2), order='F')
-        x = pixel[0] + ringidx[0]
-        y = pixel[1] + ringidx[1]
+    ringidx = np.transpose(np.nonzero(ring)) - radius - 1
+    R = len(ringidx)
+
+    # offsets between two pixels of a ring (a, b) and between a pixel and its ring (rhs),
+    # each as a canonical offset delta (one of +-delta) and the pixel relative to p at which
+    # the correlation of the pair is stored
+    def canonical(delta):
+        flip = (delta[..., 0] < 0) | ((delta[..., 0] == 0) & (delta[..., 1] < 0))
+        return np.where(flip[..., None], -delta, delta), flip
+
+    delta_ab, flip_ab = canonical(ringidx[:, None] - ringidx[None])
+    anchor_ab = np.where(flip_ab[..., None], ringidx[:, None], ringidx[None])
+    delta_r, flip_r = canonical(ringidx)
+    anchor_r = np.where(flip_r[:, None], ringidx, 0)
+    deltas, k_ab = np.unique(np.concatenate([delta_ab.reshape(-1, 2), delta_r]),
+                             axis=0, return_inverse=True)
+    k_ab = k_ab.ravel()
+    k_r = k_ab[R * R:]
+    k_ab = k_ab[:R * R].reshape(R, R)
+
+    b0 = np.zeros(np.prod(dims))
+    if spr.issparse(A):
+        A = spr.csr_matrix(A)
+    A_ds = A
+    if ssub > 1 and A.size > 0:
+        A_ds = downscale(np.reshape(A.toarray() if spr.issparse(A) else A, dims + (-1,), order='F'),
+                         (ssub, ssub, 1)).reshape((d1 * d2, -1), order='F')
+    C_mean = C.mean(1)
+
+    def solve_block(XX, y0, pixels):
+        x, y = np.unravel_index(pixels, (d1, d2), order='F')
+        xx, yy = x + pad, y - y0 + pad
+        G = XX[k_ab[..., None], yy + anchor_ab[..., 1, None], xx + anchor_ab[..., 0, None]].transpose(2, 0, 1)
+        rhs = XX[k_r[:, None], yy + anchor_r[:, 1, None], xx + anchor_r[:, 0, None]].T
+        x, y = x[:, None] + ringidx[:, 0], y[:, None] + ringidx[:, 1]
         inside = (x >= 0) * (x < d1) * (y >= 0) * (y < d2)
-        return np.ravel_multi_index((x[inside], y[inside]), (d1, d2), order='F')
-
-    b0 = np.array(Y.mean(1)) - A.dot(C.mean(1))
-
-    if data_fits_in_memory:
-        if ssub == 1 and tsub == 1:
-            X = Y - A.dot(C) - b0[:, None]
-        else:
-            X = downscale(Y.reshape(dims + (-1,), order='F'),
-                          (ssub, ssub, tsub)).reshape((-1, (T - 1) // tsub + 1), order='F') - \
-                (downscale(A.reshape(dims + (-1,), order='F'),
-                           (ssub, ssub, 1)).reshape((-1, len(C)), order='F').dot(
-                    downscale(C, (1, tsub))) if A.size > 0 else 0) - \
-                downscale(b0.reshape(dims, order='F'),
-                          (ssub, ssub)).reshape((-1, 1), order='F')
-    else:
-        X = None
-
-    indices = []
-    data = []
-    indptr = [0]
-    for p in xrange(len(X)):
-        index = get_indices_of_pixels_on_ring(p)
-        indices += list(index)
-        B = Y[index] - A[index].dot(C) - \
-            b0[index, None] if X is None else X[index]
-        tmp = np.array(B.dot(B.T))
+        # pixels of the ring outside the field of view get weight 0
+        outside = np.nonzero(~inside)
+        G[outside[0], outside[1], outside[1]] = 1
         try:
-            data += list(np.linalg.inv(tmp).
-                         dot(B.dot(Y[p] - A[p].dot(C).ravel() - b0[p] if X is None else X[p])))
-        except:
-            # np.linalg.lstsq seems less robust but scipy version is
-            # (robust but for the problem size slower) alternative
-            data += list(scipy.linalg.lstsq(B.T, Y[p] - A[p].dot(C) - b0[p]
-                                            if X is None else X[p], check_finite=False)[0])
-        indptr.append(len(indices))
-    return spr.csr_matrix((data, indices, indptr), dtype='float32'), b0.astype(np.float32)
+            weights = np.linalg.solve(G, rhs[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            weights = np.zeros(rhs.shape)
+            for i in range(len(G)):
+                try:
+                    weights[i] = np.linalg.solve(G[i], rhs[i])
+                except np.linalg.LinAlgError:
+                    # minimum norm least squares solution, as scipy.linalg.lstsq(B.T, X[p])
+                    weights[i] = scipy.linalg.lstsq(G[i], rhs[i], check_finite=False)[0]
+        return (weights[inside], np.ravel_multi_index((x[inside], y[inside]), (d1, d2), order='F'),
+                inside.sum(1))
+
+    # correlations of the shifted copies of X = Y - A*C - b0 (downscaled) for the tile of columns
+    # y0:y1 and the margin of its rings, stored transposed (consecutive pixels are contiguous) with
+    # zero padding for the rings of the border pixels. They are accumulated over chunks of frames
+    # centered on their own mean, and corrected for b0 at the end. Offsets with the same dx are
+    # obtained from the products of (blocks of) rows of pixels.
+    pad = radius + 1
+    D = np.abs(deltas[:, 1]).max()
+    w = max(2 * D, 16)
+    if tile_width is None:
+        tile_width = max(2 * (pad + D), 2**25 // (len(deltas) * (d1 + 2 * pad)) - 2 * pad)
+    n_threads = multiprocessing.cpu_count() if n_threads is None else n_threads
+    pool = ThreadPool(n_threads) if n_threads > 1 else None
+    results = []
+    for y0 in range(0, d2, tile_width):
+        y1 = min(y0 + tile_width, d2)
+        n_cols = y1 - y0 + 2 * pad
+        # the correlations of the columns y0 - pad:y1 + pad involve the pixels of the columns
+        # lo:hi, which are stored in the columns off:off + hi - lo of Upad
+        lo, hi = max(0, y0 - pad - D), min(d2, y1 + pad + D)
+        off = lo - (y0 - pad - D)
+        rows = slice(lo * ssub * dims[0], min(hi * ssub, dims[1]) * dims[0])
+        n_pixels = rows.stop - rows.start
+        chunk = T if data_fits_in_memory else max(1, 2**26 // (n_pixels * tsub)) * tsub
+        XX = np.zeros((len(deltas), n_cols, d1 + 2 * pad))
+        Y_sum = np.zeros(n_pixels)
+        means, n_frames = [], []
+        for t in range(0, T, chunk):
+            Yc = np.array(Y[rows, t:t + chunk], dtype=np.float32)
+            Cc = C[:, t:t + chunk]
+            Y_sum += Yc.sum(1, dtype=np.float64)
+            if ssub > 1 or tsub > 1:
+                Yc = downscale(Yc.reshape((dims[0], -1, Yc.shape[-1]), order='F'), (ssub, ssub, tsub))
+                Cc = downscale(Cc, (1, tsub))
+            U = Yc.reshape((d1 * (hi - lo), -1), order='F')
+            if A.size > 0:
+                U = U - A_ds[lo * d1:hi * d1].dot(Cc)
+            U = U.reshape((d1, hi - lo, -1), order='F')
+            means.append(U.mean(-1))
+            n_frames.append(U.shape[-1])
+            Upad = np.zeros((d1, (n_cols - 1) // w * w + w + 2 * D, U.shape[-1]))
+            Upad[:, off:off + hi - lo] = U - means[-1][..., None]
+            del U, Yc
+            for dx in range(deltas[:, 0].max() + 1):
+                ks = np.nonzero(deltas[:, 0] == dx)[0]
+                dys = deltas[ks, 1]
+                for j in range(0, n_cols, w):
+                    # pixel (i, j + a) and (i + dx, j + a + dy) are at [i, a, a + D + dy]
+                    prod = np.matmul(Upad[:d1 - dx, D + j:D + j + w],
+                                     Upad[dx:, j:j + w + 2 * D].transpose(0, 2, 1))
+                    a = np.arange(min(w, n_cols - j))
+                    XX[ks, j:j + len(a), pad:pad + d1 - dx] += \
+                        prod[:, a, a + D + dys[:, None]].transpose(1, 2, 0)
+            del Upad, prod
+
+        b0_tile = Y_sum / T - (A[rows].dot(C_mean) if A.size > 0 else 0)
+        start = (y0 - lo) * ssub * dims[0]
+        stop = min(y1 * ssub, dims[1]) * dims[0]
+        b0[y0 * ssub * dims[0]:stop] = b0_tile[start:start + stop - y0 * ssub * dims[0]]
+        b = downscale(b0_tile.reshape((dims[0], -1), order='F'), (ssub, ssub)) if ssub > 1 else \
+            b0_tile.reshape((d1, hi - lo), order='F')
+        dm = np.zeros((len(means), d1, n_cols + 2 * D))
+        dm[:, :, off:off + hi - lo] = np.array(means) - b
+        for k, (dx, dy) in enumerate(deltas):
+            XX[k, :, pad:pad + d1 - dx] += np.einsum(
+                'c,cij,cij->ji', n_frames, dm[:, :d1 - dx, D:D + n_cols], dm[:, dx:, D + dy:D + dy + n_cols])
+        del dm
+
+        pixels = np.arange(y0 * d1, y1 * d1)
+        blocks = np.array_split(pixels, max(1, (len(pixels) * R * R) // 2**21))
+        if pool is not None and len(blocks) > 1:
+            results += pool.map(lambda block: solve_block(XX, y0, block), blocks)
+        else:
+            results += [solve_block(XX, y0, block) for block in blocks]
+        del XX
+    if pool is not None:
+        pool.close()
+
+    data, indices, counts = [np.concatenate(res) for res in zip(*results)]
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    return spr.csr_matrix((data, indices, indptr), shape=(d1 * d2, d1 * d2), dtype='float32'), \
+        b0.astype(np.float32)
 
 #%%
 def nnsvd_init(X,n_components,eps=1e-6,random_state=None):
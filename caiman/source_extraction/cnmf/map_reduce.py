@@ -24,6 +24,7 @@ from past.utils import old_div
 import numpy as np
 import time
 import scipy
+import scipy.spatial
 import os
 from ...mmapping import load_memmap
 from ...cluster import extract_patch_coordinates
@@ -149,7 +150,8 @@ def cnmf_patches(args_in):
                         ring_size_factor=options['init_params']['ring_size_factor'],
                         center_psf=options['init_params']['center_psf'],
                         ssub_B=options['init_params']['ssub_B'],
-                        init_iter=options['init_params']['init_iter'])
+                        init_iter=options['init_params']['init_iter'],
+                        multiscale=options['init_params']['multiscale'])
 
         cnm = cnm.fit(images)
         return [idx_, shapes, scipy.sparse.coo_matrix(cnm.A),
@@ -255,10 +257,7 @@ def run_CNMF_patches(file_name, shape, options, rf=16, stride=4, gnb=1, dview=No
         #        print(id_2d)
         args_in.append((file_name, id_f, id_2d, options))
         if del_duplicates:
-            foo = np.zeros(d, dtype=bool)
-            foo[id_f] = 1
-            patch_centers.append(scipy.ndimage.center_of_mass(
-                foo.reshape(dims, order='F')))
+            patch_centers.append(np.mean(np.unravel_index(id_f, dims, order='F'), axis=1))
     print(id_2d)
     st = time.time()
     if dview is not None:
@@ -283,6 +282,9 @@ def run_CNMF_patches(file_name, shape, options, rf=16, stride=4, gnb=1, dview=No
     count_bgr = 0
     patch_id = 0
     num_patches = len(file_res)
+    if del_duplicates:
+        # spatial index over the patch centers, each component is assigned to the closest patch
+        patch_tree = scipy.spatial.cKDTree(np.array(patch_centers))
     for jj, fff in enumerate(file_res):
         if fff is not None:
             idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
@@ -291,14 +293,14 @@ def run_CNMF_patches(file_name, shape, options, rf=16, stride=4, gnb=1, dview=No
 
             A = A.tocsc()
             if del_duplicates:
-                keep = []
-                for ii in range(np.shape(A)[-1]):
-                    neuron_center = (np.array(scipy.ndimage.center_of_mass(
-                        A[:, ii].toarray().reshape(shapes, order='F'))) -
-                        np.array(shapes) / 2. + np.array(patch_centers[jj]))
-                    if np.argmin([np.linalg.norm(neuron_center - p) for p in
-                                  np.array(patch_centers)]) == jj:
-                        keep.append(ii)
+                # centers of mass of all the components of the patch at once
+                coords = np.array(np.unravel_index(np.arange(np.prod(shapes)), shapes, order='F'))
+                mass = np.ravel(A.sum(0))
+                keep = np.where(mass > 0)[0]
+                neuron_centers = (A[:, keep].T.dot(coords.T) / mass[keep, None] -
+                                  np.array(shapes) / 2. + np.array(patch_centers[jj]))
+                if len(keep):
+                    keep = keep[patch_tree.query(neuron_centers)[1] == jj]
                 A = A[:, keep]
                 file_res[jj][2] = A
                 file_res[jj][4] = C[keep]
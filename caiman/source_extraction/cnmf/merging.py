@@ -14,61 +14,135 @@ from __future__ import division
 from __future__ import print_function
 from builtins import range
 from past.utils import old_div
-from scipy.sparse import coo_matrix, csgraph, csc_matrix, lil_matrix
+from scipy.sparse import coo_matrix, csgraph, csc_matrix
 import scipy
 import numpy as np
 from .spatial import update_spatial_components, threshold_components
 from .temporal import update_temporal_components
 from .deconvolution import constrained_foopsi
-from .utilities import update_order_greedy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 #%%
-def merge_components_placeholder(params):
-    [Y, A,  b, C, f, S, sn_pix,
-     temporal_params, spatial_params,
-     thr, fast_merge, mx, bl, c1,
-     sn, g, subidx] = params
-    A, C, nr, merged_ROIs, S, bl,
-    c1, sn, g = merge_components(Y, A, b, C, f, S, sn_pix, temporal_params, spatial_params,
-                           dview=None, thr=thr, fast_merge=fast_merge, mx=mx, bl=bl,
-                           c1=c1, sn=sn, g=g)
+def merge_components_parallel(Y, A, b, C, f, S, sn_pix, temporal_params, spatial_params, dview=None, thr=0.85, fast_merge=True, mx=None, bl=None, c1=None, sn=None, g=None):
+    """ Merging of components until convergence
+
+    Same as merge_components, but merges are repeated on the updated components until no more
+    pairs exceed the correlation threshold, and without capping the number of merging operations
+    per pass (unless mx is given). The merge groups of each pass are refitted in parallel on dview.
+    merged_ROIs refer to the indices of the input components.
+
+    See Also:
+    --------
+    merge_components
+    """
+    return merge_components(Y, A, b, C, f, S, sn_pix, temporal_params, spatial_params, dview=dview,
+                            thr=thr, fast_merge=fast_merge, mx=mx, bl=bl, c1=c1, sn=sn, g=g,
+                            max_merge_iter=np.inf)
 
-    return A, C, nr, merged_ROIs, S, bl, c1, sn, g
 #%%
-def merge_components_parallel(Y, A, b, C, f, S, sn_pix, temporal_params, spatial_params, dview=None, thr=0.85, fast_merge=True, mx=1000, bl=None, c1=None, sn=None, g=None):
-    parrllcomp, len_parrllcomp = update_order_greedy(A)
+def overlap_correlations(A, C, block_size=10000):
+    """ Temporal correlations of the spatially overlapping pairs of components
 
-    params = [[Y, A.tocsc()[:,subidx],  b, C[subidx], f, S[subidx], sn_pix,
-      temporal_params, spatial_params,
-      thr, fast_merge, mx, bl, c1,
-      sn, g]  for subidx in parrllcomp]
+    Only the pairs (i < j) with a nonzero entry in A^T A are evaluated, so the cost scales with the
+    number of overlaps rather than with the square of the number of components.
 
+Parameters:
+-----------
 
-    if 'multiprocessing' in str(type(dview)):
-        results = dview.map_async(
-            merge_components_placeholder, params).get(4294967)
+A: sparse matrix
+     matrix of spatial components (d x K)
 
-    elif dview is not None and platform.system() != 'Darwin':
+C: np.ndarray
+     matrix of temporal components (K x T)
 
-        results = dview.map_sync(
-                merge_components_placeholder, params)
+block_size: int
+     number of pairs whose correlation is computed at once
 
+Returns:
+--------
+
+rows, cols: np.ndarray
+     indices of the overlapping pairs (rows < cols)
+
+corr: np.ndarray
+     Pearson correlation of the traces of each pair (0 for constant traces)
+    """
+    A_corr = scipy.sparse.triu(A.T.dot(A), k=1).tocoo()
+    keep = A_corr.data > 0
+    rows, cols = A_corr.row[keep], A_corr.col[keep]
+    Cn = np.array(C, dtype=np.float64)
+    Cn -= Cn.mean(axis=1)[:, None]
+    nrm = np.sqrt(np.sum(Cn ** 2, axis=1))
+    nrm[nrm == 0] = np.inf
+    Cn /= nrm[:, None]
+    corr = np.zeros(len(rows))
+    for st in range(0, len(rows), block_size):
+        sl = slice(st, st + block_size)
+        corr[sl] = np.einsum('ij,ij->i', Cn[rows[sl]], Cn[cols[sl]])
+
+    return rows, cols, corr
+
+#%%
+def merge_group(pars):
+    """ Fits a single component to a group of components to be merged
+
+    rank one NMF of A_group C_group (or best neuron if not fast_merge) followed by deconvolution
+
+    pars: spatial components of the group (sparse d x n), temporal components of the group (n x T),
+          time constants of the group (or None), fast_merge, parameters of constrained_foopsi
+    """
+    Acsc, Ctmp, g_group, fast_merge, temporal_params = pars
+    # the merged footprint lives on the union of the supports of the group
+    d = Acsc.shape[0]
+    pixels = np.unique(Acsc.indices)
+    Acsc = Acsc[pixels]
+
+    # this is a  big normalization value that for every one of the merged neuron
+    C_to_norm = np.sqrt(np.ravel(Acsc.power(2).sum(
+        axis=0)) * np.sum(Ctmp ** 2, axis=1))
+    indx = np.argmax(C_to_norm)
+
+    if fast_merge:
+        # we normalize the values of different A's to be able to compare them efficiently. we then sum them
+        computedA = Acsc.dot(scipy.sparse.diags(
+            C_to_norm, 0, (len(C_to_norm), len(C_to_norm)))).sum(axis=1)
+
+        # we operate a rank one NMF, refining it multiple times (see cnmf demos )
+        for _ in range(10):
+            computedC = np.maximum(Acsc.T.dot(computedA).T.dot(
+                Ctmp) / (computedA.T * computedA), 0)
+            computedA = np.maximum(
+                Acsc.dot(Ctmp.dot(computedC.T)) / (computedC * computedC.T), 0)
     else:
-        results = list(map(merge_components_placeholder, params))
+        print('Simple Merging Take Best Neuron')
+        computedC = Ctmp[indx]
+        computedA = Acsc[:, indx]
 
-    A, C, nr, merged_ROIs, S, bl, c1, sn, g = [itertools.chain(*elm) for elm in zip(*results)]
-    A = scipy.sparse.hstack(A)
-    C = np.vstack(C)
-    S = np.vstack(S)
-    nr = np.sum(nr)
+    # then we de-normalize them using A_to_norm
+    A_to_norm = np.sqrt(computedA.T.dot(computedA)[
+                        0, 0] / Acsc.power(2).sum(0).max())
+    computedA /= A_to_norm
+    computedC *= A_to_norm
 
-    if dview is not None and not('multiprocessing' in str(type(dview))):
-        dview.results.clear()
+    # we then compute the traces ( deconvolution ) to have a clean c and noise in the background
+    computedC, bm, cm, gm, sm, ss, lam_ = constrained_foopsi(
+        np.array(computedC).squeeze(), g=None if g_group is None else g_group[indx], **temporal_params)
+
+    if scipy.sparse.issparse(computedA):
+        computedA = computedA.toarray()
+    computedA = csc_matrix((np.ravel(computedA), (pixels, np.zeros(len(pixels), dtype=int))), shape=(d, 1))
+
+    return computedA, computedC, ss, bm, cm, sm, gm
 
-    return A, C, nr, merged_ROIs, S, bl, c1, sn, g, subidx
+
+def merge_group_block(args_in):
+    """ run merge_group on a block of merge groups (one task per block instead of one per group)
+    """
+    return [merge_group(pars) for pars in args_in]
 
 #%%
-def merge_components(Y, A, b, C, f, S, sn_pix, temporal_params, spatial_params, dview=None, thr=0.85, fast_merge=True, mx=1000, bl=None, c1=None, sn=None, g=None):
+def merge_components(Y, A, b, C, f, S, sn_pix, temporal_params, spatial_params, dview=None, thr=0.85, fast_merge=True, mx=1000, bl=None, c1=None, sn=None, g=None, max_merge_iter=1, n_threads=1):
     """ Merging of spatially overlapping components that have highly correlated temporal activity
 
     The correlation threshold for merging overlapping components is user specified in thr
@@ -107,7 +181,7 @@ thr:   scalar between 0 and 1
      correlation threshold for merging (default 0.85)
 
 mx:    int
-     maximum number of merging operations (default 50)
+     maximum number of merging operations per pass (default 1000, None or np.inf for no limit)
 
 sn_pix:    nd.array
      noise level for each pixel (vector of length d)
@@ -124,6 +198,17 @@ g:
 sn:
      noise level for each row in C
 
+dview: view on ipyparallel or multiprocessing client
+     the refits of the merge groups are distributed over it
+
+max_merge_iter: int
+     maximum number of merging passes; after each pass the overlap graph and the correlations are
+     recomputed on the merged components and merging stops when no group is found (default 1,
+     np.inf to iterate until convergence)
+
+n_threads: int
+     number of threads used for the refits when dview is None (default: 1, serial)
+
 Returns:
 --------
 
@@ -137,7 +222,8 @@ nr:    int
     number of components after merging
 
 merged_ROIs: list
-    index of components that have been merged
+    index of components that have been merged (indices of the input components, one array
+    for each of the merged components that are appended at the end of A and C)
 
 S:     np.ndarray
         matrix of merged deconvolved activity (spikes) (K x T)
@@ -178,112 +264,75 @@ sn: float
             "The number of elements of g must match the number of components")
 
     [d, t] = np.shape(Y)
-
-    # % find graph of overlapping spatial components
-    A_corr = scipy.sparse.triu(A.T * A)
-    A_corr.setdiag(0)
-    A_corr = A_corr.tocsc()
-    FF2 = A_corr > 0
-    C_corr = scipy.sparse.csc_matrix(A_corr.shape)
-    for ii in range(nr):
-        overlap_indeces = A_corr[ii, :].nonzero()[1]
-        if len(overlap_indeces) > 0:
-            # we chesk the correlation of the calcium traces for eahc overlapping components
-            corr_values = [scipy.stats.pearsonr(C[ii, :], C[jj, :])[
-                0] for jj in overlap_indeces]
-            C_corr[ii, overlap_indeces] = corr_values
-
-    FF1 = (C_corr + C_corr.T) > thr
-    FF3 = FF1.multiply(FF2)
-
-    nb, connected_comp = csgraph.connected_components(
-        FF3)  # % extract connected components
-
     p = temporal_params['p']
-    list_conxcomp = []
-    for i in range(nb):  # we list them
-        if np.sum(connected_comp == i) > 1:
-            list_conxcomp.append((connected_comp == i).T)
-    list_conxcomp = np.asarray(list_conxcomp).T
-
-    if list_conxcomp.ndim > 1:
-        cor = np.zeros((np.shape(list_conxcomp)[1], 1))
-        for i in range(np.size(cor)):
-            fm = np.where(list_conxcomp[:, i])[0]
-            for j1 in range(np.size(fm)):
-                for j2 in range(j1 + 1, np.size(fm)):
-                    cor[i] = cor[i] + C_corr[fm[j1], fm[j2]]
-
-#        if not fast_merge:
-#            Y_res = Y - A.dot(C) #residuals=background=noise
-        if np.size(cor) > 1:
-            # we get the size (indeces)
-            ind = np.argsort(np.squeeze(cor))[::-1]
-        else:
-            ind = [0]
+    if mx is None:
+        mx = np.inf
+
+    if dview is None:
+        n_workers = n_threads
+    elif 'multiprocessing' in str(type(dview)):
+        # a pool does not expose its size, setup_cluster starts one worker per core
+        n_workers = multiprocessing.cpu_count()
+    else:
+        n_workers = len(dview)
+    n_workers = max(1, n_workers)
+
+    A = csc_matrix(A)
+    C = np.asarray(C)
+    # indices of the input components making up each of the current components
+    members = [np.array([k]) for k in range(nr)]
+    n_iter = 0
+    while n_iter < max_merge_iter:
+        # % graph of overlapping spatial components with correlated activity
+        rows, cols, corr = overlap_correlations(A, C)
+        high = corr > thr
+        nb, connected_comp = csgraph.connected_components(coo_matrix(
+            (np.ones(high.sum()), (rows[high], cols[high])), shape=(nr, nr)))  # % extract connected components
+        sizes = np.bincount(connected_comp, minlength=nb)
+        groups = np.where(sizes > 1)[0]
+        if len(groups) == 0:
+            break
+
+        # summed correlation of the overlapping pairs within each group, used to rank the merges
+        same = connected_comp[rows] == connected_comp[cols]
+        cor = np.bincount(connected_comp[rows[same]], weights=corr[same], minlength=nb)[groups]
+        ind = np.argsort(cor)[::-1]
+        nbmrg = int(min(len(ind), mx))   # number of merging operations
+
+        order = np.argsort(connected_comp, kind='mergesort')
+        group_members = np.split(order, np.cumsum(sizes)[:-1])
+        merged_ROIs = [group_members[groups[i]] for i in ind[:nbmrg]]
+        for merged_ROI in merged_ROIs:
+            print((merged_ROI.T))
 
-        nbmrg = min((np.size(ind), mx))   # number of merging operations
+        g_ = None if g is None else np.vstack(g)
+        pars = [(A[:, merged_ROI], C[merged_ROI], None if g is None else g_[merged_ROI], fast_merge, temporal_params)
+                for merged_ROI in merged_ROIs]
+        args_in = [[pars[i] for i in idx]
+                   for idx in np.array_split(np.arange(nbmrg), min(nbmrg, 4 * n_workers))]
+        if 'multiprocessing' in str(type(dview)):
+            results = dview.map_async(merge_group_block, args_in).get(4294967)
+        elif dview is not None:
+            results = dview.map_sync(merge_group_block, args_in)
+        elif n_workers > 1:
+            pool = ThreadPool(n_workers)
+            try:
+                results = pool.map(merge_group_block, args_in)
+            finally:
+                pool.close()
+        else:
+            results = list(map(merge_group_block, args_in))
+        results = [res for block in results for res in block]
 
         # we initialize the values
-        A_merged = lil_matrix((d, nbmrg))
+        A_merged = scipy.sparse.hstack([res[0] for res in results]).tocsc()
         C_merged = np.zeros((nbmrg, t))
         S_merged = np.zeros((nbmrg, t))
         bl_merged = np.zeros((nbmrg, 1))
         c1_merged = np.zeros((nbmrg, 1))
         sn_merged = np.zeros((nbmrg, 1))
         g_merged = np.zeros((nbmrg, p))
-        merged_ROIs = []
-
-        for i in range(nbmrg):
-            merged_ROI = np.where(list_conxcomp[:, ind[i]])[0]
-            merged_ROIs.append(merged_ROI)
-
-            # we l2 the traces to have normalization values
-            C_to_norm = np.sqrt([computedC.dot(computedC)
-                                 for computedC in C[merged_ROI]])
-#            fast_merge = False
-
-            # from here we are computing initial values for C and A
-            Acsc = A.tocsc()[:, merged_ROI]
-            Ctmp = np.array(C)[merged_ROI, :]
-            print((merged_ROI.T))
-
-            # this is a  big normalization value that for every one of the merged neuron
-            C_to_norm = np.sqrt(np.ravel(Acsc.power(2).sum(
-                axis=0)) * np.sum(Ctmp ** 2, axis=1))
-            indx = np.argmax(C_to_norm)
-
-            if fast_merge:
-                # we normalize the values of different A's to be able to compare them efficiently. we then sum them
-                computedA = Acsc.dot(scipy.sparse.diags(
-                    C_to_norm, 0, (len(C_to_norm), len(C_to_norm)))).sum(axis=1)
-
-                # we operate a rank one NMF, refining it multiple times (see cnmf demos )
-                for _ in range(10):
-                    computedC = np.maximum(Acsc.T.dot(computedA).T.dot(
-                        Ctmp) / (computedA.T * computedA), 0)
-                    computedA = np.maximum(
-                        Acsc.dot(Ctmp.dot(computedC.T)) / (computedC * computedC.T), 0)
-            else:
-                print('Simple Merging Take Best Neuron')
-                computedC = Ctmp[indx]
-                computedA = Acsc[:, indx]
-
-            # then we de-normalize them using A_to_norm
-            A_to_norm = np.sqrt(computedA.T.dot(computedA)[
-                                0, 0] / Acsc.power(2).sum(0).max())
-            computedA /= A_to_norm
-            computedC *= A_to_norm
-
-            # we then compute the traces ( deconvolution ) to have a clean c and noise in the background
-            if g is not None:
-                computedC, bm, cm, gm, sm, ss, lam_ = constrained_foopsi(
-                    np.array(computedC).squeeze(), g=g[merged_ROI[indx]], **temporal_params)
-            else:
-                computedC, bm, cm, gm, sm, ss, lam_ = constrained_foopsi(
-                    np.array(computedC).squeeze(), g=None, **temporal_params)
-
-            A_merged[:, i] = computedA
+        for i, (_, computedC, ss, bm, cm, sm, gm) in enumerate(results):
             C_merged[i, :] = computedC
             S_merged[i, :] = ss[:t]
             bl_merged[i] = bm
@@ -294,7 +343,7 @@ sn: float
         # we want to remove merged neuron from the initial part and replace them with merged ones
         neur_id = np.unique(np.hstack(merged_ROIs))
         good_neurons = np.setdiff1d(list(range(nr)), neur_id)
-        A = scipy.sparse.hstack((A.tocsc()[:, good_neurons], A_merged.tocsc()))
+        A = scipy.sparse.hstack((A[:, good_neurons], A_merged)).tocsc()
         C = np.vstack((C[good_neurons, :], C_merged))
         # we continue for the variables
         if S is not None:
@@ -306,11 +355,18 @@ sn: float
         if sn is not None:
             sn = np.hstack((sn[good_neurons], np.array(sn_merged).flatten()))
         if g is not None:
-            g = np.vstack((np.vstack(g)[good_neurons], g_merged))
+            g = np.vstack((g_[good_neurons], g_merged))
+        members = [members[k] for k in good_neurons] + \
+            [np.sort(np.hstack([members[k] for k in merged_ROI])) for merged_ROI in merged_ROIs]
         nr = nr - len(neur_id) + nbmrg
+        n_iter += 1
 
-    else:
+    if dview is not None and not('multiprocessing' in str(type(dview))):
+        dview.results.clear()
+
+    if n_iter == 0:
         print('No neurons merged!')
-        merged_ROIs = []
+    # components left untouched keep their relative order ahead of the merged ones
+    merged_ROIs = [m for m in members if len(m) > 1]
 
     return A, C, nr, merged_ROIs, S, bl, c1, sn, g
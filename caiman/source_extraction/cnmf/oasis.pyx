@@ -11,6 +11,7 @@ from libc.math cimport sqrt, log, exp, fmax, fabs
 from scipy.optimize import fminbound, minimize
 from cpython cimport bool
 from libcpp.vector cimport vector
+from multiprocessing.pool import ThreadPool
 
 ctypedef np.float32_t SINGLE
 
@@ -22,10 +23,191 @@ cdef struct Pool:
     Py_ssize_t l
 
 
+cdef struct OASISRef:
+    # pointers to the state of an OASIS instance, usable without the GIL
+    vector[Pool]* P
+    vector[SINGLE]* y
+    Py_ssize_t* i
+    unsigned int* t
+    SINGLE g, lam, s_min, b, g2, d, r
+    SINGLE* h
+    SINGLE* g12
+    SINGLE* g11g11
+    SINGLE* g11g12
+
+
 cdef min1000(a):
     return a if a < 1000 else 1000
 
 
+cdef inline Py_ssize_t _min1000(Py_ssize_t a) noexcept nogil:
+    return a if a < 1000 else 1000
+
+
+@cython.cdivision(True)
+cdef void _fit_next(OASISRef o, SINGLE yt) noexcept nogil:
+    """
+    fit next time step t, see OASIS.fit_next
+    """
+    cdef Pool newpool
+    cdef Py_ssize_t i, j, k
+    cdef SINGLE tmp
+    cdef vector[Pool]* P = o.P
+    i = o.i[0]
+    if o.g2 == 0:  # AR(1)
+        newpool.v = yt - o.b - o.lam * (1 - o.g)
+        newpool.w, newpool.t, newpool.l = 1, o.t[0], 1
+        P.push_back(newpool)
+        o.t[0] += 1
+        i += 1
+        while (i > 0 and  # backtrack until violations fixed
+               (P[0][i - 1].v / P[0][i - 1].w * o.g**P[0][i - 1].l +
+                o.s_min > P[0][i].v / P[0][i].w)):
+            i -= 1
+            # merge two pools
+            P[0][i].v += P[0][i + 1].v * o.g**P[0][i].l
+            P[0][i].w += P[0][i + 1].w * o.g**(2 * P[0][i].l)
+            P[0][i].l += P[0][i + 1].l
+            P.pop_back()
+    else:  # AR(2)
+        o.y.push_back(yt - o.b - o.lam * (1 - o.g - o.g2))
+        newpool.v = fmax(0, o.y[0][o.t[0]])
+        newpool.w, newpool.t, newpool.l = newpool.v, o.t[0], 1
+        P.push_back(newpool)
+        o.t[0] += 1
+        i += 1
+        while (i > 0 and  # backtrack until violations fixed
+               (((((P[0][i - 1].v * o.d**(P[0][i - 1].l + 1) /
+                    (o.d - o.r))
+                   if o.d != o.r else
+                   (P[0][i - 1].v * o.d**P[0][i - 1].l *
+                    (P[0][i - 1].l + 1) -
+                    P[0][i - 2].w * o.d**(P[0][i - 1].l + 2) *
+                    (P[0][i - 1].l + 1)))
+                   if P[0][i - 1].l >= 1000 else
+                   (o.h[P[0][i - 1].l] * P[0][i - 1].v +
+                    o.g12[P[0][i - 1].l] * P[0][i - 2].w)) >
+                  P[0][i].v - o.s_min)
+                if i > 1 else
+                (P[0][i - 1].w * o.d > P[0][i].v - o.s_min))):
+            i -= 1
+            # merge two pools
+            P[0][i].l += P[0][i + 1].l
+            k = P[0][i].l - 1
+            if i > 0:
+                if k >= 1000:
+                    k = 999  # precomputed kernel shorter than ISI -> simply truncate
+                tmp = 0
+                for j in range(_min1000(P[0][i].l)):
+                    tmp += o.h[j] * o.y[0][P[0][i].t + j]
+                P[0][i].v = ((tmp - o.g11g12[k] * P[0][i - 1].w) /
+                             o.g11g11[k])
+                P[0][i].w = (o.h[k] * P[0][i].v +
+                             o.g12[k] * P[0][i - 1].w)
+            else:  # update first pool
+                tmp = 0
+                for j in range(P[0][i].l):
+                    tmp += o.d**j * o.y[0][j]
+                P[0][i].v = fmax(0, tmp * (1 - o.d * o.d) /
+                                 (1 - o.d**(2 * P[0][i].l)))
+                P[0][i].w = o.d**k * P[0][i].v
+            P.pop_back()
+    o.i[0] = i
+
+
+cdef void _c_of_last_pool(OASISRef o, SINGLE* c, Py_ssize_t t) noexcept nogil:
+    """
+    write the denoised calcium of the last pool into c[t - l + 1:t + 1], l being its length
+    """
+    cdef Py_ssize_t i, k, l, start
+    cdef SINGLE tmp
+    cdef vector[Pool]* P = o.P
+    i = o.i[0]
+    l = P[0][i].l
+    start = t - l + 1
+    for k in range(0 if start >= 0 else -start, l):
+        c[start + k] = 0
+    if o.g2 == 0:  # AR(1)
+        tmp = P[0][i].v / P[0][i].w
+        for k in range(0 if start >= 0 else -start, _min1000(l)):
+            c[start + k] = tmp * o.h[k]
+    elif i == 0:  # AR(2), first pool
+        tmp = P[0][0].v
+        for k in range(l):
+            if start + k >= 0:
+                c[start + k] = tmp
+            tmp *= o.d
+    else:  # AR(2)
+        for k in range(0 if start >= 0 else -start, _min1000(l)):
+            c[start + k] = o.h[k] * P[0][i].v + o.g12[k] * P[0][i - 1].w
+
+
+cdef void _c_full(OASISRef o, SINGLE* c) noexcept nogil:
+    """
+    write the full denoised calcium into the zero initialized c, see OASIS.c
+    """
+    cdef Py_ssize_t j, k
+    cdef SINGLE tmp
+    cdef vector[Pool]* P = o.P
+    if o.g2 == 0:  # AR(1)
+        for j in range(o.i[0] + 1):
+            tmp = fmax(P[0][j].v, 0) / P[0][j].w
+            for k in range(_min1000(P[0][j].l)):
+                c[k + P[0][j].t] = tmp * o.h[k]
+    else:  # AR(2)
+        c[0] = P[0][0].v
+        for k in range(1, P[0][0].l):
+            c[k] = c[k - 1] * o.d
+        for j in range(1, o.i[0] + 1):
+            for k in range(_min1000(P[0][j].l)):
+                c[k + P[0][j].t] = o.h[k] * P[0][j].v + o.g12[k] * P[0][j - 1].w
+
+
+cdef void _shift_derivative(OASISRef o, SINGLE* D) noexcept nogil:
+    """
+    write into the zero initialized D the decrease of the denoised calcium of an AR(1) instance when
+    1 - g is subtracted from each data point: g^k (1 - g^l) / w in a pool of length l and weight w,
+    0 in the pools clipped to 0
+    """
+    cdef Py_ssize_t j, k
+    cdef SINGLE tmp
+    cdef vector[Pool]* P = o.P
+    for j in range(o.i[0] + 1):
+        if P[0][j].v > 0:
+            tmp = (1 - o.g**P[0][j].l) / P[0][j].w
+            for k in range(_min1000(P[0][j].l)):
+                D[k + P[0][j].t] = tmp * o.h[k]
+
+
+@cython.cdivision(True)
+cdef void _shift_pools(OASISRef o, SINGLE db, SINGLE dlam) noexcept nogil:
+    """
+    refit a fitted AR(1) instance after its baseline is increased by db and its sparsity penalty by
+    dlam (|s|_1, i.e. lam at the last time step), warm started from its pools: the pool values are
+    shifted and the pools violating the constraints merged, as in constrained_oasisAR1
+    """
+    cdef Py_ssize_t i, n
+    cdef vector[Pool]* P = o.P
+    n = o.i[0]
+    for i in range(n + 1):
+        P[0][i].v -= (db / (1 - o.g) + dlam) * (1 - o.g**P[0][i].l)
+    P[0][n].v -= dlam * o.g**P[0][n].l
+    i = 0
+    while i < n:
+        i += 1
+        while (i > 0 and  # backtrack until violations fixed
+               (P[0][i - 1].v / P[0][i - 1].w * o.g**P[0][i - 1].l +
+                o.s_min > P[0][i].v / P[0][i].w)):
+            i -= 1
+            # merge two pools
+            P[0][i].v += P[0][i + 1].v * o.g**P[0][i].l
+            P[0][i].w += P[0][i + 1].w * o.g**(2 * P[0][i].l)
+            P[0][i].l += P[0][i + 1].l
+            P.erase(P.begin() + i + 1)
+            n -= 1
+    o.i[0] = n
+
+
 cdef class OASIS:
     """
     Deconvolution class implementing OASIS
@@ -137,72 +319,22 @@ cdef class OASIS:
                 self.i = -1
             self._y = [0] * num_empty_samples
 
-    def fit_next(self, yt):
+    cdef OASISRef _ref(self):
+        cdef OASISRef o
+        o.P = &self.P
+        o.y = &self._y
+        o.i = &self.i
+        o.t = &self.t
+        o.g, o.lam, o.s_min, o.b, o.g2 = self.g, self.lam, self.s_min, self.b, self.g2
+        o.d, o.r = self.d, self.r
+        o.h, o.g12, o.g11g11, o.g11g12 = &self.h[0], &self.g12[0], &self.g11g11[0], &self.g11g12[0]
+        return o
+
+    def fit_next(self, SINGLE yt):
         """
         fit next time step t
         """
-        cdef Pool newpool
-        cdef Py_ssize_t j, k
-        cdef np.ndarray[SINGLE, ndim = 1] h, g12, g11g11, g11g12
-        cdef SINGLE tmp
-        if self.g2 == 0:  # AR(1)
-            newpool.v = yt - self.b - self.lam * (1 - self.g)
-            newpool.w, newpool.t, newpool.l = 1, self.t, 1
-            self.P.push_back(newpool)
-            self.t += 1
-            self.i += 1
-            while (self.i > 0 and  # backtrack until violations fixed
-                   (self.P[self.i - 1].v / self.P[self.i - 1].w * self.g**self.P[self.i - 1].l +
-                    self.s_min > self.P[self.i].v / self.P[self.i].w)):
-                self.i -= 1
-                # merge two pools
-                self.P[self.i].v += self.P[self.i + 1].v * self.g**self.P[self.i].l
-                self.P[self.i].w += self.P[self.i + 1].w * self.g**(2 * self.P[self.i].l)
-                self.P[self.i].l += self.P[self.i + 1].l
-                self.P.pop_back()
-        else:  # AR(2)
-            self._y.push_back(yt - self.b - self.lam * (1 - self.g - self.g2))
-            newpool.v = fmax(0, self._y[self.t])
-            newpool.w, newpool.t, newpool.l = newpool.v, self.t, 1
-            self.P.push_back(newpool)
-            self.t += 1
-            self.i += 1
-            while (self.i > 0 and  # backtrack until violations fixed
-                   (((((self.P[self.i - 1].v * self.d**(self.P[self.i - 1].l + 1) /
-                        (self.d - self.r))
-                       if self.d != self.r else
-                       (self.P[self.i - 1].v * self.d**self.P[self.i - 1].l * \
-                        (self.P[self.i - 1].l + 1) -
-                        self.P[self.i - 2].w * self.d**(self.P[self.i - 1].l + 2) * \
-                        (self.P[self.i - 1].l + 1)))
-                       if self.P[self.i - 1].l >= 1000 else
-                       (self.h[self.P[self.i - 1].l] * self.P[self.i - 1].v +
-                        self.g12[self.P[self.i - 1].l] * self.P[self.i - 2].w)) >
-                       self.P[self.i].v - self.s_min)
-                    if self.i > 1 else
-                    (self.P[self.i - 1].w * self.d > self.P[self.i].v - self.s_min))):
-                self.i -= 1
-                # merge two pools
-                self.P[self.i].l += self.P[self.i + 1].l
-                k = self.P[self.i].l - 1
-                if self.i > 0:
-                    if k >= 1000:
-                        k = 999  # precomputed kernel shorter than ISI -> simply truncate
-                    tmp = 0
-                    for j in range(min1000(self.P[self.i].l)):
-                        tmp += self.h[j] * self._y[self.P[self.i].t + j]
-                    self.P[self.i].v = ((tmp - self.g11g12[k] * self.P[self.i - 1].w) /
-                                        self.g11g11[k])
-                    self.P[self.i].w = (self.h[k] * self.P[self.i].v +
-                                        self.g12[k] * self.P[self.i - 1].w)
-                else:  # update first pool
-                    tmp = 0
-                    for j in range(self.P[self.i].l):
-                        tmp += self.d**j * self._y[j]
-                    self.P[self.i].v = fmax(0, tmp * (1 - self.d * self.d) /
-                                            (1 - self.d**(2 * self.P[self.i].l)))
-                    self.P[self.i].w = self.d**k * self.P[self.i].v
-                self.P.pop_back()
+        _fit_next(self._ref(), yt)
 
     def fit_next_tmp(self, yt, num):
         """
@@ -357,12 +489,18 @@ cdef class OASIS:
 
         return c
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def fit(self, y):
         """
         fit all time steps
         """
-        for yt in y:
-            self.fit_next(yt)
+        cdef OASISRef o = self._ref()
+        cdef SINGLE[:] y_ = np.ascontiguousarray(y, dtype=np.float32)
+        cdef Py_ssize_t t
+        with nogil:
+            for t in range(y_.shape[0]):
+                _fit_next(o, y_[t])
         return self
 
     def get_c(self, num):
@@ -591,6 +729,267 @@ cdef class OASIS:
             return self.get_s(self.P[self.i].t + self.P[self.i].l)
 
 
+cdef class _OASISRefs:
+    """
+    state pointers of a list of OASIS instances, processed in ranges without the GIL
+    """
+    cdef vector[OASISRef] refs
+    cdef list oases  # keep the instances alive
+
+    def __init__(self, list oases):
+        cdef OASIS o
+        self.oases = oases
+        for o in oases:
+            self.refs.push_back(o._ref())
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def fit_next_range(self, SINGLE[:] yt, Py_ssize_t start, Py_ssize_t stop):
+        cdef Py_ssize_t n
+        with nogil:
+            for n in range(start, stop):
+                _fit_next(self.refs[n], yt[n])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def fit_range(self, SINGLE[:, :] Y, Py_ssize_t start, Py_ssize_t stop):
+        cdef Py_ssize_t n, t
+        with nogil:
+            for n in range(start, stop):
+                for t in range(Y.shape[1]):
+                    _fit_next(self.refs[n], Y[n, t])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def c_range(self, SINGLE[:, ::1] C, Py_ssize_t start, Py_ssize_t stop):
+        cdef Py_ssize_t n
+        with nogil:
+            for n in range(start, stop):
+                _c_full(self.refs[n], &C[n, 0])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def shift_derivative_range(self, SINGLE[:, ::1] D, Py_ssize_t start, Py_ssize_t stop):
+        cdef Py_ssize_t n
+        with nogil:
+            for n in range(start, stop):
+                _shift_derivative(self.refs[n], &D[n, 0])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def shift_range(self, SINGLE[:] db, SINGLE[:] dlam, Py_ssize_t start, Py_ssize_t stop):
+        cdef Py_ssize_t n
+        with nogil:
+            for n in range(start, stop):
+                _shift_pools(self.refs[n], db[n], dlam[n])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def c_of_last_pool_range(self, SINGLE[:, ::1] C, Py_ssize_t t, Py_ssize_t row_offset,
+                             Py_ssize_t start, Py_ssize_t stop):
+        cdef Py_ssize_t n
+        with nogil:
+            for n in range(start, stop):
+                _c_of_last_pool(self.refs[n], &C[row_offset + n, 0], t)
+
+
+def _map_ranges(func, Py_ssize_t N, int n_threads):
+    """ call func(start, stop) on n_threads contiguous ranges of range(N) in a pool of threads """
+    n_threads = max(1, min(n_threads, N))
+    if n_threads == 1:
+        func(0, N)
+    else:
+        bounds = np.linspace(0, N, n_threads + 1).astype(int)
+        pool = ThreadPool(n_threads)
+        try:
+            pool.starmap(func, zip(bounds[:-1], bounds[1:]))
+        finally:
+            pool.close()
+
+
+def fit_batch(list oases, Y, int n_threads=1):
+    """
+    fit all time steps of many traces, each with its own OASIS instance
+
+    The traces are processed without the GIL, optionally split across threads.
+
+    Parameters
+    ----------
+    oases : list of OASIS
+        One instance for each trace.
+    Y : array of float, shape (len(oases), T)
+        Fluorescence traces.
+    n_threads : int, optional, default 1
+        Number of threads among which the traces are split.
+
+    Returns
+    -------
+    oases : list of OASIS
+        Same as input, fitted.
+    """
+    cdef _OASISRefs refs = _OASISRefs(oases)
+    cdef SINGLE[:, :] Y_ = np.asarray(Y, dtype=np.float32)
+    if Y_.shape[0] != len(oases):
+        raise Exception('Y must have one row per OASIS instance')
+    _map_ranges(lambda start, stop: refs.fit_range(Y_, start, stop), len(oases), n_threads)
+    return oases
+
+
+def get_c_batch(list oases, Py_ssize_t T, int n_threads=1):
+    """
+    construct and return the full calcium traces of many fitted OASIS instances
+
+    Equivalent to np.array([o.c for o in oases]), the traces are constructed without the GIL,
+    optionally split across threads.
+
+    Parameters
+    ----------
+    oases : list of OASIS
+        One instance for each trace, each fitted on T time steps.
+    T : int
+        Number of time steps.
+    n_threads : int, optional, default 1
+        Number of threads among which the traces are split.
+
+    Returns
+    -------
+    C : array of float32, shape (len(oases), T)
+        Denoised fluorescence of each trace.
+    """
+    cdef _OASISRefs refs = _OASISRefs(oases)
+    cdef OASIS o
+    cdef SINGLE[:, ::1] C_
+    for o in oases:
+        if o.i < 0 or o.P[o.i].t + o.P[o.i].l != T:
+            raise Exception('The OASIS instances must be fitted on T time steps')
+    C = np.zeros((len(oases), T), dtype=np.float32)
+    C_ = C
+    _map_ranges(lambda start, stop: refs.c_range(C_, start, stop), len(oases), n_threads)
+    return C
+
+
+def get_shift_derivative_batch(list oases, Py_ssize_t T, int n_threads=1):
+    """
+    derivative of the calcium traces of many fitted AR(1) OASIS instances with respect to a shift of the data
+
+    D[n, t] is the decrease of the calcium of trace n at time t per unit shift dphi when dphi * (1 - g)
+    is subtracted from every data point, the active set being kept: g^k (1 - g^l) / w at the k-th time
+    step of a pool of length l and weight w, 0 in the pools clipped to 0. Used for the Newton steps
+    on the noise constraint of constrained_oasisAR1 (and deconvolution.constrained_oasis_batch).
+
+    Parameters
+    ----------
+    oases : list of OASIS
+        One AR(1) instance for each trace, each fitted on T time steps.
+    T : int
+        Number of time steps.
+    n_threads : int, optional, default 1
+        Number of threads among which the traces are split.
+
+    Returns
+    -------
+    D : array of float32, shape (len(oases), T)
+    """
+    cdef _OASISRefs refs = _OASISRefs(oases)
+    cdef OASIS o
+    cdef SINGLE[:, ::1] D_
+    for o in oases:
+        if o.g2 != 0:
+            raise Exception('Only implemented for AR(1) instances')
+        if o.i < 0 or o.P[o.i].t + o.P[o.i].l != T:
+            raise Exception('The OASIS instances must be fitted on T time steps')
+    D = np.zeros((len(oases), T), dtype=np.float32)
+    D_ = D
+    _map_ranges(lambda start, stop: refs.shift_derivative_range(D_, start, stop), len(oases), n_threads)
+    return D
+
+
+def shift_batch(list oases, db, dlam, int n_threads=1):
+    """
+    increase the baselines and sparsity penalties of many fitted AR(1) OASIS instances
+
+    The instances are refitted warm started from their pools, without the GIL, optionally split
+    across threads. As in constrained_oasisAR1 the pools are only merged, not split.
+
+    Parameters
+    ----------
+    oases : list of OASIS
+        One fitted AR(1) instance for each trace.
+    db : array of float, shape (len(oases),)
+        Increase of the baseline of each instance.
+    dlam : array of float, shape (len(oases),)
+        Increase of the sparsity penalty of each instance.
+    n_threads : int, optional, default 1
+        Number of threads among which the traces are split.
+
+    Returns
+    -------
+    oases : list of OASIS
+        Same as input, updated.
+    """
+    cdef _OASISRefs refs = _OASISRefs(oases)
+    cdef SINGLE[:] db_ = np.asarray(db, dtype=np.float32)
+    cdef SINGLE[:] dlam_ = np.asarray(dlam, dtype=np.float32)
+    cdef OASIS o
+    cdef Py_ssize_t n
+    for n, o in enumerate(oases):
+        if o.g2 != 0:
+            raise Exception('Only implemented for AR(1) instances')
+        if o.i < 0:
+            raise Exception('The OASIS instances must be fitted')
+        o.b += db_[n]
+        o.lam += dlam_[n]
+    _map_ranges(lambda start, stop: refs.shift_range(db_, dlam_, start, stop), len(oases), n_threads)
+    return oases
+
+
+def fit_next_batch(list oases, yt, C=None, Py_ssize_t t=0, Py_ssize_t row_offset=0, int n_threads=1):
+    """
+    fit next time step of many traces, each with its own OASIS instance
+
+    Equivalent to calling o.fit_next(yt[n]) for every instance o = oases[n], and, if C is given,
+    C[row_offset + n, t - l + 1:t + 1] = o.get_c_of_last_pool() with l = o.get_l_of_last_pool().
+    The traces are processed without the GIL, optionally split across threads.
+
+    Parameters
+    ----------
+    oases : list of OASIS
+        One instance for each trace.
+    yt : array of float, shape (len(oases),)
+        New fluorescence value of each trace.
+    C : array of float32, optional, default None
+        C order buffer of denoised fluorescence, updated in place.
+    t : int, optional, default 0
+        Column of C corresponding to yt.
+    row_offset : int, optional, default 0
+        Row of C corresponding to the first instance.
+    n_threads : int, optional, default 1
+        Number of threads among which the traces are split.
+
+    Returns
+    -------
+    oases : list of OASIS
+        Same as input, updated.
+    """
+    cdef _OASISRefs refs = _OASISRefs(oases)
+    cdef SINGLE[:] yt_ = np.ascontiguousarray(yt, dtype=np.float32)
+    cdef SINGLE[:, ::1] C_
+    if yt_.shape[0] != len(oases):
+        raise Exception('yt must have one value per OASIS instance')
+    if C is None:
+        _map_ranges(lambda start, stop: refs.fit_next_range(yt_, start, stop), len(oases), n_threads)
+    else:
+        C_ = C
+        if t >= C_.shape[1] or row_offset + len(oases) > C_.shape[0]:
+            raise Exception('C is too small')
+
+        def func(start, stop):
+            refs.fit_next_range(yt_, start, stop)
+            refs.c_of_last_pool_range(C_, t, row_offset, start, stop)
+        _map_ranges(func, len(oases), n_threads)
+    return oases
+
+
 @cython.cdivision(True)
 def oasisAR1(np.ndarray[SINGLE, ndim=1] y, SINGLE g, SINGLE lam=0, SINGLE s_min=0):
     """ Infer the most likely discretized spike train underlying an AR(1) fluorescence trace
@@ -743,9 +743,9 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
                 fitness_delta, erfc_delta, std_rr, _ = compute_event_exceptionality(
                     np.diff(cin_res)[None, :], robust_std=robust_std, N=N_samples_exceptionality)
                 if remove_baseline:
+                    from caiman.source_extraction.cnmf.running_percentile import running_percentile
                     num_samps_bl = min(len(cin_res) // 5, 800)
-                    bl = scipy.ndimage.percentile_filter(
-                        cin_res, 8, size=num_samps_bl)
+                    bl = running_percentile(cin_res, 8, num_samps_bl)
                 else:
                     bl = 0
                 fitness_raw, erfc_raw, std_rr, _ = compute_event_exceptionality(
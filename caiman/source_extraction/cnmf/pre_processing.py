@@ -23,8 +23,8 @@ See Also:
 from __future__ import division
 from __future__ import print_function
 
-import shutil
-import tempfile
+from multiprocessing.pool import ThreadPool
+import os
 
 import numpy as np
 import scipy
@@ -156,9 +156,13 @@ def get_noise_welch(Y, noise_range=[0.25, 0.5], noise_method='logmexp',
 
 
 def get_noise_fft(Y, noise_range=[0.25, 0.5], noise_method='logmexp', max_num_samples_fft=3072,
-                  opencv=True):
+                  opencv=True, n_threads=1, return_psd=True):
     """Estimate the noise level for each pixel by averaging the power spectral density.
 
+    Pixels are processed in blocks of contiguous rows (one batched transform along time per
+    block, blocks distributed over threads), so that memory mapped movies are read block by block
+    and only the PSD bins within noise_range are kept.
+
     Inputs:
     -------
 
@@ -177,23 +181,39 @@ def get_noise_fft(Y, noise_range=[0.25, 0.5], noise_method='logmexp', max_num_sa
             'median': Median
             'logmexp': Exponential of the mean of the logarithm of PSD (default)
 
+    opencv: bool
+        use cv2.dft (on rows) instead of np.fft.rfft
+
+    n_threads: int
+        number of threads processing the pixel blocks (default: 1, serial)
+
+    return_psd: bool
+        if False the PSD of the pixels is not kept and None is returned in its place
+
     Output:
     ------
     sn: np.ndarray
         Noise level for each pixel
+
+    psdx: np.ndarray
+        PSD of each pixel within noise_range (None if not return_psd)
     """
     T = Y.shape[-1]
     # Y=np.array(Y,dtype=np.float64)
 
     if T > max_num_samples_fft:
-        Y = np.concatenate((Y[..., 1:max_num_samples_fft // 3 + 1],
-                            Y[..., np.int(T // 2 - max_num_samples_fft / 3 / 2)
-                                          :np.int(T // 2 + max_num_samples_fft / 3 / 2)],
-                            Y[..., -max_num_samples_fft // 3:]), axis=-1)
-        T = np.shape(Y)[-1]
+        # beginning, middle and end of the recording
+        samples = [slice(1, max_num_samples_fft // 3 + 1),
+                   slice(np.int(T // 2 - max_num_samples_fft / 3 / 2),
+                         np.int(T // 2 + max_num_samples_fft / 3 / 2)),
+                   slice(-max_num_samples_fft // 3, None)]
+        sub_T = np.sum([len(range(T)[sl]) for sl in samples])
+    else:
+        samples = None
+        sub_T = T
 
     # we create a map of what is the noise on the FFT space
-    ff = np.arange(0, 0.5 + 1. / T, 1. / T)
+    ff = np.arange(0, 0.5 + 1. / sub_T, 1. / sub_T)
     ind1 = ff > noise_range[0]
     ind2 = ff <= noise_range[1]
     ind = np.logical_and(ind1, ind2)
@@ -205,22 +225,50 @@ def get_noise_fft(Y, noise_range=[0.25, 0.5], noise_method='logmexp', max_num_sa
                 cv2.setNumThreads(0)
             except:
                 pass
-            psdx = []
-            for y in Y.reshape(-1, T):
-                dft = cv2.dft(y, flags=cv2.DFT_COMPLEX_OUTPUT).squeeze()[
-                    :len(ind)][ind]
-                psdx.append(np.sum(1. / T * dft * dft, 1))
-            psdx = np.reshape(psdx, Y.shape[:-1] + (-1,))
+
+        Yr = Y.reshape(-1, T)
+        n_pixels = Yr.shape[0]
+        sn = np.zeros(n_pixels)
+        psdx = np.zeros((n_pixels, np.sum(ind))) if return_psd else None
+
+        def psd_block(pixels):
+            if samples is None:
+                y = np.asarray(Yr[pixels])
+            else:
+                y = np.concatenate([Yr[pixels, sl] for sl in samples], axis=-1)
+            if opencv:
+                dft = cv2.dft(y, flags=cv2.DFT_COMPLEX_OUTPUT + cv2.DFT_ROWS)[:, :len(ind)][:, ind]
+                psd = np.sum(1. / sub_T * dft * dft, -1)
+            else:
+                xdft = np.fft.rfft(y, axis=-1)
+                xdft = xdft[..., ind[:xdft.shape[-1]]]
+                psd = 1. / sub_T * abs(xdft)**2
+            psd *= 2
+            sn[pixels] = mean_psd(psd, method=noise_method)
+            if return_psd:
+                psdx[pixels] = psd
+
+        # blocks of about 16 MB of input
+        block_size = max(1, 2**21 // sub_T)
+        blocks = [slice(i, min(i + block_size, n_pixels)) for i in range(0, n_pixels, block_size)]
+        if n_threads > 1 and len(blocks) > 1:
+            pool = ThreadPool(min(n_threads, len(blocks)))
+            try:
+                pool.map(psd_block, blocks)
+            finally:
+                pool.close()
         else:
-            xdft = np.fft.rfft(Y, axis=-1)
-            xdft = xdft[..., ind[:xdft.shape[-1]]]
-            psdx = 1. / T * abs(xdft)**2
-        psdx *= 2
-        sn = mean_psd(psdx, method=noise_method)
+            list(map(psd_block, blocks))
+
+        sn = sn.reshape(Y.shape[:-1])
+        if return_psd:
+            psdx = psdx.reshape(Y.shape[:-1] + (-1,))
 
     else:
+        if samples is not None:
+            Y = np.concatenate([Y[sl] for sl in samples])
         xdft = np.fliplr(np.fft.rfft(Y))
-        psdx = 1. / T * (xdft**2)
+        psdx = 1. / sub_T * (xdft**2)
         psdx[1:] *= 2
         sn = mean_psd(psdx[ind[:psdx.shape[0]]], method=noise_method)
 
@@ -253,10 +301,6 @@ def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
     sn: ndarray(double)
         noise associated to each pixel
     """
-    folder = tempfile.mkdtemp()
-
-    # Pre-allocate a writeable shared memory map as a container for the
-    # results of the parallel computation
     pixel_groups = list(
         range(0, Y.shape[0] - n_pixels_per_process + 1, n_pixels_per_process))
 
@@ -296,22 +340,50 @@ def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
 
     _, _, psx_ = results[0]
     sn_s = np.zeros(Y.shape[0])
-    psx_s = np.zeros((Y.shape[0], psx_.shape[-1]))
+    psx_s = None if psx_ is None else np.zeros((Y.shape[0], psx_.shape[-1]))
     for idx, sn, psx_ in results:
         sn_s[idx] = sn
-        psx_s[idx, :] = psx_
+        if psx_s is not None:
+            psx_s[idx, :] = psx_
 
-    sn_s = np.array(sn_s)
-    psx_s = np.array(psx_s)
+    return sn_s, psx_s
+#%%
 
-    try:
-        shutil.rmtree(folder)
 
-    except:
-        print(("Failed to delete: " + folder))
-        raise
+def noise_cache_key(Y, noise_range, noise_method, max_num_samples_fft):
+    """Name of the file caching the noise of a memory mapped movie, and the key identifying the estimate
+
+    The cache lives alongside the memory mapped file and is keyed by its header (the file name encodes
+    dimensions, order and number of frames), size and modification time together with the parameters
+    of the estimate. Only movies covering a whole memory mapped file opened read only can be cached,
+    as the modifications of a writable one need not be flushed yet.
+
+    Parameters:
+    ----------
+    Y: np.memmap
+        input movie (n_pixels x Time)
+
+    noise_range, noise_method, max_num_samples_fft:
+        parameters of get_noise_fft
+
+    Returns:
+    -------
+    cache_file: str
+        name of the cache file (None if Y is not a whole read only memory mapped file)
+
+    key: str
+        key of the estimate
+    """
+    fname = getattr(Y, 'filename', None)
+    if (fname is None or getattr(Y, 'mode', None) != 'r' or not os.path.isfile(fname) or
+            not Y.flags['C_CONTIGUOUS'] or Y.nbytes != os.path.getsize(fname)):
+        return None, None
+
+    key = str((os.path.split(fname)[-1], os.path.getsize(fname), os.path.getmtime(fname), Y.shape,
+               str(Y.dtype), list(noise_range), noise_method, max_num_samples_fft))
+    return os.path.splitext(fname)[0] + '_sn.npz', key
+
 
-    return sn_s, psx_s
 #%%
 
 
@@ -468,31 +540,26 @@ def estimate_time_constant(Y, sn, p=None, lags=5, include_noise=False, pixels=No
     if pixels is None:
         pixels = np.arange(old_div(np.size(Y), np.shape(Y)[-1]))
 
-    from scipy.linalg import toeplitz
     npx = len(pixels)
     lags += p
-    XC = np.zeros((npx, 2 * lags + 1))
-    for j in range(npx):
-        XC[j, :] = np.squeeze(axcov(np.squeeze(Y[pixels[j], :]), lags))
+    # autocovariances of blocks of pixels, one FFT pass per block
+    n_fft = np.power(2, nextpow2(2 * np.shape(Y)[-1] - 1))
+    block_size = max(1, 2**22 // n_fft)
+    XC = np.concatenate([axcov(np.asarray(Y[pixels[i:i + block_size]], dtype=np.float64), lags)
+                         for i in range(0, npx, block_size)])
 
-    gv = np.zeros(npx * lags)
+    # stacked Toeplitz systems of all the pixels
     if not include_noise:
         XC = XC[:, np.arange(lags - 1, -1, -1)]
         lags -= p
-
-    A = np.zeros((npx * lags, p))
-    for i in range(npx):
-        if not include_noise:
-            A[i * lags + np.arange(lags), :] = toeplitz(np.squeeze(XC[i, np.arange(
-                p - 1, p + lags - 1)]), np.squeeze(XC[i, np.arange(p - 1, -1, -1)]))
-        else:
-            A[i * lags + np.arange(lags), :] = toeplitz(np.squeeze(XC[i, lags + np.arange(
-                lags)]), np.squeeze(XC[i, lags + np.arange(p)])) - (sn[i]**2) * np.eye(lags, p)
-            gv[i * lags + np.arange(lags)] = np.squeeze(XC[i, lags + 1:])
-
-    if not include_noise:
-        gv = XC[:, p:].T
-        gv = np.squeeze(np.reshape(gv, (np.size(gv), 1), order='F'))
+        A = XC[:, p - 1 + np.arange(lags)[:, None] - np.arange(p)]
+        gv = XC[:, p:]
+    else:
+        A = XC[:, lags + np.abs(np.arange(lags)[:, None] - np.arange(p))] - \
+            np.reshape(np.asarray(sn)[pixels]**2, (-1, 1, 1)) * np.eye(lags, p)
+        gv = XC[:, lags + 1:]
+    A = A.reshape((npx * lags, p))
+    gv = gv.ravel()
 
     g = np.dot(np.linalg.pinv(A), gv)
 
@@ -507,7 +574,7 @@ def axcov(data, maxlag=5):
     Parameters:
     ----------
     data : array
-        Array containing fluorescence data
+        Array containing fluorescence data (one trace per row if two dimensional)
 
     maxlag : int
         Number of lags to use in autocovariance calculation
@@ -515,18 +582,16 @@ def axcov(data, maxlag=5):
     Returns:
     -------
     axcov : array
-        Autocovariances computed from -maxlag:0:maxlag
+        Autocovariances computed from -maxlag:0:maxlag (along the last axis)
     """
 
-    data = data - np.mean(data)
-    T = len(data)
-    bins = np.size(data)
-    xcov = np.fft.fft(data, np.power(2, nextpow2(2 * bins - 1)))
-    xcov = np.fft.ifft(np.square(np.abs(xcov)))
-    xcov = np.concatenate([xcov[np.arange(xcov.size - maxlag, xcov.size)],
-                           xcov[np.arange(0, maxlag + 1)]])
+    data = data - np.mean(data, axis=-1, keepdims=True)
+    T = np.shape(data)[-1]
+    n_fft = np.power(2, nextpow2(2 * T - 1))
+    xcov = np.fft.irfft(np.square(np.abs(np.fft.rfft(data, n_fft))), n_fft)
+    xcov = np.concatenate([xcov[..., n_fft - maxlag:], xcov[..., :maxlag + 1]], axis=-1)
     #xcov = xcov/np.concatenate([np.arange(T-maxlag,T+1),np.arange(T-1,T-maxlag-1,-1)])
-    return np.real(old_div(xcov, T))
+    return old_div(xcov, T)
 
 
 #%%
@@ -550,7 +615,7 @@ def nextpow2(value):
     return exponent
 
 
-def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100, noise_range=[0.25, 0.5], noise_method='logmexp', compute_g=False, p=2, lags=5, include_noise=False, pixels=None, max_num_samples_fft=3000, check_nan=True):
+def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100, noise_range=[0.25, 0.5], noise_method='logmexp', compute_g=False, p=2, lags=5, include_noise=False, pixels=None, max_num_samples_fft=3000, check_nan=True, cache_noise=False):
     """
     Performs the pre-processing operations described above.
 
@@ -585,6 +650,10 @@ def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100, noise_rang
             'median': Median
             'logmexp': Exponential of the mean of the logarithm of PSD (default)
 
+    cache_noise: bool
+        if Y is a whole memory mapped file opened read only, store the noise estimate alongside it and
+        reuse it in subsequent calls on the same file with the same parameters (default False)
+
     Returns:
     -------
         Y: ndarray
@@ -603,16 +672,28 @@ def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100, noise_rang
     if check_nan:
         Y, coor = interpolate_missing_data(Y)
 
+    if sn is None:
+        cache_file, key = noise_cache_key(Y, noise_range, noise_method, max_num_samples_fft) \
+            if cache_noise else (None, None)
+        if cache_file is not None and os.path.isfile(cache_file):
+            with np.load(cache_file) as ld:
+                if str(ld['key']) == key:
+                    print('using cached noise estimate ' + cache_file)
+                    sn = ld['sn']
+
     if sn is None:
         if dview is None:
             sn, psx = get_noise_fft(Y, noise_range=noise_range, noise_method=noise_method,
-                                    max_num_samples_fft=max_num_samples_fft)
+                                    max_num_samples_fft=max_num_samples_fft, return_psd=False)
         else:
             sn, psx = get_noise_fft_parallel(Y, n_pixels_per_process=n_pixels_per_process, dview=dview,
                                              noise_range=noise_range, noise_method=noise_method,
-                                             max_num_samples_fft=max_num_samples_fft)
-    else:
-        psx = None
+                                             max_num_samples_fft=max_num_samples_fft, return_psd=False)
+        if cache_file is not None:
+            try:
+                np.savez(cache_file, sn=sn, key=key)
+            except (IOError, OSError):
+                print('could not cache the noise estimate in ' + cache_file)
 
     if compute_g:
         g = estimate_time_constant(Y, sn, p=p, lags=lags,
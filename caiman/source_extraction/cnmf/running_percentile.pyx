@@ -0,0 +1,326 @@
+"""Exact running percentiles of many traces over sliding windows of frames
+
+For a window of w samples and the k-th smallest of them, the samples are split between a max-heap
+holding the k + 1 smallest and a min-heap holding the others, so that the percentile is the top of
+the first heap. Sliding the window overwrites the oldest sample with the newest one in place and
+restores both heaps in O(log w) steps. The streaming mode, whose windows grow until they are full,
+keeps the samples of each window in a sorted buffer instead.
+"""
+
+import numpy as np
+cimport numpy as np
+cimport cython
+from libc.string cimport memmove
+from caiman.source_extraction.cnmf.oasis import _map_ranges
+
+ctypedef np.float64_t DOUBLE
+
+
+cdef inline Py_ssize_t _lower_bound(DOUBLE* buf, Py_ssize_t n, DOUBLE v) noexcept nogil:
+    # position of the first of the n sorted values in buf that is not less than v,
+    # found without data dependent branches
+    cdef DOUBLE* base = buf
+    cdef Py_ssize_t half
+    if n == 0:
+        return 0
+    while n > 1:
+        half = n >> 1
+        base += (base[half - 1] < v) * half
+        n -= half
+    return (base - buf) + (base[0] < v)
+
+
+cdef inline void _insert(DOUBLE* buf, Py_ssize_t n, DOUBLE v) noexcept nogil:
+    # insert v into the n sorted values in buf
+    cdef Py_ssize_t i = _lower_bound(buf, n, v)
+    memmove(buf + i + 1, buf + i, (n - i) * sizeof(DOUBLE))
+    buf[i] = v
+
+
+cdef inline void _replace(DOUBLE* buf, Py_ssize_t n, DOUBLE old, DOUBLE new) noexcept nogil:
+    # replace old by new in the n sorted values in buf, shifting only the values in between
+    cdef Py_ssize_t i = _lower_bound(buf, n, old), j
+    if new > old:
+        j = i + 1 + _lower_bound(buf + i + 1, n - i - 1, new)
+        memmove(buf + i, buf + i + 1, (j - i - 1) * sizeof(DOUBLE))
+        buf[j - 1] = new
+    elif new < old:
+        j = _lower_bound(buf, i, new)
+        memmove(buf + j + 1, buf + j, (i - j) * sizeof(DOUBLE))
+        buf[j] = new
+
+
+@cython.cdivision(True)
+cdef inline Py_ssize_t _reflect(Py_ssize_t i, Py_ssize_t T) noexcept nogil:
+    # index of sample i of a trace extended at both ends by reflection (c b a | a b c | c b a)
+    i %= 2 * T
+    if i < 0:
+        i += 2 * T
+    if i >= T:
+        i = 2 * T - 1 - i
+    return i
+
+
+cdef struct Heaps:
+    DOUBLE* val         # sample at each position of the window
+    Py_ssize_t* lo      # max-heap of the positions of the n_lo smallest samples
+    Py_ssize_t* hi      # min-heap of the positions of the n_hi other samples
+    Py_ssize_t* where   # index of each position in lo, or n_lo + index in hi
+    Py_ssize_t n_lo, n_hi
+
+
+cdef inline void _heap_swap(Heaps* m, Py_ssize_t* h, Py_ssize_t off, Py_ssize_t i,
+                            Py_ssize_t j) noexcept nogil:
+    cdef Py_ssize_t p = h[i]
+    h[i] = h[j]
+    h[j] = p
+    m.where[h[i]] = off + i
+    m.where[h[j]] = off + j
+
+
+cdef inline void _sift_up(Heaps* m, Py_ssize_t* h, Py_ssize_t off, Py_ssize_t i,
+                          DOUBLE sign) noexcept nogil:
+    # sign = 1 for the max-heap and -1 for the min-heap
+    cdef Py_ssize_t parent
+    while i > 0:
+        parent = (i - 1) >> 1
+        if sign * m.val[h[parent]] >= sign * m.val[h[i]]:
+            break
+        _heap_swap(m, h, off, i, parent)
+        i = parent
+
+
+cdef inline void _sift_down(Heaps* m, Py_ssize_t* h, Py_ssize_t off, Py_ssize_t n, Py_ssize_t i,
+                            DOUBLE sign) noexcept nogil:
+    cdef Py_ssize_t c
+    while True:
+        c = 2 * i + 1
+        if c >= n:
+            break
+        if c + 1 < n and sign * m.val[h[c + 1]] > sign * m.val[h[c]]:
+            c += 1
+        if sign * m.val[h[i]] >= sign * m.val[h[c]]:
+            break
+        _heap_swap(m, h, off, i, c)
+        i = c
+
+
+cdef inline void _balance(Heaps* m) noexcept nogil:
+    # exchange the tops of the heaps until all samples in lo are not larger than those in hi
+    cdef Py_ssize_t p
+    while m.n_hi > 0 and m.val[m.lo[0]] > m.val[m.hi[0]]:
+        p = m.lo[0]
+        m.lo[0] = m.hi[0]
+        m.hi[0] = p
+        m.where[m.lo[0]] = 0
+        m.where[m.hi[0]] = m.n_lo
+        _sift_down(m, m.lo, 0, m.n_lo, 0, 1)
+        _sift_down(m, m.hi, m.n_lo, m.n_hi, 0, -1)
+
+
+cdef inline void _heap_replace(Heaps* m, Py_ssize_t p, DOUBLE v) noexcept nogil:
+    # overwrite the sample at position p of the window with v
+    cdef Py_ssize_t i = m.where[p]
+    cdef DOUBLE old = m.val[p]
+    m.val[p] = v
+    if i < m.n_lo:
+        if v > old:
+            _sift_up(m, m.lo, 0, i, 1)
+        else:
+            _sift_down(m, m.lo, 0, m.n_lo, i, 1)
+    else:
+        if v < old:
+            _sift_up(m, m.hi, m.n_lo, i - m.n_lo, -1)
+        else:
+            _sift_down(m, m.hi, m.n_lo, m.n_hi, i - m.n_lo, -1)
+    _balance(m)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _running_rank(DOUBLE* y, DOUBLE* out, Py_ssize_t T, Py_ssize_t w, Py_ssize_t rank,
+                        DOUBLE* val, Py_ssize_t* pos) noexcept nogil:
+    # val: space for w samples, pos: space for 2 * w positions
+    cdef Heaps m
+    cdef Py_ssize_t t, p, i, half = w // 2
+    m.val = val
+    m.lo = pos
+    m.hi = pos + rank + 1
+    m.where = pos + w
+    m.n_lo = rank + 1
+    m.n_hi = w - rank - 1
+    for p in range(w):
+        val[p] = y[_reflect(p - half, T)]
+        pos[p] = p
+        m.where[p] = p
+    for p in range(m.n_lo // 2 - 1, -1, -1):
+        _sift_down(&m, m.lo, 0, m.n_lo, p, 1)
+    for p in range(m.n_hi // 2 - 1, -1, -1):
+        _sift_down(&m, m.hi, m.n_lo, m.n_hi, p, -1)
+    _balance(&m)
+    out[0] = val[m.lo[0]]
+    p = 0
+    for t in range(1, T):
+        i = t - half + w - 1
+        _heap_replace(&m, p, y[i] if i < T else y[_reflect(i, T)])
+        out[t] = val[m.lo[0]]
+        p += 1
+        if p == w:
+            p = 0
+
+
+def _ranks(q, Py_ssize_t w, Py_ssize_t N):
+    """ position of the q-th percentile in a sorted window of w samples, as in scipy.ndimage """
+    q = np.broadcast_to(np.asarray(q, dtype=np.float64), (N,)).copy()
+    q[q < 0] += 100
+    if np.any(q < 0) or np.any(q > 100):
+        raise ValueError('invalid percentile')
+    return np.where(q == 100, w - 1, (w * q / 100.).astype(np.intp)).astype(np.intp)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _running_percentile_range(DOUBLE[:, ::1] Y, DOUBLE[:, ::1] out, Py_ssize_t[::1] ranks,
+                                    Py_ssize_t w, Py_ssize_t start, Py_ssize_t stop):
+    cdef Py_ssize_t n, T = Y.shape[1]
+    cdef DOUBLE[::1] val = np.empty(w)
+    cdef Py_ssize_t[::1] pos = np.empty(2 * w, dtype=np.intp)
+    if T == 0:
+        return
+    with nogil:
+        for n in range(start, stop):
+            _running_rank(&Y[n, 0], &out[n, 0], T, w, ranks[n], &val[0], &pos[0])
+
+
+def running_percentile(Y, q, Py_ssize_t frames_window, int n_threads=1):
+    """
+    exact running percentile of each trace over a centered window of frames
+
+    The result equals scipy.ndimage.percentile_filter(y, q, frames_window) for each trace y, with the
+    traces extended by reflection at both ends, at a cost of O(log(frames_window)) per frame.
+
+    Parameters
+    ----------
+    Y : array of float, shape (N, T) or (T,)
+        Traces, one per row.
+    q : float or array of float, shape (N,)
+        Percentile in [0, 100], either for all traces or one for each trace.
+    frames_window : int
+        Number of frames of the running window.
+    n_threads : int, optional, default 1
+        Traces are processed without the GIL, split across this many threads.
+
+    Returns
+    -------
+    array of float, same shape as Y
+        Running percentile of each trace.
+    """
+    Y_ = np.ascontiguousarray(np.atleast_2d(Y), dtype=np.float64)
+    if frames_window < 1:
+        raise ValueError('frames_window must be positive')
+    out = np.empty_like(Y_)
+    ranks = _ranks(q, frames_window, len(Y_))
+
+    def fit_range(Py_ssize_t start, Py_ssize_t stop):
+        _running_percentile_range(Y_, out, ranks, frames_window, start, stop)
+
+    _map_ranges(fit_range, len(Y_), n_threads)
+    return out.reshape(np.shape(Y)).astype(np.result_type(Y, np.float32), copy=False)
+
+
+cdef class RunningPercentile:
+    """
+    streaming exact percentile of many traces over their most recent frames
+
+    Every call to update adds one frame to all traces and returns the percentile of the last
+    frames_window samples of each trace (of all samples seen, while fewer have arrived).
+
+    Parameters
+    ----------
+    N : int
+        Number of traces.
+    q : float or array of float, shape (N,)
+        Percentile in [0, 100], either for all traces or one for each trace.
+    frames_window : int
+        Number of frames of the running window.
+
+    Attributes
+    ----------
+    t : int
+        Number of frames seen so far.
+    """
+    cdef DOUBLE[:, ::1] buf     # samples of each window, sorted
+    cdef DOUBLE[:, ::1] ring    # samples of each window, in order of arrival
+    cdef DOUBLE[::1] q
+    cdef readonly Py_ssize_t N, frames_window, t
+
+    def __init__(self, Py_ssize_t N, q, Py_ssize_t frames_window):
+        if frames_window < 1:
+            raise ValueError('frames_window must be positive')
+        self.N = N
+        self.frames_window = frames_window
+        self.t = 0
+        q = np.broadcast_to(np.asarray(q, dtype=np.float64), (N,)).copy()
+        q[q < 0] += 100
+        if np.any(q < 0) or np.any(q > 100):
+            raise ValueError('invalid percentile')
+        self.q = q
+        self.buf = np.empty((N, frames_window))
+        self.ring = np.empty((N, frames_window))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def update(self, yt):
+        """
+        add the next frame of all traces
+
+        Parameters
+        ----------
+        yt : array of float, shape (N,)
+            Next sample of each trace.
+
+        Returns
+        -------
+        array of float, shape (N,)
+            Percentile of each trace over its current window.
+        """
+        cdef DOUBLE[::1] y = np.ascontiguousarray(yt, dtype=np.float64).ravel()
+        if y.shape[0] != self.N:
+            raise ValueError('expected one sample for each of the %d traces' % self.N)
+        cdef np.ndarray[DOUBLE, ndim=1] out = np.empty(self.N)
+        cdef Py_ssize_t n, rank, w = self.frames_window
+        cdef Py_ssize_t pos = self.t % w, count = min(self.t, w), size = min(self.t + 1, w)
+        with nogil:
+            for n in range(self.N):
+                if count == w:
+                    _replace(&self.buf[n, 0], w, self.ring[n, pos], y[n])
+                else:
+                    _insert(&self.buf[n, 0], count, y[n])
+                self.ring[n, pos] = y[n]
+                if self.q[n] == 100:
+                    rank = size - 1
+                else:
+                    rank = <Py_ssize_t>(size * self.q[n] / 100.)
+                out[n] = self.buf[n, rank]
+        self.t += 1
+        return out
+
+    def fit(self, Y):
+        """
+        add many frames of all traces
+
+        Parameters
+        ----------
+        Y : array of float, shape (N, T)
+            Next T samples of each trace.
+
+        Returns
+        -------
+        array of float, shape (N, T)
+            Percentile of each trace over its window ending at each of the T frames.
+        """
+        Y = np.asarray(Y, dtype=np.float64).reshape(self.N, -1)
+        out = np.empty_like(Y)
+        for t in range(Y.shape[1]):
+            out[:, t] = self.update(Y[:, t])
+        return out
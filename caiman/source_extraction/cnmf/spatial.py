@@ -48,7 +48,8 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
                               method='ellipse', expandCore=None, dview=None, n_pixels_per_process=128,
                               medw=(3, 3), thr_method='nrg', maxthr=0.1, nrgthr=0.9999, extract_cc=True, b_in=None,
                               se=np.ones((3, 3), dtype=np.int), ss=np.ones((3, 3), dtype=np.int), nb=1,
-                              method_ls='lasso_lars', update_background_components=True, low_rank_background=True, block_size=1000, num_blocks_per_run=20):
+                              method_ls='lasso_lars', update_background_components=True, low_rank_background=True, block_size=1000, num_blocks_per_run=20,
+                              return_removed=False):
     """update spatial footprints and background through Basis Pursuit Denoising
 
     for each pixel i solve the problem
@@ -117,6 +118,8 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
              'nnls_L0'. Nonnegative least square with L0 penalty
              'lasso_lars' lasso lars function from scikit learn
              'lasso_lars_old' lasso lars from old implementation, will be deprecated
+             'hals' block coordinate descent (HALS) updating all the footprints of a pixel block at once,
+                    restricted to the search locations and with the same l1 penalty as 'lasso_lars'
 
         normalize_yyt_one: bool
             wheter to norrmalize the C and A matrices so that diag(C*C.T) are ones
@@ -128,6 +131,9 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
         whether to update the using a low rank approximation. In the False case all the nonzero elements of the background components are updated using hals
         (to be used with one background per patch)
 
+    return_removed: bool
+        whether to also return the indices of the removed (empty) components
+
 
     Returns:
     --------
@@ -143,6 +149,9 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     f: np.ndarray
         same as f_in except if empty component deleted.
 
+    removed: np.ndarray
+        indices in A_in of the components that were removed, only if return_removed
+
     Raise:
     -------
     Exception('You need to define the input dimensions')
@@ -192,32 +201,49 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     if b_in is None:
         b_in = b_
 
-    print('memmaping')
-    # we create a memory map file if not already the case, we send Cf, a
-    # matrix that include background components
-    C_name, Y_name, folder = creatememmap(Y, np.vstack((C, f)), dview)
+    # single pass over Y for the sufficient statistics: Y*[C;f]' for hals (which never reads Y again),
+    # only Y*f' for the other methods since the per pixel regressions need the raw traces
+    Cf = np.vstack((C, f))
+    print("Computing Y*Cf'" if method_ls == 'hals' else "Computing Y*f'")
+    if 'memmap' in str(type(Y)):
+        YCf = parallel_dot_product(Y, Cf.T if method_ls == 'hals' else f.T, dview=dview,
+                                   block_size=block_size, num_blocks_per_run=num_blocks_per_run)
+    else:
+        YCf = np.dot(Y, Cf.T if method_ls == 'hals' else f.T)
+    Y_f = YCf[:, -f.shape[0]:] if f.shape[0] > 0 else YCf[:, :0]
+    f_idx = np.arange(f.shape[0])
 
     # we create a pixel group array (chunks for the cnmf)for the parrallelization of the process
-    print('Updating Spatial Components using lasso lars')
     cct = np.diag(C.dot(C.T))
-    pixel_groups = []
-    for i in range(0, np.prod(dims) - n_pixels_per_process + 1, n_pixels_per_process):
-        pixel_groups.append([Y_name, C_name, sn, ind2_, list(
-            range(i, i + n_pixels_per_process)), method_ls, cct, ])
-    if i < np.prod(dims):
-        pixel_groups.append([Y_name, C_name, sn, ind2_, list(
-            range(i, np.prod(dims))), method_ls, cct])
+    folder = None
+    if method_ls == 'hals':
+        print('Updating Spatial Components using block HALS')
+        pixel_groups = hals_pixel_groups(YCf, sn, ind2_, A_in, b_in, Cf, d, n_pixels_per_process, cct)
+    else:
+        print('memmaping')
+        # we create a memory map file if not already the case, we send Cf, a
+        # matrix that include background components
+        C_name, Y_name, folder = creatememmap(Y, Cf, dview)
+        print('Updating Spatial Components using lasso lars')
+        pixel_groups = []
+        for i in range(0, np.prod(dims) - n_pixels_per_process + 1, n_pixels_per_process):
+            pixel_groups.append([Y_name, C_name, sn, ind2_, list(
+                range(i, i + n_pixels_per_process)), method_ls, cct, ])
+        if i < np.prod(dims):
+            pixel_groups.append([Y_name, C_name, sn, ind2_, list(
+                range(i, np.prod(dims))), method_ls, cct])
+    regression_fun = regression_hals if method_ls == 'hals' else regression_ipyparallel
     A_ = np.zeros((d, nr + np.size(f, 0)))  # init A_
     if dview is not None:
         if 'multiprocessing' in str(type(dview)):
             parallel_result = dview.map_async(
-                regression_ipyparallel, pixel_groups).get(4294967)
+                regression_fun, pixel_groups).get(4294967)
         else:
             parallel_result = dview.map_sync(
-                regression_ipyparallel, pixel_groups)
+                regression_fun, pixel_groups)
             dview.results.clear()
     else:
-        parallel_result = list(map(regression_ipyparallel, pixel_groups))
+        parallel_result = list(map(regression_fun, pixel_groups))
 
     for chunk in parallel_result:
         for pars in chunk:
@@ -229,8 +255,10 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
                               maxthr=maxthr, nrgthr=nrgthr, extract_cc=extract_cc, se=se, ss=ss)
 
     ff = np.where(np.sum(A_, axis=0) == 0)  # remove empty components
+    removed = np.array([], dtype=int)
     if np.size(ff) > 0:
         ff = ff[0]
+        removed = ff[ff < nr]
         print('eliminating {} empty spatial components'.format(len(ff)))
         A_ = np.delete(A_, list(ff[ff < nr]), 1)
         C = np.delete(C, list(ff[ff < nr]), 0)
@@ -242,17 +270,14 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
             background_ff = list(filter(lambda i: i >= 0, ff - nr))
             f = np.delete(f, background_ff, 0)
             b_in = np.delete(b_in, background_ff, 1)
+        f_idx = np.delete(f_idx, background_ff)
 
     A_ = A_[:, :nr]
     A_ = coo_matrix(A_)
 
     print("Computing residuals")
-    if 'memmap' in str(type(Y)):
-        Y_resf = parallel_dot_product(Y, f.T, dview=dview, block_size=block_size, num_blocks_per_run=num_blocks_per_run) - \
-            A_.dot(coo_matrix(C[:nr, :]).dot(f.T))
-    else:
-        # Y*f' - A*(C*f')
-        Y_resf = np.dot(Y, f.T) - A_.dot(coo_matrix(C[:nr, :]).dot(f.T))
+    # Y*f' - A*(C*f')
+    Y_resf = Y_f[:, f_idx] - A_.dot(coo_matrix(C[:nr, :]).dot(f.T))
 
     if update_background_components:
 
@@ -273,13 +298,16 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
         b = b_in
 
     print(("--- %s seconds ---" % (time.time() - start_time)))
-    try:  # clean up
-        # remove temporary file created
-        print("Removing tempfiles created")
-        shutil.rmtree(folder)
-    except:
-        raise Exception("Failed to delete: " + folder)
-
+    if folder is not None:
+        try:  # clean up
+            # remove temporary file created
+            print("Removing tempfiles created")
+            shutil.rmtree(folder)
+        except:
+            raise Exception("Failed to delete: " + folder)
+
+    if return_removed:
+        return A_, b, C, f, removed
     return A_, b, C, f
 
 
@@ -410,7 +438,108 @@ def regression_ipyparallel(pars):
     return As
 
 
+#%%
+def hals_pixel_groups(YCf, noise_sn, ind2_, A_in, b_in, Cf, d, n_pixels_per_process, cct):
+    """split the pixels in blocks for regression_hals
+
+    for each block of pixels only the components whose search location intersects the block are kept.
+    The footprints are warm started from A_in (and b_in if given) and C*C' is computed once here,
+    so that the regression only works on the sufficient statistics Y*Cf' and Cf*Cf'.
+
+    Parameters:
+    ----------
+    YCf: np.ndarray
+        product of the movie with the temporal components and background (pixels x components)
+
+    noise_sn: np.ndarray
+        noise level of each pixel
+
+    ind2_: list
+        for each pixel the indices of the components it can belong to (see computing_indicator)
+
+    A_in: sparse matrix or np.ndarray
+        current estimate of the spatial footprints (pixels x neurons)
+
+    b_in: np.ndarray or None
+        current estimate of the spatial background (pixels x nb)
+
+    Cf: np.ndarray
+        temporal components and background (components x time)
+
+    d: int
+        number of pixels
+
+    n_pixels_per_process: int
+        number of pixels in each block
+
+    cct: np.ndarray
+        squared norm of each temporal component
+
+    Returns:
+    --------
+    pixel_groups: list
+        arguments of regression_hals for each block
+    """
+    K = Cf.shape[0]
+    nr = A_in.shape[-1]
+    lens = [np.size(ind) for ind in ind2_]
+    mask = csr_matrix((np.ones(np.sum(lens), dtype=bool),
+                       (np.repeat(np.arange(d), lens),
+                        np.concatenate([np.asarray(ind, dtype=int) for ind in ind2_] + [np.zeros(0, dtype=int)]))),
+                      shape=(d, K))
+    A_init = scipy.sparse.hstack([csr_matrix(A_in), csr_matrix(
+        (d, K - nr)) if b_in is None else csr_matrix(b_in)]).tocsr()
+    CCt = Cf.dot(Cf.T)
+    lambda_cct = .5 * np.sqrt(np.max(cct)) if np.size(cct) > 0 else 0
+
+    pixel_groups = []
+    for i in range(0, d, n_pixels_per_process):
+        idxs_Y = np.arange(i, min(i + n_pixels_per_process, d))
+        mask_ = mask[idxs_Y]
+        idxs_C = np.unique(mask_.indices)
+        if len(idxs_C) == 0:
+            continue
+        mask_ = mask_[:, idxs_C].toarray()
+        A_ = A_init[idxs_Y][:, idxs_C].toarray() * mask_
+        pixel_groups.append([YCf[idxs_Y[0]:idxs_Y[-1] + 1][:, idxs_C], idxs_Y, idxs_C, mask_, A_,
+                             CCt[np.ix_(idxs_C, idxs_C)], lambda_cct * noise_sn[idxs_Y]])
+    return pixel_groups
+
+
+#%%
+def regression_hals(pars, iters=10):
+    """update the spatial footprints of a block of pixels through block coordinate descent (HALS)
+
+    for the pixels i of the block solve
+        A(i,:) = argmin 1/2 || Y(i,:) - A(i,:)*C ||^2 + lambda(i) sum(A(i,:))
+    subject to
+        A(i,:) >= 0 and A(i,j) = 0 outside of the search locations
+
+    all the pixels of the block are updated together, one component at a time
+
+    Parameters:
+    ----------
+    pars: list
+        YCt, idxs_Y, idxs_C, mask, A, CCt, lambdas as returned by hals_pixel_groups
+
+    iters: int
+        number of passes over the components
+
+    Returns:
+    --------
+    list of one (px, idxs_C, a) tuple, with px a column of pixel indices
+    """
+    # /!\ need to import since it is run from within the server
+    import numpy as np
+
+    YCt, idxs_Y, idxs_C, mask, A, CCt, lambdas = pars
+    YCt = YCt - lambdas[:, None]
+    vkk = np.maximum(np.diag(CCt), np.finfo(np.float32).eps)
+    for _ in range(iters):
+        for k in range(len(idxs_C)):
+            A[:, k] = np.maximum(A[:, k] + (YCt[:, k] - A.dot(CCt[:, k])) / vkk[k], 0) * mask[:, k]
 
+    return [(idxs_Y[:, None], idxs_C, A)]
 
 
 # %%
@@ -15,7 +15,9 @@ from scipy.sparse import spdiags, coo_matrix  # ,csgraph
 import scipy
 import numpy as np
 import platform
-from .deconvolution import constrained_foopsi
+import multiprocessing
+from .deconvolution import constrained_foopsi, estimate_parameters, constrained_oasis_batch, oasis_batch, \
+    ar_innovations
 from .utilities import update_order_greedy
 import sys
 from ...mmapping import parallel_dot_product
@@ -73,7 +75,56 @@ def constrained_foopsi_parallel(arg_in):
 
 
 #%%
-def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=None, nb=1, ITER=2, block_size=5000, num_blocks_per_run=20, debug=False, dview=None, **kwargs):
+def _oasis_batchable(argss):
+    """ whether constrained_foopsi_block deconvolves the traces of a block at once with OASIS """
+    return (argss.get('method', 'oasis') == 'oasis' and argss['p'] in (1, 2)
+            and argss.get('s_min') is None and not argss.get('optimize_g', 0))
+
+
+def constrained_foopsi_block(arg_in):
+    """ run constrained_foopsi_parallel on a block of traces
+
+        one task (and one pickling) per block of components instead of one per component.
+        The noise levels and time constants of all the traces of the block are estimated at once.
+        For OASIS with p=1 or p=2, without s_min and optimize_g, the traces of the block are then
+        deconvolved at once with deconvolution.constrained_oasis_batch, without the GIL
+
+        arg_in: Ytemp (T x number of traces), indices of the traces, parameters of constrained_foopsi,
+            optionally the baselines, time constants, noise levels and sparsity penalties of the traces,
+            which are then kept fixed, and optionally a number of threads for OASIS
+    """
+
+    Ytemp, jjs, argss = arg_in[:3]
+    if len(arg_in) > 4:
+        bl, g, sn, lam, n_threads = arg_in[3:]
+        if not _oasis_batchable(argss) or any(l is None for l in lam):
+            return [constrained_foopsi_parallel((Ytemp[:, k], None, jj, bl[k], None, g[k], sn[k], argss))
+                    for k, jj in enumerate(jjs)]
+        g = np.array([np.ravel(gg) for gg in g])
+        bl = np.array(bl, dtype=np.float32)
+        lam = np.array(lam, dtype=np.float32)
+        C = oasis_batch(Ytemp.T, g, lam, bl, n_threads)[1]
+        S = ar_innovations(C, g)
+    else:
+        n_threads = arg_in[3] if len(arg_in) == 4 else 1
+        g, sn = estimate_parameters(np.transpose(Ytemp), p=argss['p'],
+                                    range_ff=argss.get('noise_range', [.25, .5]),
+                                    method=argss.get('noise_method', 'logmexp'), lags=argss.get('lags', 5),
+                                    fudge_factor=argss.get('fudge_factor', 1.))
+        if not _oasis_batchable(argss):
+            return [constrained_foopsi_parallel((Ytemp[:, k], None, jj, None, None, g[k], sn[k], argss))
+                    for k, jj in enumerate(jjs)]
+        C, S, bl, lam = constrained_oasis_batch(np.transpose(Ytemp), g, sn,
+                                                b_nonneg=argss.get('bas_nonneg', True), n_threads=n_threads)
+    results = []
+    for k, jj in enumerate(jjs):
+        C_ = C[k] + bl[k]
+        results.append((C_, S[k], Ytemp[:, k] - C_, bl[k], C[k, 0], sn[k], np.ravel(g[k]), jj, lam[k]))
+    return results
+
+
+#%%
+def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=None, nb=1, ITER=2, block_size=5000, num_blocks_per_run=20, debug=False, dview=None, return_removed=False, **kwargs):
     """Update temporal components and background given spatial components using a block coordinate descent approach.
 
     Parameters:
@@ -132,6 +183,9 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
     memory_efficient: Bool
         whether or not to optimize for memory usage (longer running times). nevessary with very large datasets
 
+    return_removed: bool
+        whether to also return the indices of the removed (empty) components
+
     **kwargs: dict
         all parameters passed to constrained_foopsi except bl,c1,g,sn (see documentation).
          Some useful parameters are
@@ -183,6 +237,9 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
         lam: np.ndarray
         Automatically tuned sparsity parameter
 
+    removed: np.ndarray
+        indices in A of the components that were removed, only if return_removed
+
     """
 
     if 'p' not in kwargs or kwargs['p'] is None:
@@ -233,8 +290,10 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
                                                      ITER, YrA, c1, sn, g, Cin, T, nA, dview, debug, AA, kwargs)
 
     ff = np.where(np.sum(C, axis=1) == 0)  # remove empty components
+    removed = np.array([], dtype=int)
     if np.size(ff) > 0:  # Eliminating empty temporal components
         ff = ff[0]
+        removed = ff[ff < nr]
         keep = list(range(A.shape[1]))
         for i in ff:
             keep.remove(i)
@@ -258,6 +317,8 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
     C = C[:nr, :]
     YrA = np.array(YrA[:, :nr]).T
 
+    if return_removed:
+        return C, A, b, f, S, bl, c1, sn, g, YrA, lam, removed
     return C, A, b, f, S, bl, c1, sn, g, YrA, lam
 
 
@@ -327,6 +388,7 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
     Note:
     ------
     The temporal components are updated in parallel by default by forming of sequence of vertex covers.
+    The components of a vertex cover are sent in a few blocks of traces (four per worker).
 
     Returns:
     --------
@@ -355,6 +417,23 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
 """
 
     lam = np.repeat(None, nr)
+    if dview is None:
+        n_workers = 1
+    elif 'multiprocessing' in str(type(dview)):
+        # a pool does not expose its size, setup_cluster starts one worker per core
+        n_workers = multiprocessing.cpu_count()
+    else:
+        n_workers = len(dview)
+
+    if _oasis_batchable(kwargs):
+        # OASIS deconvolves a whole block at once without the GIL: one block per worker,
+        # split across the threads of this process if there is no cluster
+        n_blocks = n_workers
+        n_threads = multiprocessing.cpu_count() if dview is None else 1
+    else:
+        n_blocks = 4 * n_workers
+        n_threads = 1
+
     for _ in range(ITER):
 
         for count, jo_ in enumerate(parrllcomp):
@@ -363,18 +442,17 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
             Ytemp = YrA[:, jo.flatten()] + Cin[jo, :].T
             Ctemp = np.zeros((np.size(jo), T))
             Stemp = np.zeros((np.size(jo), T))
-            nT = nA[jo]
-            args_in = [(np.squeeze(np.array(Ytemp[:, jj])), nT[jj], jj, None,
-                        None, None, None, kwargs) for jj in range(len(jo))]
+            args_in = [(np.array(Ytemp[:, jjs]), jjs, kwargs, n_threads)
+                       for jjs in np.array_split(np.arange(len(jo)), min(len(jo), n_blocks))]
             # computing the most likely discretized spike train underlying a fluorescence trace
             if 'multiprocessing' in str(type(dview)):
                 results = dview.map_async(
-                    constrained_foopsi_parallel, args_in).get(4294967)
+                    constrained_foopsi_block, args_in).get(4294967)
 
             elif dview is not None and platform.system() != 'Darwin':
                 if debug:
                     results = dview.map_async(
-                        constrained_foopsi_parallel, args_in)
+                        constrained_foopsi_block, args_in)
                     results.get()
                     for outp in results.stdout:
                         print((outp[:-1]))
@@ -384,10 +462,11 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
                         sys.stderr.flush()
                 else:
                     results = dview.map_sync(
-                        constrained_foopsi_parallel, args_in)
+                        constrained_foopsi_block, args_in)
 
             else:
-                results = list(map(constrained_foopsi_parallel, args_in))
+                results = list(map(constrained_foopsi_block, args_in))
+            results = [chunk for block in results for chunk in block]
             # unparsing and updating the result
             for chunk in results:
                 C_, Sp_, Ytemp_, cb_, c1_, sn_, gn_, jj_, lam_ = chunk
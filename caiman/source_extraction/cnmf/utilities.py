@@ -32,8 +32,10 @@ from .initialization import greedyROI
 from ...base.rois import com
 import pylab as pl
 import scipy
+import multiprocessing
 from ...mmapping import parallel_dot_product
 from ...utils.stats import df_percentile
+from .running_percentile import running_percentile
 import logging
 
 #%%
@@ -42,7 +44,7 @@ def CNMFSetParms(Y, n_processes, K=30, gSig=[5, 5], gSiz=None, ssub=2, tsub=2, p
                  check_nan=True, normalize_init=True, options_local_NMF=None, remove_very_bad_comps=False,
                  alpha_snmf=10e2, update_background_components=True, low_rank_background=True, rolling_sum=False,
                  min_corr=.85, min_pnr=20,
-                 ring_size_factor=1.5, center_psf=False, ssub_B=2, init_iter=2):
+                 ring_size_factor=1.5, center_psf=False, ssub_B=2, init_iter=2, multiscale=False):
     """Dictionary for setting the CNMF parameters.
 
     Any parameter that is not set get a default value specified
@@ -125,6 +127,10 @@ def CNMFSetParms(Y, n_processes, K=30, gSig=[5, 5], gSiz=None, ssub=2, tsub=2, p
         options_local_NMF:
             dictionary with parameters to pass to local_NMF initializer
 
+        multiscale: False
+            refine the components found on downsampled data (ssub > 1) up a resolution
+            pyramid, with rank-1 HALS steps on the pixels of their bounding boxes
+
     SPATIAL PARAMS##########
 
         dims: dims
@@ -171,6 +177,7 @@ def CNMFSetParms(Y, n_processes, K=30, gSig=[5, 5], gSiz=None, ssub=2, tsub=2, p
             'nnls_L0'. Nonnegative least square with L0 penalty
             'lasso_lars' lasso lars function from scikit learn
             'lasso_lars_old' lasso lars from old implementation, will be deprecated
+            'hals' block coordinate descent updating all the footprints of a block of pixels at once
 
     TEMPORAL PARAMS###########
 
@@ -320,7 +327,9 @@ def CNMFSetParms(Y, n_processes, K=30, gSig=[5, 5], gSiz=None, ssub=2, tsub=2, p
                               'ring_size_factor': ring_size_factor,
                               'center_psf': center_psf,
                               'ssub_B': ssub_B,
-                              'init_iter': init_iter
+                              'init_iter': init_iter,
+                              # refine the components found on downsampled data up a resolution pyramid
+                              'multiscale': multiscale
                               }
 
     options['spatial_params'] = {
@@ -472,8 +481,7 @@ s
         C_df = Cf / Df[:, None]
 
     else:
-        Df = scipy.ndimage.percentile_filter(
-            C2, quantileMin, (frames_window, 1))
+        Df = running_percentile(C2, quantileMin, frames_window)
         C_df = Cf / Df
 
     return C_df
@@ -481,7 +489,7 @@ s
 
 #%%
 def detrend_df_f(A, b, C, f, YrA=None, quantileMin=8, frames_window=500, 
-                 flag_auto=True, use_fast=False):
+                 flag_auto=True, use_fast=False, n_threads=1):
     """ Compute DF/F signal without using the original data.
     In general much faster than extract_DF_F
 
@@ -514,6 +522,9 @@ def detrend_df_f(A, b, C, f, YrA=None, quantileMin=8, frames_window=500,
     use_fast: bool
         flag for using approximate fast percentile filtering
 
+    n_threads: int
+        number of threads computing the running quantiles
+
     Returns:
     ----------
     F_df:
@@ -547,7 +558,7 @@ def detrend_df_f(A, b, C, f, YrA=None, quantileMin=8, frames_window=500,
     T = C.shape[-1]
 
     if flag_auto:
-        data_prct, val = df_percentile(F[:frames_window], axis=1)
+        data_prct, val = df_percentile(F[:, :frames_window], axis=1)
         if frames_window is None or frames_window > T:
             Fd = np.stack([np.percentile(f, prctileMin) for f, prctileMin in
                            zip(F, data_prct)])
@@ -563,12 +574,8 @@ def detrend_df_f(A, b, C, f, YrA=None, quantileMin=8, frames_window=500,
                                               frames_window=frames_window) for
                                f, prctileMin in zip(B, data_prct)])
             else:
-                Fd = np.stack([scipy.ndimage.percentile_filter(
-                    f, prctileMin, (frames_window)) for f, prctileMin in
-                    zip(F, data_prct)])
-                Df = np.stack([scipy.ndimage.percentile_filter(
-                    f, prctileMin, (frames_window)) for f, prctileMin in
-                    zip(B, data_prct)])
+                Fd = running_percentile(F, data_prct, frames_window, n_threads)
+                Df = running_percentile(B, data_prct, frames_window, n_threads)
             F_df = (F - Fd) / (Df + Fd)
     else:
         if frames_window is None or frames_window > T:
@@ -576,14 +583,112 @@ def detrend_df_f(A, b, C, f, YrA=None, quantileMin=8, frames_window=500,
             Df = np.percentile(B, quantileMin, axis=1)
             F_df = (F - Fd) / (Df[:, None] + Fd[:, None])
         else:
-            Fd = scipy.ndimage.percentile_filter(
-                F, quantileMin, (frames_window, 1))
-            Df = scipy.ndimage.percentile_filter(
-                B, quantileMin, (frames_window, 1))
+            Fd = running_percentile(F, quantileMin, frames_window, n_threads)
+            Df = running_percentile(B, quantileMin, frames_window, n_threads)
             F_df = (F - Fd) / (Df + Fd)
     return F_df
 
 
+#%%
+def detrend_df_f_memmap(Yr, A, b, C, f, quantileMin=8, frames_window=500, flag_auto=True,
+                        use_fast=False, fname_out=None, comps_per_block=100, block_size=5000,
+                        num_blocks_per_run=20, dview=None, n_threads=None):
+    """ Compute DF/F signals including the residuals, streaming the memory mapped movie once.
+
+    The residuals of all components (see compute_residuals) are obtained from a single pass over
+    blocks of pixels of Yr. The baselines are then computed for blocks of components, in parallel
+    if dview is provided, and every block of DF/F traces is written as soon as it is ready, into
+    an array on disk if fname_out is given. The result is the same as
+    detrend_df_f(A, b, C, f, YrA=compute_residuals(Yr, A, b, C, f), ...)
+
+    Parameters:
+    -----------
+    Yr: np.memmap
+        movie in format pixels (d) x frames (T), as returned by load_memmap
+
+    A, b, C, f:
+        spatial and temporal components and background (from cnmf)
+
+    quantileMin, frames_window, flag_auto, use_fast:
+        see detrend_df_f
+
+    fname_out: str
+        name of the .npy file the DF/F traces are written to, in memory if None
+
+    comps_per_block: int
+        number of components whose baselines are computed together
+
+    block_size: int
+        number of pixels read together from Yr
+
+    num_blocks_per_run: int
+        number of pixel blocks processed in parallel
+
+    dview: client
+        cluster used for the pass over Yr and the baselines
+
+    n_threads: int
+        number of threads computing the running quantiles when dview is None
+
+    Returns:
+    ----------
+    F_df: np.ndarray or np.memmap
+        DF/F traces (# components X T)
+    """
+    if C is None:
+        logging.warning("There are no components for DF/F extraction!")
+        return None
+
+    if 'csc_matrix' not in str(type(A)):
+        A = scipy.sparse.csc_matrix(A)
+    if 'array' not in str(type(b)):
+        b = b.toarray()
+    if 'array' not in str(type(C)):
+        C = C.toarray()
+    if 'array' not in str(type(f)):
+        f = f.toarray()
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+
+    YrA = compute_residuals(Yr, A, b, C, f, dview=dview, block_size=block_size,
+                            num_blocks_per_run=num_blocks_per_run)
+
+    N, T = C.shape
+    if fname_out is None:
+        F_df = np.zeros((N, T), dtype=np.float32)
+    else:
+        F_df = np.lib.format.open_memmap(fname_out, mode='w+', dtype=np.float32, shape=(N, T))
+
+    kwargs = {'quantileMin': quantileMin, 'frames_window': frames_window,
+              'flag_auto': flag_auto, 'use_fast': use_fast}
+    pars = []
+    for start in range(0, N, comps_per_block):
+        idx = slice(start, min(start + comps_per_block, N))
+        pars.append([idx, A[:, idx], b, C[idx], f, YrA[idx], kwargs])
+
+    if dview is None:
+        kwargs['n_threads'] = n_threads
+        results = map(detrend_df_f_block, pars)
+    elif 'multiprocessing' in str(type(dview)):
+        results = dview.map_async(detrend_df_f_block, pars).get(4294967)
+    else:
+        results = dview.map_sync(detrend_df_f_block, pars)
+
+    for idx, F_df_block in results:
+        F_df[idx] = F_df_block
+
+    if fname_out is not None:
+        F_df.flush()
+
+    return F_df
+
+
+def detrend_df_f_block(pars):
+    """ DF/F signals of a block of components, see detrend_df_f_memmap """
+    idx, A, b, C, f, YrA, kwargs = pars
+    return idx, detrend_df_f(A, b, C, f, YrA=YrA, **kwargs)
+
+
 #%%
 
 def fast_prct_filt(input_data, level=8, frames_window=1000):
@@ -696,7 +801,7 @@ def detrend_df_f_auto(A, b, C, f, dims=None, YrA=None, use_annulus = True,
     B = A_ann.T.dot(b).dot(f)
     T = C.shape[-1]
 
-    data_prct, val = df_percentile(F[:frames_window], axis=1)
+    data_prct, val = df_percentile(F[:, :frames_window], axis=1)
 
     if frames_window is None or frames_window > T:
         Fd = np.stack([np.percentile(f, prctileMin) for f, prctileMin in
@@ -713,12 +818,8 @@ def detrend_df_f_auto(A, b, C, f, dims=None, YrA=None, use_annulus = True,
                                           frames_window=frames_window) for
                            f, prctileMin in zip(B, data_prct)])
         else:
-            Fd = np.stack([scipy.ndimage.percentile_filter(
-                f, prctileMin, (frames_window)) for f, prctileMin in
-                zip(F, data_prct)])
-            Df = np.stack([scipy.ndimage.percentile_filter(
-                f, prctileMin, (frames_window)) for f, prctileMin in
-                zip(B, data_prct)])
+            Fd = running_percentile(F, data_prct, frames_window)
+            Df = running_percentile(B, data_prct, frames_window)
         F_df = (F - Fd) / (Df + Fd)
 
     return F_df
@@ -874,12 +975,19 @@ def app_vertex_cover(A):
      @authors by Eftychios A. Pnevmatikakis, Simons Foundation, 2015
     """
 
+    A = scipy.sparse.csr_matrix(A, dtype=bool)
+    A.eliminate_zeros()
+    cols = A.tocsc()
+    deg = np.diff(A.indptr)            # number of remaining edges in each row
+    removed = np.zeros(A.shape[0], dtype=bool)
     L = []
-    while A.any():
-        nz = np.nonzero(A)[0]          # find non-zero edges
-        u = nz[np.random.randint(0, len(nz))]
-        A[u, :] = False
-        A[:, u] = False
+    while deg.any():
+        # same choice as picking a random nonzero entry and taking its row
+        u = np.searchsorted(np.cumsum(deg), np.random.randint(0, deg.sum()), side='right')
+        removed[u] = True
+        deg[u] = 0
+        nbrs = cols.indices[cols.indptr[u]:cols.indptr[u + 1]]
+        deg[nbrs[~removed[nbrs]]] -= 1
         L.append(u)
 
     return np.asarray(L)
@@ -990,8 +1098,7 @@ def update_order_random(A, flag_AA=True):
         AA = A.T.dot(A)
 
     AA.setdiag(0)
-    F = (AA) > 0
-    F = F.toarray()
+    F = scipy.sparse.csr_matrix(AA > 0)
     rem_ind = np.arange(K)
     O = []
     lo = []
@@ -1016,6 +1123,10 @@ def update_order_greedy(A, flag_AA=True):
     this, given the spatial components using a greedy method
     Basically we can update the components that are not overlapping, in parallel
 
+    The graph of overlapping components is colored greedily, visiting components by decreasing
+    number of overlaps and putting each into the smallest group it does not overlap with, so
+    that the groups stay balanced. A new group is started only when all groups overlap.
+
     Input:
      -------
      A:       sparse crc matrix
@@ -1027,7 +1138,7 @@ def update_order_greedy(A, flag_AA=True):
 
      Outputs:
      ---------
-     parllcomp:   list of sets
+     parllcomp:   list of lists
           list of subsets of components. The components of each subset can be updated in parallel
 
      len_parrllcomp:  list
@@ -1035,25 +1146,35 @@ def update_order_greedy(A, flag_AA=True):
 
     @author: Eftychios A. Pnevmatikakis, Simons Foundation, 2017
     """
-    K = np.shape(A)[-1]
-    parllcomp = []
-    for i in range(K):
-        new_list = True
-        for ls in parllcomp:
-            if flag_AA:
-                if A[i, ls].nnz == 0:
-                    ls.append(i)
-                    new_list = False
-                    break
-            else:
-                if (A[:, i].T.dot(A[:, ls])).nnz == 0:
-                    ls.append(i)
-                    new_list = False
-                    break
-
-        if new_list:
-            parllcomp.append([i])
-    len_parrllcomp = [len(ls) for ls in parllcomp]
+    if flag_AA:
+        AA = scipy.sparse.csr_matrix(A)
+    else:
+        A = scipy.sparse.csc_matrix(A)
+        AA = A.T.dot(A).tocsr()
+    AA = scipy.sparse.csr_matrix(AA != 0)
+    AA.setdiag(False)
+    AA.eliminate_zeros()
+    K = AA.shape[0]
+
+    degree = np.diff(AA.indptr)
+    group = -np.ones(K, dtype=int)
+    sizes = np.zeros(K)
+    n_groups = 0
+    for i in np.argsort(-degree, kind='mergesort'):
+        nbr_groups = group[AA.indices[AA.indptr[i]:AA.indptr[i + 1]]]
+        load = sizes[:n_groups].copy()
+        load[nbr_groups[nbr_groups >= 0]] = np.inf
+        k = np.argmin(load) if n_groups > 0 else 0
+        if n_groups == 0 or load[k] == np.inf:
+            k = n_groups
+            n_groups += 1
+        group[i] = k
+        sizes[k] += 1
+
+    members = np.argsort(group, kind='mergesort')
+    len_parrllcomp = sizes[:n_groups].astype(int).tolist()
+    parllcomp = [ls.tolist() for ls in np.split(members, np.cumsum(len_parrllcomp)[:-1])] \
+        if K > 0 else []
     return parllcomp, len_parrllcomp
 #%%
 
@@ -3,7 +3,9 @@
 import numpy.testing as npt
 import numpy as np
 from time import time
-from caiman.source_extraction.cnmf.deconvolution import constrained_foopsi
+from caiman.source_extraction.cnmf.deconvolution import constrained_foopsi, estimate_parameters, \
+    constrained_oasis_batch, oasis_batch
+from caiman.source_extraction.cnmf.oasis import OASIS, fit_batch, fit_next_batch, get_c_batch, shift_batch
 
 
 def gen_data(g=[.95], sn=.2, T=1000, framerate=30, firerate=.5, b=10, N=1, seed=0):
@@ -73,6 +75,69 @@ def test_oasis():
     foo('oasis', 2)
 
 
+def test_oasis_batch():
+    for g in [[.95], [1.7, -.71]]:
+        Y = gen_data(g, .2, T=500, b=0, N=10)[0].astype(np.float32)
+        oases = [[OASIS(g[0], lam=.1, g2=g[1] if len(g) == 2 else 0) for _ in Y] for _ in range(2)]
+        C = np.zeros((12, 500), dtype=np.float32)
+        fit_batch(oases[1], Y[:, :300], n_threads=3)
+        for i, (o, y) in enumerate(zip(oases[0], Y)):
+            o.fit(y[:300])
+        for t in range(300, 500):
+            fit_next_batch(oases[1], Y[:, t], C=C, t=t, row_offset=2, n_threads=3)
+        for i, (o, y) in enumerate(zip(oases[0], Y)):
+            for yt in y[300:]:
+                o.fit_next(yt)
+            npt.assert_allclose(o.c, oases[1][i].c)
+            npt.assert_allclose(o.s, oases[1][i].s)
+            l = o.get_l_of_last_pool()
+            npt.assert_allclose(C[2 + i, 500 - l:], o.get_c_of_last_pool())
+        npt.assert_allclose(get_c_batch(oases[1], 500, n_threads=3), [o.c for o in oases[0]])
+
+
+def test_shift_batch():
+    Y = gen_data([.95], .2, T=500, b=1, N=10)[0]
+    db, dlam = np.linspace(0, .2, 10), np.linspace(.1, 0, 10)
+    oases = oasis_batch(Y, .95 * np.ones(10), .1, 1)[0]
+    shift_batch(oases, db, dlam, n_threads=3)
+    npt.assert_allclose(get_c_batch(oases, 500), oasis_batch(Y, .95 * np.ones(10), .1 + dlam, 1 + db)[1],
+                        atol=1e-4)
+
+
+def test_constrained_oasis_batch():
+    for g in [[.95], [1.7, -.71]]:
+        Y, trueC = gen_data(g, .3, T=1000, b=2, N=10)[:2]
+        g_all, sn_all = estimate_parameters(Y, p=len(g))
+        C, S, b, lam = constrained_oasis_batch(Y, g_all, sn_all, n_threads=3)
+        for i, y in enumerate(Y):
+            c, bl, c1 = constrained_foopsi(y, g=g_all[i], sn=sn_all[i], p=len(g))[:3]
+            d = max(np.roots(np.append(1, -g_all[i])))
+            c += c1 * d**np.arange(len(y))
+            if len(g) == 1:  # same algorithm as constrained_oasisAR1
+                npt.assert_allclose(b[i], bl, atol=1e-3)
+                npt.assert_allclose(C[i], c, atol=.05)
+            else:  # single OASIS pass instead of ONNLS restricted to the spike times found on decimated data
+                npt.assert_allclose(b[i], bl, atol=.1)
+                assert np.corrcoef(C[i], c)[0, 1] > .99
+            assert np.corrcoef(C[i], trueC[i])[0, 1] > .95
+            npt.assert_allclose(S[i, 1:], C[i, 1:] - g_all[i, 0] * C[i, :-1] -
+                                (g_all[i, 1] * np.append(0, C[i, :-2]) if len(g) == 2 else 0), atol=1e-5)
+        if len(g) == 1:  # noise constraint, AR(2) is a single pass as in constrained_oasisAR2
+            npt.assert_allclose(np.sum((Y - C - b[:, None])**2, 1), sn_all**2 * 1000, rtol=1e-3)
+
+
+def test_estimate_parameters_batch():
+    for g in [[.95], [1.7, -.71]]:
+        Y = gen_data(g, .2, T=2000, b=0, N=10)[0]
+        g_all, sn_all = estimate_parameters(Y, p=len(g), fudge_factor=.98)
+        assert g_all.shape == (10, len(g)) and sn_all.shape == (10,)
+        for i, y in enumerate(Y):
+            g_i, sn_i = estimate_parameters(y, p=len(g), fudge_factor=.98)
+            npt.assert_allclose(g_all[i], g_i)
+            npt.assert_allclose(sn_all[i], sn_i)
+        npt.assert_allclose(g_all, np.tile(g, (10, 1)), atol=.1)
+
+
 # def test_cvx():
 #     try:  # test only if mosek is installed
 #         import mosek
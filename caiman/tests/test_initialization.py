@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+from caiman.summary_images import local_correlations_fft
+from caiman.source_extraction import cnmf
+
+
+def test_local_correlation_moments():
+    ini = cnmf.initialization
+    np.random.seed(0)
+    T = 200
+    Y = np.random.randn(T, 30, 40).astype(np.float32) + np.random.randn(T, 1, 1).astype(np.float32)
+    moments = ini.local_correlation_moments(Y)
+    npt.assert_allclose(ini.local_correlation_from_moments(moments, T),
+                        local_correlations_fft(Y, swap_dim=False), atol=1e-5)
+    # update after changing a block of pixels
+    Y[:, 10:15, 20:26] -= np.random.rand(T, 5, 6).astype(np.float32)
+    ini.local_correlation_moments(Y[:, 9:16, 19:27], moments, (9, 19))
+    npt.assert_allclose(ini.local_correlation_from_moments(moments, T, slice(5, 20), slice(15, 30)),
+                        local_correlations_fft(Y, swap_dim=False)[5:20, 15:30], atol=1e-5)
+
+
+def test_compute_W():
+    np.random.seed(0)
+    dims, T, radius = (20, 25), 300, 3
+    Y = np.random.randn(np.prod(dims), T)
+    Y += np.random.rand(np.prod(dims), 1)
+    A = np.zeros((np.prod(dims), 0))
+    C = np.zeros((0, T))
+    W, b0 = cnmf.initialization.compute_W(Y, A, C, dims, radius)
+    npt.assert_allclose(b0, Y.mean(1), rtol=1e-5)
+    X = Y - Y.mean(1)[:, None]
+    for p in [0, 27, 213, 499]:
+        # least squares regression on the pixels of the ring
+        index = W[p].indices
+        npt.assert_allclose(W[p, index].toarray().ravel(),
+                            np.linalg.lstsq(X[index].T, X[p], rcond=None)[0], rtol=1e-4, atol=1e-6)
+        r = np.array(np.unravel_index(index, dims, order='F')) - \
+            np.array(np.unravel_index(p, dims, order='F'))[:, None]
+        npt.assert_array_less(np.sqrt((r**2).sum(0)), radius + 2)
+    W2, b02 = cnmf.initialization.compute_W(Y, A, C, dims, radius, data_fits_in_memory=False)
+    npt.assert_allclose(W2.toarray(), W.toarray(), rtol=1e-4, atol=1e-6)
+    # systems formed and solved in tiles of columns of pixels
+    W3, b03 = cnmf.initialization.compute_W(Y, A, C, dims, radius, data_fits_in_memory=False, tile_width=3)
+    npt.assert_allclose(W3.toarray(), W.toarray(), rtol=1e-4, atol=1e-6)
+    npt.assert_allclose(b03, b0)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+import scipy.sparse
+import scipy.signal
+from caiman.source_extraction import cnmf
+
+
+def gen_data():
+    np.random.seed(0)
+    dims, T = (30, 30), 300
+    spikes = (np.random.rand(3, T) < .03).astype(float)
+    traces = np.array([scipy.signal.lfilter([1], [1, -.9], s) for s in spikes])
+    C = np.vstack([traces[0], traces[0], traces[1], traces[2]]) + .01 * np.random.rand(4, T)
+    A = np.zeros(dims + (4,))
+    A[5:12, 5:12, 0] = 1
+    A[8:15, 8:15, 1] = 1    # overlaps 0, same activity
+    A[20:27, 20:27, 2] = 1
+    A[24:29, 18:25, 3] = 1  # overlaps 2, different activity
+    A = scipy.sparse.csc_matrix(A.reshape((-1, 4), order='F'))
+    return A, C, dims, T
+
+
+def test_merge_components():
+    A, C, dims, T = gen_data()
+    rows, cols, corr = cnmf.merging.overlap_correlations(A, C)
+    npt.assert_array_equal(np.transpose([rows, cols]), [[0, 1], [2, 3]])
+    npt.assert_allclose(corr, np.corrcoef(C)[rows, cols])
+
+    options = cnmf.utilities.CNMFSetParms(dims, 1, K=4, p=1)
+    for max_merge_iter in (1, np.inf):
+        A_m, C_m, nr, merged_ROIs, S, bl, c1, sn, g = cnmf.merging.merge_components(
+            np.zeros((np.prod(dims), T)), A, [], C, [], C, [], options['temporal_params'],
+            options['spatial_params'], thr=0.8, g=[[.9]] * 4, max_merge_iter=max_merge_iter)
+        assert nr == 3 and A_m.shape[1] == 3 and C_m.shape == (3, T)
+        npt.assert_array_equal(merged_ROIs[0], [0, 1])
+        npt.assert_array_equal(A_m[:, :2].toarray(), A[:, 2:].toarray())
+        # merged footprint covers the union of the two supports
+        npt.assert_array_equal(A_m[:, 2].toarray().ravel() > 0,
+                               (A[:, 0] + A[:, 1]).toarray().ravel() > 0)
+        assert np.corrcoef(C_m[2], C[0])[0, 1] > .9
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+import os
+import shutil
+import tempfile
+import cv2
+import h5py
+import multiprocessing
+import caiman as cm
+from caiman.motion_correction import tile_and_correct, tile_and_correct_batch, register_translation_pyramid, \
+    compute_metrics_batch, tile_and_correct_3d, write_frames_memmap, bin_mean, interpolate_shifts, \
+    _upsampled_dft, _upsampled_dft_batch, motion_correct_batch_rigid, motion_correct_batch_pwrigid, \
+    refine_template_streaming, MotionCorrect
+
+
+def gen_data(T=10, dims=(64, 80), max_shift=4, seed=0):
+    """
+    Generate a movie of random blobs translated by random integer shifts
+    """
+    np.random.seed(seed)
+    xx, yy = np.meshgrid(np.arange(dims[0] + 2 * max_shift), np.arange(dims[1] + 2 * max_shift), indexing='ij')
+    img = np.zeros(xx.shape, dtype=np.float32)
+    for cx, cy in np.random.rand(dims[0] * dims[1] // 100, 2) * xx.shape:
+        img += np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / 8.)
+    shifts = np.random.randint(-max_shift, max_shift + 1, size=(T, 2))
+    mov = np.array([img[max_shift + sx:max_shift + sx + dims[0], max_shift + sy:max_shift + sy + dims[1]]
+                    for sx, sy in shifts])
+    template = img[max_shift:max_shift + dims[0], max_shift:max_shift + dims[1]]
+    return mov, template, shifts
+
+
+def gen_drift_file(folder, T=120, dims=(64, 80), max_shift=6, seed=0):
+    """
+    Save a movie of random blobs translated by a smooth subpixel drift in folder, return its name and the drift
+    """
+    np.random.seed(seed)
+    xx, yy = np.meshgrid(np.arange(dims[0] + 2 * max_shift), np.arange(dims[1] + 2 * max_shift), indexing='ij')
+    img = np.zeros(xx.shape, dtype=np.float32)
+    for cx, cy in np.random.rand(60, 2) * xx.shape:
+        img += np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / 8.)
+    drift = np.column_stack([3 * np.sin(np.arange(T) / 20.), 2 * np.cos(np.arange(T) / 25.)])
+    mov = np.array([cv2.warpAffine(img, np.float32([[1, 0, dy], [0, 1, dx]]), img.shape[::-1])
+                    [max_shift:max_shift + dims[0], max_shift:max_shift + dims[1]] for dx, dy in drift])
+    fname = os.path.join(folder, 'mov.hdf5')
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('mov', data=mov.astype(np.float32))
+    return fname, drift
+
+
+def test_tile_and_correct_batch():
+    mov, template, _ = gen_data()
+    for strides, overlaps, max_dev in [(None, None, 0), ((24, 24), (12, 12), 2)]:
+        for shifts_opencv in [True, False]:
+            ref = [tile_and_correct(img, template, strides, overlaps, (6, 6), max_deviation_rigid=max_dev,
+                                    shifts_opencv=shifts_opencv) for img in mov]
+            new_imgs, shift_info = tile_and_correct_batch(mov, template, strides, overlaps, (6, 6),
+                                                          max_deviation_rigid=max_dev,
+                                                          shifts_opencv=shifts_opencv)
+            npt.assert_allclose(new_imgs, np.array([r[0] for r in ref]), atol=1e-6)
+            npt.assert_allclose(np.array([sh[0] for sh in shift_info], dtype=float),
+                                np.array([r[1] for r in ref], dtype=float))
+            none, shift_info_only = tile_and_correct_batch(mov, template, strides, overlaps, (6, 6),
+                                                           max_deviation_rigid=max_dev,
+                                                           shifts_opencv=shifts_opencv, shifts_only=True)
+            assert none is None and shift_info_only == shift_info
+
+
+def test_register_translation_pyramid():
+    mov, template, shifts = gen_data(T=5, dims=(96, 96), max_shift=20, seed=1)
+    for levels in [0, 2]:
+        est, _ = register_translation_pyramid(mov, template, levels=levels, upsample_factor=10,
+                                              max_shifts=(20, 20))
+        npt.assert_allclose(est, -shifts, atol=0.5)
+
+
+def test_compute_metrics_batch():
+    mov, template, shifts = gen_data(T=5, max_shift=3)
+    for strides, overlaps in [(None, None), ((24, 24), (12, 12))]:
+        new_imgs, shift_info = tile_and_correct_batch(mov, template, strides, overlaps, (6, 6),
+                                                      max_deviation_rigid=0)
+        correlations, est = compute_metrics_batch(new_imgs, template, shift_info)
+        npt.assert_allclose(est, shifts, atol=0.5)
+        # the NaN borders left by the correction do not enter the correlations
+        assert np.all(np.isnan(new_imgs).any(axis=(1, 2)))
+        npt.assert_allclose(correlations, [np.corrcoef(img[~np.isnan(img)], template[~np.isnan(img)])[0, 1]
+                                           for img in new_imgs])
+        assert np.all(correlations > .9)
+    correlations, est = compute_metrics_batch(np.array([template] * 3), template, [[(0., 0.), None, None]] * 3)
+    npt.assert_allclose(correlations, 1)
+    npt.assert_allclose(est, 0)
+
+
+def test_tile_and_correct_3d():
+    # stack shifted copies of a plane along z so that each volume is translated in 3D
+    mov2d, plane, shifts = gen_data(T=4, dims=(48, 56), max_shift=3, seed=2)
+    z_prof = np.exp(-(np.arange(16) - 8.) ** 2 / 8.)
+    template = plane[:, :, None] * z_prof
+    mov = np.array([img[:, :, None] * np.roll(z_prof, sz) for img, sz in zip(mov2d, shifts[:, 0] // 2)])
+    true_shifts = np.column_stack([shifts, -(shifts[:, 0] // 2)])
+    new_imgs, shift_info = tile_and_correct_3d(mov, template, None, None, (6, 6, 3), max_deviation_rigid=0)
+    npt.assert_allclose(np.array([sh[0] for sh in shift_info]), true_shifts, atol=0.3)
+    new_imgs, shift_info = tile_and_correct_3d(mov, template, (16, 16, 8), (8, 8, 4), (6, 6, 3),
+                                               max_deviation_rigid=1)
+    err = np.nanmean(np.abs(new_imgs - template)[:, 6:-6, 6:-6, 3:-3])
+    assert err < 0.2 * np.mean(np.abs(mov - template)[:, 6:-6, 6:-6, 3:-3])
+
+
+def test_write_frames_memmap():
+    mov, _, _ = gen_data(T=12, dims=(20, 30))
+    expected = np.reshape(mov, (len(mov), -1), order='F').T + 1
+    for order in ['C', 'F']:
+        fname = os.path.join(tempfile.mkdtemp(), 'test_' + order + '.mmap')
+        outv = np.memmap(fname, mode='w+', dtype=np.float32, shape=expected.shape, order=order)
+        write_frames_memmap(outv, mov[:5], np.arange(5), bias=1, block_size=128)
+        write_frames_memmap(outv, mov[5:], np.arange(5, 12), bias=1, block_size=128)
+        npt.assert_allclose(outv, expected, rtol=1e-6)
+        del outv
+        os.remove(fname)
+
+
+def test_volumetric_metrics_not_supported():
+    for kwargs in [dict(compute_metrics=True), dict(frames_per_bin=4)]:
+        npt.assert_raises(ValueError, motion_correct_batch_rigid, 'mov.mmap', (3, 3, 3), is3D=True, **kwargs)
+        npt.assert_raises(ValueError, motion_correct_batch_pwrigid, 'mov.mmap', (3, 3, 3), (16, 16, 8),
+                          (8, 8, 4), 0, template=np.zeros((32, 32, 16)), is3D=True, **kwargs)
+
+
+def test_binned_shifts():
+    # linear drift is recovered exactly by interpolating the shifts of the bin averages
+    drift = np.column_stack([np.linspace(-3, 3, 23), np.linspace(2, -1, 23)])
+    binned, centers = bin_mean(drift, 5)
+    npt.assert_allclose(centers, [2, 7, 12, 17, 21])
+    npt.assert_allclose(interpolate_shifts(binned, centers, 23)[2:-1], drift[2:-1], atol=1e-12)
+
+
+def test_movie_shifts_threads():
+    mov, template, shifts = gen_data(T=20)
+    mov = cm.movie(mov)
+    sh_1, _ = mov.extract_shifts(5, 5, template=template, n_threads=1)
+    sh_3, _ = mov.extract_shifts(5, 5, template=template, n_threads=3)
+    npt.assert_allclose(sh_1, sh_3)
+    npt.assert_allclose(np.round(sh_1), shifts)
+    reg_1 = mov.copy().apply_shifts(sh_1, n_threads=1)
+    out = np.zeros(mov.shape, dtype=np.float32)
+    mov.copy().apply_shifts(sh_1, n_threads=3, out=out)
+    npt.assert_allclose(out, reg_1)
+
+
+def test_upsampled_dft_batch():
+    np.random.seed(3)
+    for shape in [(24, 20), (12, 10, 8)]:
+        data = np.random.randn(5, *shape) + 1j * np.random.randn(5, *shape)
+        offsets = np.random.randn(5, len(shape)) * 5
+        ref = np.array([_upsampled_dft(d, 15, 10, off) for d, off in zip(data, offsets)])
+        npt.assert_allclose(_upsampled_dft_batch(data, 15, 10, offsets), ref, atol=1e-10)
+
+
+def test_batch_motion_correction_binned():
+    # on a slow drift, shifts estimated on bins of frames match those estimated on every frame
+    folder = tempfile.mkdtemp()
+    try:
+        fname, _ = gen_drift_file(folder)
+        res = [motion_correct_batch_rigid(fname, (8, 8), splits=2, frames_per_bin=fpb) for fpb in [1, 4]]
+        npt.assert_allclose(res[1][3], res[0][3], atol=0.5)
+        template = res[0][1]
+        res = [motion_correct_batch_pwrigid(fname, (8, 8), (32, 32), (16, 16), 0, template=template, splits=2,
+                                            frames_per_bin=fpb) for fpb in [1, 4]]
+        for k in [3, 4]:  # x and y shifts of the patches
+            npt.assert_allclose(res[1][k], res[0][k], atol=0.5)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_refine_template_streaming():
+    folder = tempfile.mkdtemp()
+    try:
+        fname, _ = gen_drift_file(folder)
+        template = np.median(np.asarray(cm.load(fname)), 0)
+        kwargs = dict(strides=None, overlaps=None, max_shifts=(8, 8), max_deviation_rigid=0, add_to_movie=0)
+        # stops early once the template settles, close to the template of full passes
+        new_templ, num_chunks, converged = refine_template_streaming(fname, template, 8, num_passes=4,
+                                                                     tol=1e-2, **kwargs)
+        assert converged and num_chunks < 4 * 8
+        ref = motion_correct_batch_rigid(fname, (8, 8), splits=8, num_iter=3, template=template,
+                                         add_to_movie=0)[1]
+        assert np.corrcoef(new_templ.ravel(), ref.ravel())[0, 1] > 0.99
+        _, num_chunks, converged = refine_template_streaming(fname, template, 8, num_passes=2, tol=None,
+                                                             **kwargs)
+        assert not converged and num_chunks == 2 * 8
+
+        # without template_tol every iteration is a full pass registering to the previous template
+        res = motion_correct_batch_rigid(fname, (8, 8), splits=2, num_iter=2, template=template,
+                                         add_to_movie=0, template_tol=None)
+        first = motion_correct_batch_rigid(fname, (8, 8), splits=2, num_iter=1, template=template,
+                                           add_to_movie=0)
+        second = motion_correct_batch_rigid(fname, (8, 8), splits=2, num_iter=1, template=first[1],
+                                            add_to_movie=0)
+        npt.assert_array_equal(res[1], second[1])
+        npt.assert_array_equal(res[3], second[3])
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_apply_shifts_movie_parallel():
+    # stored shifts applied chunk by chunk to a memory mapped file match those applied in memory
+    folder = tempfile.mkdtemp()
+    dview = multiprocessing.Pool(2)
+    try:
+        fname, _ = gen_drift_file(folder, T=48)
+        fname_mmap = cm.save_memmap([fname], base_name=os.path.join(folder, 'mov'), order='C')
+        mc = MotionCorrect(fname, 0, max_shifts=(8, 8), strides=(32, 32), overlaps=(16, 16), splits_rig=3,
+                           splits_els=3, max_deviation_rigid=2)
+        mc.motion_correct_rigid(save_movie=False)
+        mc.motion_correct_pwrigid(save_movie=False, template=mc.total_template_rig)
+        for rigid_shifts in [True, False]:
+            ref = np.asarray(mc.apply_shifts_movie(fname_mmap, rigid_shifts=rigid_shifts))
+            for mc.dview in [None, dview]:
+                fname_out = mc.apply_shifts_movie(fname_mmap, rigid_shifts=rigid_shifts, save_memmap=True,
+                                                  base_name=os.path.join(folder, 'shifted'))
+                npt.assert_array_equal(np.asarray(cm.load(fname_out)), ref)
+    finally:
+        dview.terminate()
+        shutil.rmtree(folder)
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
+import os
+import shutil
+import tempfile
 import numpy.testing as npt
 import numpy as np
+from caiman.mmapping import load_memmap
 from caiman.source_extraction import cnmf as cnmf
 
+
 def test_axcov():
     data = np.random.randn(1000)
     maxlag = 5
@@ -12,3 +17,55 @@ def test_axcov():
 
     npt.assert_allclose(C, np.concatenate(
         (np.zeros(maxlag), np.array([1]), np.zeros(maxlag))), atol=1)
+
+
+def test_get_noise_fft():
+    np.random.seed(0)
+    sn_true = np.random.rand(20, 30) + .5
+    Y = (np.random.randn(20, 30, 4000) * sn_true[..., None]).astype(np.float32)
+    for opencv in (True, False):
+        sn, psx = cnmf.pre_processing.get_noise_fft(Y, noise_method='mean', max_num_samples_fft=3000,
+                                                          opencv=opencv)
+        npt.assert_allclose(sn, sn_true, rtol=.1)
+        assert psx.shape[:2] == (20, 30)
+        # blocks of pixels give the same result as the single pixels
+        npt.assert_allclose(sn[3, 4], cnmf.pre_processing.get_noise_fft(
+            Y[3:4, 4], noise_method='mean', max_num_samples_fft=3000, opencv=opencv, return_psd=False)[0], rtol=1e-6)
+
+
+def test_preprocess_data_cache_noise():
+    np.random.seed(0)
+    d1, d2, T = 10, 12, 1000
+    folder = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(folder, 'Yr_d1_%d_d2_%d_d3_1_order_C_frames_%d_.mmap' % (d1, d2, T))
+        Yr = np.memmap(fname, mode='w+', dtype=np.float32, shape=(d1 * d2, T), order='C')
+        Yr[:] = np.random.randn(d1 * d2, T)
+        Yr.flush()
+        del Yr
+        Yr, dims, T = load_memmap(fname)
+        kwargs = dict(noise_method='mean', noise_range=[.25, .5], max_num_samples_fft=3000, cache_noise=True)
+        cache_file = os.path.splitext(fname)[0] + '_sn.npz'
+        sn = cnmf.pre_processing.preprocess_data(Yr, **kwargs)[1]
+
+        def tamper():  # store a value that can only be returned by a cache hit
+            with np.load(cache_file) as ld:
+                key = ld['key']
+            np.savez(cache_file, sn=-np.ones_like(sn), key=key)
+
+        # hit
+        tamper()
+        npt.assert_array_equal(cnmf.pre_processing.preprocess_data(Yr, **kwargs)[1], -1)
+        # invalidated by other parameters and by a modified file
+        assert (cnmf.pre_processing.preprocess_data(Yr, **dict(kwargs, noise_range=[.3, .5]))[1] > 0).all()
+        npt.assert_array_equal(cnmf.pre_processing.preprocess_data(Yr, **kwargs)[1], sn)
+        tamper()
+        os.utime(fname, (os.path.getatime(fname), os.path.getmtime(fname) + 10))
+        npt.assert_array_equal(cnmf.pre_processing.preprocess_data(Yr, **kwargs)[1], sn)
+        # bypassed for partial views, fancy indexed patches, copies and writable maps
+        tamper()
+        for Y in (Yr[:50], Yr[:, :500], Yr[np.arange(d1 * d2)], np.array(Yr), load_memmap(fname, mode='r+')[0]):
+            assert (cnmf.pre_processing.preprocess_data(Y, **kwargs)[1] > 0).all()
+        del Yr, Y
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+from caiman.base.rois import detect_duplicates_and_subsets
+
+
+def test_detect_duplicates_and_subsets():
+    masks = np.zeros((5, 50, 50))
+    masks[0, 5:12, 5:12] = 1
+    masks[1, 5:12, 5:12] = 1    # duplicate of 0
+    masks[2, 30:40, 30:40] = 1
+    masks[3, 32:37, 32:37] = 1  # subset of 2
+    masks[4, 10:16, 30:36] = 1
+    predictions = np.array([.9, .8, .7, .95, .6])
+    duplicates, keep, remove, D, overlap = detect_duplicates_and_subsets(
+        masks, predictions=predictions, dist_thr=0.1, min_dist=10, thresh_subset=0.8)
+    npt.assert_array_equal(sorted(set(np.ravel(duplicates))), [0, 1, 2, 3])
+    npt.assert_array_equal(sorted(remove), [1, 2])
+    npt.assert_array_equal(keep, [0, 3])
+    npt.assert_allclose(D[0, 1], 0)
+    npt.assert_allclose(D[2, 3], 1 - 25. / 100)
+    assert np.all(D[4, :4] == 1) and np.all(overlap[4] == 0)
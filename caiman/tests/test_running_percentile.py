@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+from scipy.ndimage import percentile_filter
+from caiman.source_extraction.cnmf.running_percentile import running_percentile, RunningPercentile
+
+
+def test_running_percentile():
+    np.random.seed(0)
+    Y = np.random.randn(4, 300)
+    Y[1] = np.round(Y[1])  # many ties
+    for w in [1, 2, 25, 100, 301]:
+        for q in [0, 8, 50, 100]:
+            npt.assert_array_equal(running_percentile(Y, q, w),
+                                   [percentile_filter(y, q, w) for y in Y])
+    q = [5, 20, 50, 100]
+    npt.assert_array_equal(running_percentile(Y, q, 60, n_threads=2),
+                           [percentile_filter(y, qq, 60) for y, qq in zip(Y, q)])
+
+
+def test_running_percentile_streaming():
+    np.random.seed(0)
+    Y = np.random.randn(3, 200)
+    q, w = [8, 50, 100], 30
+    out = RunningPercentile(3, q, w).fit(Y)
+    for t in range(Y.shape[1]):
+        for n in range(3):
+            window = np.sort(Y[n, max(0, t - w + 1):t + 1])
+            rank = len(window) - 1 if q[n] == 100 else int(len(window) * q[n] / 100.)
+            npt.assert_equal(out[n, t], window[rank])
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import numpy.testing as npt
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from scipy.optimize import nnls
+from caiman.source_extraction import cnmf
+
+
+def test_regression_hals():
+    np.random.seed(0)
+    C = np.random.rand(4, 200)
+    A = np.random.rand(30, 4) * (np.random.rand(30, 4) > .3)
+    Y = A.dot(C) + .01 * np.random.randn(30, 200)
+    mask = np.ones((30, 4), dtype=bool)
+    mask[:10, 0] = False
+    pars = [Y.dot(C.T), np.arange(30), np.arange(4), mask, np.zeros((30, 4)), C.dot(C.T), np.zeros(30)]
+    px, idxs_C, a = cnmf.spatial.regression_hals(pars, iters=500)[0]
+    npt.assert_array_equal(px.squeeze(), np.arange(30))
+    npt.assert_array_equal(a[~mask], 0)
+    for y, m, a_ in zip(Y, mask, a):
+        npt.assert_allclose(a_[m], nnls(C[m].T, y)[0], atol=1e-6)
+
+
+def test_update_spatial_components_hals():
+    np.random.seed(3)
+    dims, T, N = (20, 30), 300, 3
+    trueA = np.zeros(dims + (N,))
+    for i, c in enumerate([[6, 8], [13, 20], [8, 22]]):
+        trueA[tuple(c) + (i,)] = 1.
+    trueA = gaussian_filter(trueA, (2, 2, 0)).reshape((-1, N), order='F')
+    trueA /= trueA.max(0)
+    C = (np.random.rand(N, T) < .05).astype(float)
+    for t in range(1, T):
+        C[:, t] += .9 * C[:, t - 1]
+    f = np.ones((1, T))
+    b = 2 * np.ones((np.prod(dims), 1))
+    Y = trueA.dot(C) + b.dot(f) + .1 * np.random.randn(np.prod(dims), T)
+    sn = cnmf.pre_processing.get_noise_fft(Y)[0]
+    # the initial footprints only cover the cores, the search locations are smaller than the true footprints
+    A_in = trueA * (1 + .2 * np.random.rand(*trueA.shape)) * (trueA > .3)
+    search = cnmf.spatial.determine_search_location(A_in, dims, method='dilate').toarray() > 0
+    assert np.any(trueA[~search] > .01)
+
+    A = {}
+    for method_ls in ['lasso_lars', 'hals']:
+        A[method_ls] = cnmf.spatial.update_spatial_components(
+            Y, C.copy(), f.copy(), A_in.copy(), sn=sn, dims=dims, b_in=b.copy(), method='dilate',
+            method_ls=method_ls, n_pixels_per_process=100, extract_cc=False)[0].toarray()
+    npt.assert_array_equal(A['hals'][~search], 0)
+    for a_hals, a_lars, a_true in zip(A['hals'].T, A['lasso_lars'].T, trueA.T):
+        assert np.corrcoef(a_hals, a_true)[0, 1] > .99
+        assert np.corrcoef(a_hals, a_lars)[0, 1] > .999
+    npt.assert_allclose(A['hals'], A['lasso_lars'], atol=.01 * A['lasso_lars'].max())
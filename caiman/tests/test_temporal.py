@@ -19,3 +19,60 @@ def test_make_G_matrix():
          [0., 0., -3., -2., -1., 1.]])
 
     npt.assert_allclose(G, true_G)
+
+
+def test_constrained_foopsi_block():
+    np.random.seed(0)
+    T = 500
+    Y = np.array([np.convolve((np.random.rand(T) < .05) * np.random.rand(T), .9 ** np.arange(100))[:T]
+                  for _ in range(3)]).T + .05 * np.random.randn(T, 3)
+    for p in [1, 2]:
+        kwargs = dict(p=p, method='oasis', bas_nonneg=False, noise_range=[.25, .5], noise_method='mean', lags=5,
+                      fudge_factor=.96, verbosity=False)
+        # all traces of the block at once with OASIS
+        res = cnmf.temporal.constrained_foopsi_block((Y, np.array([4, 7, 9]), kwargs, 2))
+        # one trace at a time, with s_min
+        res_smin = cnmf.temporal.constrained_foopsi_block((Y, np.array([4, 7, 9]), dict(kwargs, s_min=0)))
+        for k, (jj, out, out_smin) in enumerate(zip([4, 7, 9], res, res_smin)):
+            ref = cnmf.temporal.constrained_foopsi_parallel((Y[:, k], None, jj, None, None, None, None, kwargs))
+            npt.assert_equal(out[7], jj)
+            npt.assert_allclose(out[0] + out[2], Y[:, k], rtol=1e-5, atol=1e-5)
+            c = out[0] - out[3]
+            npt.assert_allclose(out[1][1:], c[1:] - sum(out[6][i] * np.append(np.zeros(i), c[:T - 1 - i])
+                                                        for i in range(p)), atol=1e-5)
+            if p == 1:  # same algorithm as constrained_oasisAR1
+                npt.assert_allclose(out[0], ref[0], atol=.05)
+                assert np.abs(out[0] - ref[0]).mean() < 2e-3
+            else:  # single OASIS pass instead of ONNLS restricted to the spike times found on decimated data
+                assert np.abs(out[0] - ref[0]).mean() < .02
+                assert np.corrcoef(out[0], ref[0])[0, 1] > .99
+            npt.assert_allclose(out_smin[0], cnmf.temporal.constrained_foopsi_parallel(
+                (Y[:, k], None, jj, None, None, None, None, dict(kwargs, s_min=0)))[0])
+
+
+def test_constrained_foopsi_block_fixed_params():
+    np.random.seed(0)
+    T = 500
+    Y = np.array([np.convolve((np.random.rand(T) < .05) * np.random.rand(T), .9 ** np.arange(100))[:T]
+                  for _ in range(4)]).T + .05 * np.random.randn(T, 4) + [-.2, 0, .3, .6]
+    jjs = np.array([1, 3, 5, 8])
+    for p in [1, 2]:
+        kwargs = dict(p=p, method='oasis', bas_nonneg=False, noise_range=[.25, .5], noise_method='mean',
+                      lags=5, fudge_factor=.96, verbosity=False)
+        ref = cnmf.temporal.constrained_foopsi_block((Y, jjs, kwargs))
+        bl, sn, g, lam = [[r[i] for r in ref] for i in (3, 5, 6, 8)]
+        res = cnmf.temporal.constrained_foopsi_block((Y, jjs, kwargs, bl, g, sn, lam, 2))
+        for k, (r, out) in enumerate(zip(ref, res)):
+            npt.assert_equal(out[7], jjs[k])
+            npt.assert_allclose(out[3], bl[k])
+            npt.assert_allclose(out[0] + out[2], Y[:, k], rtol=1e-5, atol=1e-5)
+            # same problem as the noise constrained one, solved exactly for the final lam
+            npt.assert_allclose(out[0], r[0], atol=.05)
+            assert np.abs(out[0] - r[0]).mean() < 1e-3
+            npt.assert_allclose(out[1], r[1], atol=.05)
+        # one trace at a time with s_min
+        kwargs['s_min'] = 0
+        res = cnmf.temporal.constrained_foopsi_block((Y, jjs, kwargs, bl, g, sn, lam, 2))
+        for k, out in enumerate(res):
+            npt.assert_allclose(out[0], cnmf.temporal.constrained_foopsi_parallel(
+                (Y[:, k], None, jjs[k], bl[k], None, g[k], sn[k], kwargs))[0])
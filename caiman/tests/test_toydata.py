@@ -81,3 +81,70 @@ def test_2D():
 
 def test_3D():
     pipeline(3)
+
+
+def test_fit_more():
+    Yr, trueC, trueS, trueA, centers, dims = gen_data(2)
+    N, T = trueC.shape
+    trueA = np.reshape(trueA, (-1, N), order='F')
+    images = np.reshape(Yr.T, (T,) + dims, order='F')
+    cnm = cnmf.CNMF(1, k=N, gSig=[2, 2], p=1)
+    cnm.options['spatial_params']['extract_cc'] = False
+    # components of a previous session: perturbed footprints, background, traces of other frames
+    np.random.seed(1)
+    cnm.A = trueA * (1 + .3 * np.random.rand(*trueA.shape))
+    cnm.b = np.ones((np.prod(dims), 1))
+    cnm.C = np.random.rand(N, 100)
+    cnm.f = np.ones((1, 100))
+    cnm.fit_more(images, n_iter=1)
+    npt.assert_array_equal(cnm.idx_previous, np.arange(N))
+    corr = [np.corrcoef(tc, c)[0, 1] for tc, c in zip(trueC, cnm.C)]
+    npt.assert_allclose(corr, 1, .05)
+    corr = [np.corrcoef(ta, a)[0, 1] for ta, a in zip(trueA.T, cnm.A.toarray().T)]
+    npt.assert_allclose(corr, 1, .05)
+
+
+def test_fit_more_search_residual():
+    Yr, trueC, trueS, trueA, centers, dims = gen_data(2)
+    N, T = trueC.shape
+    trueA = np.reshape(trueA, (-1, N), order='F')
+    images = np.reshape(Yr.T, (T,) + dims, order='F')
+    cnm = cnmf.CNMF(1, k=1, gSig=[2, 2], p=1)
+    cnm.options['spatial_params']['extract_cc'] = False
+    # the last neuron is missing, a footprint without activity and a duplicate are added
+    np.random.seed(1)
+    A = trueA[:, :N - 1] * (1 + .3 * np.random.rand(np.prod(dims), N - 1))
+    empty = np.zeros(dims)
+    empty[:3, 26:] = 1
+    cnm.A = np.hstack((A, empty.reshape((-1, 1), order='F'), A[:, :1]))
+    cnm.b = np.ones((np.prod(dims), 1))
+    cnm.C = np.random.rand(N + 1, 100)
+    cnm.f = np.ones((1, 100))
+    npt.assert_raises(ValueError, cnm.fit_more, images, n_iter=0, search_residual=True)
+    options = {key: dict(params) for key, params in cnm.options.items()}
+    cnm.fit_more(images, n_iter=1, search_residual=True, max_new_comps=1)
+    npt.assert_array_equal(cnm.idx_previous, [0, 1, 2, 4, -1])
+    for key, params in options.items():
+        assert cnm.options[key].keys() == params.keys()
+        for k, v in params.items():
+            npt.assert_array_equal(cnm.options[key][k], v)
+    assert np.corrcoef(trueA[:, N - 1], cnm.A.toarray()[:, -1])[0, 1] > .95
+
+
+def test_refine_multiscale():
+    Yr, trueC, trueS, trueA, centers, dims = gen_data(2)
+    N, T = trueC.shape
+    Y = np.reshape(Yr, dims + (T,), order='F')
+    ini = cnmf.initialization
+    A_ds = ini.downscale(trueA, (4, 4, 1))
+    ds = A_ds.shape[:-1]
+    A_up = ini.resize(A_ds, dims + (N,)).reshape((-1, N), order='F')
+    A, C = ini.refine_multiscale(Y, A_ds.reshape((-1, N), order='F'), trueC, ds,
+                                 b=10 * np.ones((np.prod(dims), 1)), f=np.ones((1, T)))
+    trueA = np.reshape(trueA, (-1, N), order='F')
+    corr_up = [np.corrcoef(ta, a)[0, 1] for ta, a in zip(trueA.T, A_up.T)]
+    corr = [np.corrcoef(ta, a)[0, 1] for ta, a in zip(trueA.T, A.toarray().T)]
+    npt.assert_array_less(corr_up, corr)
+    npt.assert_allclose(np.mean(corr), 1, .05)
+    corr = [np.corrcoef(tc, c)[0, 1] for tc, c in zip(trueC, C)]
+    npt.assert_allclose(corr, 1, .05)
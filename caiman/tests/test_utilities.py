@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import numpy.testing as npt
+import numpy as np
+import scipy.sparse
+from caiman.mmapping import load_memmap
+from caiman.source_extraction.cnmf.utilities import (
+    compute_residuals, detrend_df_f, detrend_df_f_memmap, update_order_greedy, app_vertex_cover)
+
+
+def test_detrend_df_f_memmap():
+    np.random.seed(0)
+    d1, d2, T, N = 20, 15, 300, 12
+    A = scipy.sparse.random(d1 * d2, N, density=.1, format='csc', random_state=0) + \
+        scipy.sparse.eye(d1 * d2, N, format='csc')
+    b = np.random.rand(d1 * d2, 1)
+    C = np.abs(np.random.randn(N, T)) + 1
+    f = np.random.rand(1, T) + 5
+    Y = (A.dot(C) + b.dot(f) + .1 * np.random.randn(d1 * d2, T)).astype(np.float32)
+
+    folder = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(folder, 'Yr_d1_%d_d2_%d_d3_1_order_C_frames_%d_.mmap' % (d1, d2, T))
+        Yr = np.memmap(fname, mode='w+', dtype=np.float32, shape=(d1 * d2, T), order='C')
+        Yr[:] = Y
+        Yr.flush()
+        Yr, dims, T = load_memmap(fname)
+
+        expected = detrend_df_f(A, b, C, f, YrA=compute_residuals(Y, A, b, C, f),
+                                frames_window=100, flag_auto=False)
+        fname_out = os.path.join(folder, 'F_df.npy')
+        F_df = detrend_df_f_memmap(Yr, A, b, C, f, frames_window=100, flag_auto=False,
+                                   fname_out=fname_out, comps_per_block=5, block_size=70)
+        npt.assert_allclose(F_df, expected, rtol=1e-3, atol=1e-5)
+        npt.assert_array_equal(np.load(fname_out, mmap_mode='r'), F_df)
+        del F_df, Yr
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_update_order_greedy():
+    np.random.seed(0)
+    A = scipy.sparse.random(2000, 300, density=.005, format='csc', random_state=0)
+    F = (A.T.dot(A) != 0).toarray()
+    np.fill_diagonal(F, False)
+    groups, lengths = update_order_greedy(A, flag_AA=False)
+    npt.assert_array_equal(sorted(sum(groups, [])), np.arange(300))
+    npt.assert_array_equal(lengths, [len(ls) for ls in groups])
+    for ls in groups:
+        assert not F[np.ix_(ls, ls)].any()
+    assert max(lengths) - min(lengths) <= 1
+    assert groups == update_order_greedy(A.T.dot(A))[0]
+
+    L = app_vertex_cover(F)
+    assert not np.delete(np.delete(F, L, 0), L, 1).any()
@@ -47,6 +47,10 @@ data_files.append(['bin', binaries])
 ext_modules = [Extension("caiman.source_extraction.cnmf.oasis",
                          sources=["caiman/source_extraction/cnmf/oasis.pyx"],
                          include_dirs=[np.get_include()],
+                         language="c++"),
+               Extension("caiman.source_extraction.cnmf.running_percentile",
+                         sources=["caiman/source_extraction/cnmf/running_percentile.pyx"],
+                         include_dirs=[np.get_include()],
                          language="c++")]
 
 setup(